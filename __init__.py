@@ -31,6 +31,7 @@ from bpy.props import CollectionProperty, PointerProperty
 from . import sl_mesh
 from . import sl_const
 from . import sl_animation
+from . import sl_sampler
 from . import tgor_export
 from . import tgor_character
 from . import tgor_util
@@ -73,6 +74,7 @@ class TGOR_PT_GameAnimExport(Panel):
 			if selectedCharacter:
 				col = self.layout.column()
 				col.prop(selectedCharacter, "meshFolder", text="Skel. Meshes")
+				col.prop(context.window_manager.tgor_action_settings, "skipUnchanged")
 							
 				# ui box that lists all the exportable meshes of the character
 				characterScene = bpy.data.scenes.get(selectedCharacter.scene)
@@ -138,6 +140,7 @@ class TGOR_PT_GameAnimExport(Panel):
 						col.operator("object.sl_mesh_remove_unused_groups", icon='EDITMODE_HLT')
 						col.operator("object.sl_mesh_remove_empty_groups", icon='MESH_DATA')
 						col.operator("object.sl_mesh_fix_weightmaps", icon='MOD_VERTEX_WEIGHT')
+						col.operator("object.sl_mesh_audit_weights", icon='VIEWZOOM')
 						
 						row.separator()
 						
@@ -146,9 +149,19 @@ class TGOR_PT_GameAnimExport(Panel):
 						col.label(text="Export collada:")
 						col.prop(selectedCharacter, "meshFolder", text="Output")
 						# col.prop(context.window_manager.sl_mesh_export, 'file_path')
+						col.row().prop(context.window_manager.sl_mesh_export, "writer", expand=True)
+						col.prop(context.window_manager.sl_mesh_export, "processes")
+						col.prop(context.window_manager.sl_mesh_export, "skipUnchanged")
 						split = col.split(factor=0.25)
 						split.prop(context.window_manager.sl_mesh_export, "patchCollada")
 						split.operator("object.sl_mesh_export", icon='FILE_TICK')
+						
+						col.label(text="Levels of detail:")
+						row = col.row(align=True)
+						row.prop(context.window_manager.sl_mesh_export, "lodMedium")
+						row.prop(context.window_manager.sl_mesh_export, "lodLow")
+						row.prop(context.window_manager.sl_mesh_export, "lodLowest")
+						col.operator("object.sl_mesh_export_lods", icon='MOD_DECIM')
 
 			else:
 				col.label(text="No character selected", icon="CANCEL")
@@ -196,6 +209,27 @@ class TGOR_PT_GameAnimExport(Panel):
 					    row.prop(action.sl_animation_export, 'optimisation')
 					    if action.sl_animation_export.optimisation:   
 					        row.prop(action.sl_animation_export, 'threshold')
+
+					    row = box.row()
+					    row.prop(action.sl_animation_export, 'mirror')
+					    if action.sl_animation_export.mirror:
+					        row.prop(action.sl_animation_export, 'mirror_suffix')
+
+					    row = box.row()
+					    row.prop(action.sl_animation_export, 'adaptive')
+					    if action.sl_animation_export.adaptive:
+					        row.prop(action.sl_animation_export, 'adaptive_step')
+
+					    row = box.row()
+					    row.prop(context.window_manager.sl_animation_properties, 'useCache')
+					    if context.window_manager.sl_animation_properties.useCache:
+					        row.prop(context.window_manager.sl_animation_properties, 'diskCache')
+					        row.operator("object.sl_animation_clear_cache", icon='TRASH', text="")
+
+					    row = box.row()
+					    row.prop(context.window_manager.sl_animation_properties, 'processes')
+					    row = box.row()
+					    row.prop(context.window_manager.sl_animation_properties, 'tracePath')
 					
 					box = self.layout.box()
 					row = box.row()
@@ -209,7 +243,7 @@ class TGOR_PT_GameAnimExport(Panel):
 						if characterScene:			
 						    deformRig = characterScene.objects.get(selectedCharacter.deform)
 						    if deformRig:
-						        for bone in sl_const.validBones:
+						        for bone in sl_const.skeleton.names:
 						            if bone in deformRig.data.bones:
 						                objCache.add()
 						                collectionMember = objCache[-1]
@@ -239,6 +273,8 @@ class TGOR_PT_GameAnimExport(Panel):
 					box = col.box()
 					sub = box.column(align=True)
 					sub.operator("object.sl_animation_export", icon="EXPORT", text="Export current action")
+					sub.operator("object.tgor_export_character_animation_combined", icon="EXPORT", text="Export current action for SL and UE")
+					sub.operator("object.sl_animation_export_characters", icon="EXPORT", text="Export current action for all characters")
 					sub.prop(context.window_manager.tgor_action_settings, "exportAnimCharacterName")
 
 
@@ -7,10 +7,15 @@ from bpy.props import CollectionProperty, PointerProperty
 import re
 import os
 import math
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from mathutils import Matrix, Vector, Euler, Quaternion
 
 from . import sl_const
 from . import sl_animexport
+from . import sl_sampler
+from . import sl_shard
 from . import tgor_character
 from . import tgor_util
 
@@ -168,6 +173,31 @@ class SLAnimationExportProperties(PropertyGroup):
             min = 0.0
         )
 
+    adaptive: BoolProperty(
+            name = "Adaptive Sampling",
+            description = "Only evaluate keyframes and coarse intervals, refining where poses deviate beyond threshold",
+            default = False
+        )
+
+    adaptive_step: IntProperty(
+            name = "Step",
+            description = "Frames between coarse samples for adaptive sampling",
+            default = 8,
+            min = 2
+        )
+
+    mirror: BoolProperty(
+            name = "Mirrored",
+            description = "Also export a left/right mirrored animation from the same samples",
+            default = False
+        )
+
+    mirror_suffix: StringProperty(
+            name = "Suffix",
+            description = "Appended to the file name of the mirrored animation",
+            default = "_Mirrored"
+        )
+
     file_path: StringProperty(
             name = "Output",
             description = "Path to output file",
@@ -234,6 +264,33 @@ class SLAnimationUIProperties(PropertyGroup):
             description="Whether to display bones",
             default=False
         )
+
+    useCache: BoolProperty(
+            name="Cache Samples", 
+            description="Whether to reuse sampled poses when only export settings changed",
+            default=True
+        )
+
+    diskCache: BoolProperty(
+            name="Disk Cache", 
+            description="Whether to also store sampled poses in the animation folder",
+            default=False
+        )
+
+    processes: IntProperty(
+            name="Processes",
+            description="Background Blender processes to split sampling of long actions over, samples in this instance if 1",
+            default=1,
+            min=1,
+            max=64
+        )
+
+    tracePath: StringProperty(
+            name="Timing Trace",
+            description="File to append export phase timings to as json lines, nothing is written if empty",
+            default="",
+            subtype="FILE_PATH"
+        )
     
     boneCollection: CollectionProperty(type=SLBoneProperty)
 
@@ -241,13 +298,227 @@ class SLAnimationUIProperties(PropertyGroup):
 ############################################# OPERATORS ############################################
 ####################################################################################################
 
+# Optimise curves of several joints at once by removing linear curve elements. Each decision depends on
+# the previous ones, so frames are walked in order while every curve keeps its own anchor and last element.
+# Values are frame x curve x dimension, returns kept frames and values of each curve.
+def optimise(frames, values, force, refs, threshold):
+    count = values.shape[1]
+    curves = np.arange(count)
+    refs = np.asarray(refs, dtype=values.dtype).reshape((count, values.shape[2]))
+    frameValues = frames.astype(values.dtype)
+
+    # Negative indices are virtual elements at the reference
+    def element(indices):
+        virtual = indices < 0
+        valid = np.maximum(indices, 0)
+        return np.where(virtual, indices, frameValues[valid]), np.where(virtual[:, None], refs, values[valid, curves])
+
+    # Assume nothing changes from the start
+    anchor = np.full(count, -2)
+    last = np.full(count, -1)
+    kept = np.zeros((len(frames), count), dtype=bool)
+    for index in range(len(frames)):
+        anch_frm, anch_emt = element(anchor)
+        last_frm, last_emt = element(last)
+        emt = values[index]
+
+        # Only add new element if there is a curve, the last one then becomes the anchor
+        ratio = (frameValues[index] - last_frm) / (frameValues[index] - anch_frm)
+        curve = (emt - last_emt) - (emt - anch_emt) * ratio[:, None]
+        bent = np.linalg.norm(curve, axis=-1) >= threshold
+
+        commit = bent & (last >= 0)
+        kept[last[commit], curves[commit]] = True
+        anchor = np.where(bent, last, anchor)
+        last[:] = index
+    if len(frames):
+        kept[last, curves] = True
+
+    results = []
+    for curve in range(count):
+        keptFrames = frames[kept[:, curve]]
+        keptValues = values[kept[:, curve], curve]
+
+        # Insert copy of first element if there is none
+        if keptFrames[0] != 0:
+            keptFrames = np.concatenate(([0], keptFrames)).astype(frames.dtype)
+            keptValues = np.concatenate((keptValues[:1], keptValues))
+        # TODO: Could remove last entry if the last two are equal
+
+        # Don't export anything if there is no difference to initial pose (or if forced)
+        ssd = np.max(np.linalg.norm(keptValues - refs[curve], axis=-1))
+        results.append((keptFrames, keptValues) if ssd > threshold or force[curve] else emptyCurve(values[:, curve]))
+    return results
+
+# Curve without any keys with the same dimension as given values
+def emptyCurve(values):
+    return (np.zeros(0, dtype=np.int32), np.zeros((0,) + values.shape[1:], dtype=values.dtype))
+
+# Gather export settings of each bone
+def boneSettings(context, action, joints):
+    bones = {}
+    for joint in joints:
+        
+        bone = {}
+
+        # Settings from UI
+        settings = action.sl_animation_bones.get(joint)
+        if not settings or context.window_manager.sl_animation_properties.hasBones:
+            settings = action.sl_animation_default_bone
+
+        bone['loc_always'] = (settings.location == 'ALWAYS')
+        bone['loc_never'] = (settings.location == 'NEVER')
+        bone['rot_always'] = (settings.rotation == 'ALWAYS')
+        bone['rot_never'] = (settings.rotation == 'NEVER')
+        bone['priority'] = settings.priority if settings.override else action.sl_animation_export.priority
+            
+        # Only continue if bone has any keys
+        if not bone['loc_never'] or not bone['rot_never']:
+            bones[joint] = bone
+    return bones
+
+# Build anim from sampled curves according to the export settings of an action
+def encodeAnimation(action, bones, samples, frame_start, totalFrames, fps, timer=None):
+    timer = timer or tgor_util.PhaseTimer()
+    settings = action.sl_animation_export
+
+    with timer.phase('optimise'):
+        curves = encodeCurves(bones, samples, settings.optimisation, settings.threshold, float(totalFrames - 1) / fps, totalFrames)
+
+    with timer.phase('anim'):
+        return buildAnim(settings, bones, curves, frame_start, totalFrames, fps)
+
+# Quantize and pack the reduced curves of one joint, only touches numpy data so it can run on any thread
+def packJoint(bone, samples, joint, location, rotation, duration, totalFrames):
+    if bone['loc_never']:
+        location = emptyCurve(samples.locations[:, joint])
+    if bone['rot_never']:
+        rotation = emptyCurve(samples.rotations[:, joint])
+
+    # Key times in seconds, computed the same way as Anim.add_time_pos
+    def times(frames):
+        return duration * frames.astype(np.float64) / (totalFrames - 1)
+
+    return (sl_animexport.PackedPositionCurve(times(location[0]), duration, location[1]),
+        sl_animexport.PackedRotationCurve(times(rotation[0]), duration, rotation[1][:, 1:])) # Drop w
+
+# Reduce the curves of all joints, each kind of curve for all joints in one pass, then quantize and pack the
+# joints on a thread pool, numpy releases the GIL while doing so. Results keep the order of the bones so the
+# file is the same as when encoding one joint after another.
+def encodeCurves(bones, samples, optimisation, threshold, duration, totalFrames, workers=None):
+    names = list(bones.keys())
+    joints = [samples.joints.index(name) for name in names]
+    identity = np.tile(np.array([1.0, 0.0, 0.0, 0.0], dtype=samples.rotations.dtype), (len(joints), 1))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+
+        # Location and rotation reductions don't depend on each other either
+        if optimisation:
+            locations = executor.submit(optimise, samples.frames, samples.locations[:, joints], [bones[name]['loc_always'] for name in names], samples.offsets[joints], threshold)
+            rotations = executor.submit(optimise, samples.frames, samples.rotations[:, joints], [bones[name]['rot_always'] for name in names], identity, threshold)
+            locations, rotations = locations.result(), rotations.result()
+        else:
+            locations = [(samples.frames, samples.locations[:, joint]) for joint in joints]
+            rotations = [(samples.frames, samples.rotations[:, joint]) for joint in joints]
+
+        return list(executor.map(lambda job: packJoint(bones[job[0]], samples, *job[1:], duration, totalFrames), zip(names, joints, locations, rotations)))
+
+# Construct anim from reduced curves
+def buildAnim(settings, bones, curves, frame_start, totalFrames, fps):
+    totalDuration = float(totalFrames - 1) / fps
+
+    anim = sl_animexport.Anim(None, False)
+    anim.constraints = sl_animexport.Constraints()
+    anim.constraints.num_constraints = 0
+    anim.constraints.constraints = []
+    anim.joints = []
+
+    # Not used
+    anim.emote_name = "(None)"
+    anim.hand_pose = 0
+
+    # Versioning
+    anim.version = 1
+    anim.sub_version = 0
+
+    # Loop
+    anim.loop = settings.loop
+
+    if settings.custom_loop:
+
+        inFrame = settings.loop_in - frame_start
+        loop_in = min(max(inFrame, 0), totalFrames - 1)
+        anim.loop_in_point = float(loop_in) / fps
+
+        outFrame = settings.loop_out - frame_start
+        loop_out = min(max(outFrame, inFrame), totalFrames - 1)
+        anim.loop_out_point = float(loop_out) / fps
+
+    else:
+
+        anim.loop_in_point = 0.0
+        anim.loop_out_point = totalDuration
+
+
+    # Easing (clamp if not looping)
+    ease_in = settings.ease_in
+    anim.ease_in_duration = ease_in if anim.loop else min(max(ease_in, 0.0), totalDuration)
+    ease_out = settings.ease_out
+    anim.ease_out_duration = ease_out if anim.loop else min(max(ease_out, 0.0), totalDuration - ease_in)
+
+    # Misc
+    anim.base_priority = settings.priority
+    anim.duration = totalDuration
+
+    # Add joints and packed curves to anim in bone order
+    for (name, bone), (positions, rotations) in zip(bones.items(), curves):
+
+        # Only add joint if there are any curves
+        if len(positions.times) or len(rotations.times):
+
+            anim.add_joint(name, bone['priority'])
+            anim.add_pos_curve([name], positions)
+            anim.add_rot_curve([name], rotations)
+
+    return anim
+
+# Encode and write anim (and its log) to basePath, plus a mirrored variant if the action asks for it, returns written files
+def writeAnimations(action, bones, samples, frame_start, totalFrames, fps, basePath, timer=None):
+    timer = timer or tgor_util.PhaseTimer()
+    outputs = [(bones, samples, basePath)]
+
+    # Mirrored variant reuses the samples, bone settings move to the other side along with the curves
+    if action.sl_animation_export.mirror:
+        with timer.phase('mirror'):
+            mirrorBones = {sl_const.mirrorName(name): dict(bone) for name, bone in bones.items()}
+            outputs.append((mirrorBones, samples.mirrored(), basePath + tgor_util.makeValidFilename(action.sl_animation_export.mirror_suffix)))
+
+    files = []
+    for bones, samples, path in outputs:
+        anim = encodeAnimation(action, bones, samples, frame_start, totalFrames, fps, timer)
+        
+        # Write anim to file
+        with timer.phase('write'):
+            anim.write(path + ".anim")
+        with timer.phase('dump'):
+            anim.dump(path + ".log")
+        files.append(path + ".anim")
+    return files
+
 class SL_OT_AnimationExport(Operator):
     bl_idname = "object.sl_animation_export"
     bl_label = "SL AnimationExport"
     bl_description = ("Export animation")
     bl_options = {'REGISTER', 'UNDO'}
 
-    def execute(self, context):
+    # Seconds spent sampling per timer event when running modal
+    sliceDuration = 0.05
+
+    _timer = None
+    _session = False
+
+    # Validate selection and settings, then either reuse cached samples or set up a sampler
+    def prepare(self, context):
 
         if context.active_object.type != "ARMATURE":
             
@@ -261,240 +532,384 @@ class SL_OT_AnimationExport(Operator):
 
         ############################################################
 
-        
         selectedAction = context.scene.tgor_character_selection.action_selection
-        if selectedAction < len(bpy.data.actions):
-            action = bpy.data.actions[selectedAction]
-            if not action:
-                self.report({'INFO'}, "No action selected!")
-                return {'CANCELLED'}
-            
-            # Determine start and end frame
-            frame_start = action.tgor_action_range.startFrame
-            frame_end = action.tgor_action_range.endFrame
-
-            if action.sl_animation_export.custom_range:
-                frame_start = action.sl_animation_export.custom_start
-                frame_end = action.sl_animation_export.custom_end
-            
-            # Generate data structure for all joints involved
-            totalFrames = frame_end - frame_start + 1
-            totalDuration = float(frame_end - frame_start) / context.scene.render.fps
-            joints = [bone.name for bone in context.active_object.pose.bones if bone.name in sl_const.validBones]
-
-            # Compute relative pose transforms
-            bones = {}
-            for joint in joints:
-                
-                bone = {}
-
-                # Settings from UI
-                settings = action.sl_animation_bones.get(joint)
-                if not settings or context.window_manager.sl_animation_properties.hasBones:
-                    settings = action.sl_animation_default_bone
-
-                bone['loc_always'] = (settings.location == 'ALWAYS')
-                bone['loc_never'] = (settings.location == 'NEVER')
-                bone['rot_always'] = (settings.rotation == 'ALWAYS')
-                bone['rot_never'] = (settings.rotation == 'NEVER')
-                bone['priority'] = settings.priority if settings.override else action.sl_animation_export.priority
-                    
-                # Only continue if bone has any keys
-                if not bone['loc_never'] or not bone['rot_never']:
-
-                    bone['locations'] = []
-                    bone['rotations'] = []
-
-                    # Get initial pose local transform
-                    dataBone = context.active_object.data.bones[joint]
-                    dataChild = dataBone.matrix_local
-
-                    # Get initial pose parent transform (assume origin if root)
-                    if dataBone.parent:
-                        dataParent = dataBone.parent.matrix_local
-                        bone['offset'] = dataChild.to_translation() - dataParent.to_translation()
-                    else:
-                        dataParent = Matrix()
-                        bone['offset'] = Vector((0,0,0))
-
-                    # Transforms
-                    bone['transform'] = dataChild.inverted() @ dataParent # (PT^-1 * T)^-1 = T1^-1 * PT
-                    bone['basis'] = dataChild.to_3x3().to_4x4() # Rotation (and scale) only
-                    
-                    bones[joint] = bone
-
-            # Render all frames
-            oldFrame = context.scene.frame_current
-            for frame in range(0, totalFrames):
-                
-                context.scene.frame_set(frame_start + frame)
-                for name, bone in bones.items():
-
-                    # Get current pose and pose parent transform
-                    poseBone = context.active_object.pose.bones[name]
-                    poseChild = poseBone.matrix
-                    poseParent = poseBone.parent.matrix if poseBone.parent else Matrix()
-                    poseTransform = poseParent.inverted() @ poseChild
-
-                    # Transform in bone space
-                    B = bone['basis']
-                    T = bone['transform'] @ poseTransform
-                    matrix = B @ T @ B.transposed() # Without scaling B^-1 = B^T
-
-                    # poseTransform:        from "pose" to "pose parent" space
-                    # bone['transform']:    from "data parent" to "data" space
-                    # => T:                 from "pose" to "data" space
-
-                    # B:                    from "data" to "global" space
-                    # B':                   from "global" to "data" space
-                    # => B * T * B':        from "global" to "global" space
-
-                    # matrix: Difference between "pose" and "data" in global space
-
-                    # Compute translation
-                    loc = matrix.to_translation() + bone['offset']
-                    bone['locations'].append((frame, loc))
-                    
-                    # Compute rotation
-                    quat = (sl_const.leftRot @ matrix @ sl_const.rightRot).to_quaternion()
-                    bone['rotations'].append((frame, quat))
-
-            context.scene.frame_set(oldFrame)
-
-            # Optimise elements by removing linear curve elements
-            def optimise(elements, force, ref):
-                
-                # Assume nothing changes from the start
-                output = [(-2, ref), (-1, ref)]
-                for frm, emt in elements:
-                    anch_frm, anch_emt = output[-2]
-                    last_frm, last_emt = output[-1]
-
-                    # Only add new location if there is no curve
-                    ratio = float((frm - last_frm)) / (frm - anch_frm)
-                    curve = (emt - last_emt) - (emt - anch_emt) * ratio
-                    if curve.magnitude < action.sl_animation_export.threshold:
-                        output[-1] = (frm, emt)
-                    else:
-                        output += [(frm, emt)]
-                
-                # Filter virtual location list
-                elements = [(frm, emt) for frm, emt in output if frm >= 0]
-
-                # Insert copy of first element if there is none
-                frm, emt = elements[0]
-                if frm != 0:
-                    elements = [(0, emt)] + elements
-                # TODO: Could remove last entry if the last two are equal
-
-                # Don't export anything if there is no difference to initial pose (or if forced)
-                ssd = max([(emt-ref).magnitude for frm,emt in elements])
-                return elements if ssd > action.sl_animation_export.threshold or force else []
-
-            if action.sl_animation_export.optimisation:
-                # Optimize frames and filter according to always/never lists
-                for name, bone in bones.items():
-
-                    bone['locations'] = [] if bone['loc_never'] else optimise(bone['locations'], bone['loc_always'], bone['offset'])
-                    bone['rotations'] = [] if bone['rot_never'] else optimise(bone['rotations'], bone['rot_always'], Quaternion((1,0,0,0)))
-            else:
-                # Remove blacklisted bones
-                for name, bone in bones.items():
-
-                    bone['locations'] = [] if bone['loc_never'] else bone['locations']
-                    bone['rotations'] = [] if bone['rot_never'] else bone['rotations']
-
-            ############################################################
-
-            #filePath = action.sl_animation_export.file_path
-            selectedName = context.scene.tgor_character_selection.characters_selection
-            charRefHndlr = tgor_character.CharacterReferenceHandler(context)
-            if not charRefHndlr.animFolder:
-                self.report({'ERROR'}, "Character doesn't have animation export path defined.")
-                return {'CANCELLED'}
-            
-            # Check path as absolute path TODO: Relative paths https://docs.blender.org/api/blender_python_api_2_77_0/bpy.path.html
-            if not os.path.isdir(bpy.path.abspath(charRefHndlr.animFolder)):
-                self.report({'ERROR'}, "Path '" + charRefHndlr.animFolder + "' doesn't point to an existing directory (has to be absolute path).")
-                return {'CANCELLED'}
-            
-            # getting the full fbx export file path
-            includeCharacterName = context.window_manager.tgor_action_settings.exportAnimCharacterName
-            filename = tgor_util.makeValidFilename(selectedName+"_"+action.name if includeCharacterName else action.name)+".anim"
-            filePath = bpy.path.abspath(os.path.join( charRefHndlr.animFolder, filename))
+        if selectedAction >= len(bpy.data.actions):
+            self.report({'INFO'}, "No action selected!")
+            return {'CANCELLED'}
 
-            logname = tgor_util.makeValidFilename(selectedName+"_"+action.name if includeCharacterName else action.name)+".log"
-            logPath = bpy.path.abspath(os.path.join( charRefHndlr.animFolder, logname))
-            
+        action = bpy.data.actions[selectedAction]
+        if not action:
+            self.report({'INFO'}, "No action selected!")
+            return {'CANCELLED'}
+        
+        #filePath = action.sl_animation_export.file_path
+        selectedName = context.scene.tgor_character_selection.characters_selection
+        charRefHndlr = tgor_character.CharacterReferenceHandler(context)
+        if not charRefHndlr.animFolder:
+            self.report({'ERROR'}, "Character doesn't have animation export path defined.")
+            return {'CANCELLED'}
+        
+        # Check path as absolute path TODO: Relative paths https://docs.blender.org/api/blender_python_api_2_77_0/bpy.path.html
+        if not os.path.isdir(bpy.path.abspath(charRefHndlr.animFolder)):
+            self.report({'ERROR'}, "Path '" + charRefHndlr.animFolder + "' doesn't point to an existing directory (has to be absolute path).")
+            return {'CANCELLED'}
 
+        # getting the full anim export file path
+        includeCharacterName = context.window_manager.tgor_action_settings.exportAnimCharacterName
+        filename = tgor_util.makeValidFilename(selectedName+"_"+action.name if includeCharacterName else action.name)
+        self.basePath = bpy.path.abspath(os.path.join( charRefHndlr.animFolder, filename))
 
-            anim = sl_animexport.Anim(None, False)
-            anim.constraints = sl_animexport.Constraints()
-            anim.constraints.num_constraints = 0
-            anim.constraints.constraints = []
-            anim.joints = []
+        # Determine start and end frame
+        frame_start = action.tgor_action_range.startFrame
+        frame_end = action.tgor_action_range.endFrame
 
-            # Not used
-            anim.emote_name = "(None)"
-            anim.hand_pose = 0
+        if action.sl_animation_export.custom_range:
+            frame_start = action.sl_animation_export.custom_start
+            frame_end = action.sl_animation_export.custom_end
+        
+        # Generate data structure for all joints involved
+        self.action = action
+        self.armature = context.active_object
+        self.frame_start = frame_start
+        self.totalFrames = frame_end - frame_start + 1
+        joints = [bone.name for bone in self.armature.pose.bones if bone.name in sl_const.skeleton.bones]
+
+        self.bones = boneSettings(context, action, joints)
+
+        # Compute relative pose transforms
+        self.rest = sl_sampler.restPose(self.armature, joints)
+
+        # Sample all joints regardless of their settings so cached samples stay valid when settings change
+        self.cacheFolder = charRefHndlr.animFolder if context.window_manager.sl_animation_properties.diskCache else None
+        sharded, adaptive = self.samplingMode(context, action)
+        options = "adaptive:%d:%f" % (action.sl_animation_export.adaptive_step, action.sl_animation_export.threshold) if adaptive else "full"
+        
+        # The sampled rig may only follow the rigs of the character through constraints and drivers
+        sources = [rig for rig in (charRefHndlr.controlRig, charRefHndlr.deformRig) if rig]
+
+        self.cacheKey = None
+        self.samples = None
+        if context.window_manager.sl_animation_properties.useCache:
+            self.cacheKey = sl_sampler.sampleKey(self.armature, frame_start, frame_end, joints, options, action, sources)
+            self.samples = sl_sampler.sampleCache.get(self.cacheKey, self.cacheFolder)
+
+        # Set up sampling if nothing was cached
+        self.sampler = None
+        self.cached = self.samples is not None
+        if not self.cached:
+            self.samples = sl_sampler.allocateSamples(self.rest, self.totalFrames)
+            if sharded:
+                self.sampler = sl_shard.iterSampleShards(context, self.armature, self.rest, frame_start, self.totalFrames, 
+                    self.samples, context.window_manager.sl_animation_properties.processes, self.timer)
+            elif adaptive:
+                actions = [action] + [rig.animation_data.action for rig in [self.armature] + sources if rig.animation_data]
+                keyframes = sl_sampler.keyframeFrames(actions, frame_start, self.totalFrames)
+                self.sampler = sl_sampler.iterSampleAdaptive(context, self.armature, self.rest, frame_start, self.totalFrames, 
+                    keyframes, action.sl_animation_export.adaptive_step, action.sl_animation_export.threshold, self.samples, self.timer)
+            else:
+                self.sampler = sl_sampler.iterSampleAction(context, self.armature, self.rest, frame_start, self.totalFrames, self.samples, self.timer)
+        
+        # Frame gets restored once the session ends, which is after the last export of a batch
+        tgor_util.exportSession.begin(context.scene)
+        self._session = True
+        return None
+
+    # End the session begun by prepare, safe to call more than once
+    def restore(self, context):
+        if self._session:
+            self._session = False
+            with self.timer.phase('frame_set'):
+                tgor_util.exportSession.end()
+
+    # Whether to sample in background processes or only around keyframes, returns (sharded, adaptive)
+    def samplingMode(self, context, action):
+
+        # Long actions can be split over background processes, which always sample every frame
+        sharded = sl_shard.shardCount(self.totalFrames, context.window_manager.sl_animation_properties.processes) >= 2
+        adaptive = action.sl_animation_export.adaptive and not sharded
+        return sharded, adaptive
+
+    # Encode sampled poses and write anim to file
+    def finish(self, context):
+        self.restore(context)
+
+        if not self.cached:
+            with self.timer.phase('collect'):
+                self.samples.compress().convertToSL()
+                if self.cacheKey:
+                    sl_sampler.sampleCache.put(self.cacheKey, self.samples, self.cacheFolder)
+
+        files = writeAnimations(self.action, self.bones, self.samples, self.frame_start, self.totalFrames, context.scene.render.fps, self.basePath, self.timer)
+
+        # Report where time was spent, optionally keep a trace to compare runs
+        self.report({'INFO'}, "Timings: %s" % (self.timer.summary()))
+        tracePath = context.window_manager.sl_animation_properties.tracePath
+        if tracePath:
+            self.timer.write(bpy.path.abspath(tracePath), action=self.action.name, frames=self.totalFrames, 
+                joints=len(self.rest.joints), cached=self.cached, files=files)
+
+        self.report({'INFO'}, "Exported to @ %s" % (", ".join(files)))
+        return {'FINISHED'}
 
-            # Versioning
-            anim.version = 1
-            anim.sub_version = 0
+    def execute(self, context):
 
-            # Loop
-            anim.loop = action.sl_animation_export.loop
+        self.timer = tgor_util.PhaseTimer()
+        try:
+            with self.timer.phase('setup'):
+                result = self.prepare(context)
+            if result:
+                return result
+
+            if self.sampler:
+                try:
+                    for progress in self.sampler:
+                        pass
+                except sl_shard.ShardError as error:
+                    self.report({'ERROR'}, str(error))
+                    return {'CANCELLED'}
+            return self.finish(context)
+        finally:
+            # Whatever went wrong, frames and actions of the user are restored
+            self.restore(context)
 
-            if action.sl_animation_export.custom_loop:
+    def invoke(self, context, event):
 
-                inFrame = action.sl_animation_export.loop_in - frame_start
-                loop_in = min(max(inFrame, 0), totalFrames - 1)
-                anim.loop_in_point = float(loop_in) / context.scene.render.fps
+        self.timer = tgor_util.PhaseTimer()
+        try:
+            with self.timer.phase('setup'):
+                result = self.prepare(context)
+            if result:
+                return result
+
+            # Nothing to sample, no need to go modal
+            if not self.sampler:
+                return self.finish(context)
+        except:
+            self.restore(context)
+            raise
+
+        context.window_manager.progress_begin(0, 100)
+        self._timer = context.window_manager.event_timer_add(0.01, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+
+        if event.type in {'ESC', 'RIGHTMOUSE'}:
+            self.cancel(context)
+            self.report({'WARNING'}, "Export cancelled")
+            return {'CANCELLED'}
 
-                outFrame = action.sl_animation_export.loop_out - frame_start
-                loop_out = min(max(outFrame, inFrame), totalFrames - 1)
-                anim.loop_out_point = float(loop_out) / context.scene.render.fps
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
 
+        # Sample frames until time slice is used up
+        progress = 0.0
+        start = time.perf_counter()
+        try:
+            for progress in self.sampler:
+                if time.perf_counter() - start > self.sliceDuration:
+                    break
             else:
+                self.cleanup(context)
+                return self.finish(context)
+        except sl_shard.ShardError as error:
+            self.cancel(context)
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        except:
+            self.cancel(context)
+            raise
+
+        context.window_manager.progress_update(int(progress * 100))
+        context.workspace.status_text_set("Sampling %s: %d%% (Esc to cancel)" % (self.action.name, int(progress * 100)))
+        return {'RUNNING_MODAL'}
+
+    def cleanup(self, context):
+        if self._timer:
+            context.window_manager.event_timer_remove(self._timer)
+            self._timer = None
+        context.window_manager.progress_end()
+        context.workspace.status_text_set(None)
+
+    def cancel(self, context):
+        self.cleanup(context)
+        self.sampler = None
+        self.restore(context)
+
+
+# Sampling state of one character when exporting an action to several characters at once
+class CharacterJob(object):
+    def __init__(self, context, name, charRefHndlr, action, options, useCache, diskCache):
+        self.name = name
+        self.animationData = charRefHndlr.animationData
+        self.oldAction = charRefHndlr.animationData.action
+        self.scene = charRefHndlr.characterScene
+        self.armature = charRefHndlr.controlRig
+        self.sources = [charRefHndlr.deformRig]
+
+        # Rest pose and settings only depend on the character, so they're computed once for the whole job
+        joints = [bone.name for bone in self.armature.pose.bones if bone.name in sl_const.skeleton.bones]
+        self.bones = boneSettings(context, action, joints)
+        self.rest = sl_sampler.restPose(self.armature, joints)
+
+        # Always prefixed with the character name since characters may share an animation folder
+        filename = tgor_util.makeValidFilename(name + "_" + action.name)
+        self.basePath = bpy.path.abspath(os.path.join(charRefHndlr.animFolder, filename))
+
+        # Samples depend on the assigned action, so the key is computed once it's assigned
+        self.cacheFolder = charRefHndlr.animFolder if diskCache else None
+        self.options = options
+        self.useCache = useCache
+        self.cacheKey = None
+        self.samples = None
+        self.cached = False
+
+    # Assign action to the control rig and look up cached samples
+    def assign(self, action, frame_start, frame_end):
+        self.animationData.action = action
+        if self.useCache:
+            self.cacheKey = sl_sampler.sampleKey(self.armature, frame_start, frame_end, list(self.rest.joints), self.options, action, self.sources)
+            self.samples = sl_sampler.sampleCache.get(self.cacheKey, self.cacheFolder)
+
+        self.cached = self.samples is not None
+        if not self.cached:
+            self.samples = sl_sampler.allocateSamples(self.rest, frame_end - frame_start + 1)
+
+    def restore(self):
+        self.animationData.action = self.oldAction
+
+class SL_OT_AnimationExportCharacters(SL_OT_AnimationExport):
+    bl_idname = "object.sl_animation_export_characters"
+    bl_label = "SL AnimationExport Characters"
+    bl_description = ("Export animation for every character, evaluating the timeline once for all of them")
+    bl_options = {'REGISTER', 'UNDO'}
+
+    # Collect characters that can be exported and assign the action to their control rigs
+    def prepare(self, context):
 
-                anim.loop_in_point = 0.0
-                anim.loop_out_point = totalDuration
+        selectedAction = context.scene.tgor_character_selection.action_selection
+        if selectedAction >= len(bpy.data.actions):
+            self.report({'INFO'}, "No action selected!")
+            return {'CANCELLED'}
 
+        action = bpy.data.actions[selectedAction]
+        if not action:
+            self.report({'INFO'}, "No action selected!")
+            return {'CANCELLED'}
 
-            # Easing (clamp if not looping)
-            ease_in = action.sl_animation_export.ease_in
-            anim.ease_in_duration = ease_in if anim.loop else min(max(ease_in, 0.0), totalDuration)
-            ease_out = action.sl_animation_export.ease_out
-            anim.ease_out_duration = ease_out if anim.loop else min(max(ease_out, 0.0), totalDuration - ease_in)
+        # Determine start and end frame
+        frame_start = action.tgor_action_range.startFrame
+        frame_end = action.tgor_action_range.endFrame
+
+        if action.sl_animation_export.custom_range:
+            frame_start = action.sl_animation_export.custom_start
+            frame_end = action.sl_animation_export.custom_end
+
+        self.action = action
+        self.frame_start = frame_start
+        self.totalFrames = frame_end - frame_start + 1
+
+        # Every character evaluates every frame, so adaptive sampling wouldn't save any evaluations
+        properties = context.window_manager.sl_animation_properties
+        self.jobs = []
+        for character in context.scene.tgor_character_selection.characters:
+            charRefHndlr = tgor_character.CharacterReferenceHandler(context, character.name)
+            if charRefHndlr.error:
+                self.report({'WARNING'}, "Skipped %s: %s" % (character.name, charRefHndlr.statusMsg))
+                continue
+
+            if not charRefHndlr.animFolder or not os.path.isdir(bpy.path.abspath(charRefHndlr.animFolder)):
+                self.report({'WARNING'}, "Skipped %s: Character doesn't have a valid animation export path." % (character.name))
+                continue
+
+            job = CharacterJob(context, character.name, charRefHndlr, action, "full", properties.useCache, properties.diskCache)
+            if not job.rest.joints:
+                self.report({'WARNING'}, "Skipped %s: Control rig doesn't have any SL bones." % (character.name))
+                continue
+            self.jobs.append(job)
+
+        if not self.jobs:
+            self.report({'ERROR'}, "No character to export to!")
+            return {'CANCELLED'}
 
-            # Misc
-            anim.base_priority = action.sl_animation_export.priority
-            anim.duration = totalDuration
+        # Frames of all character scenes get restored once the session ends
+        tgor_util.exportSession.begin(context.scene)
+        self._session = True
+        for job in self.jobs:
+            tgor_util.exportSession.remember(job.scene)
+            job.assign(action, frame_start, frame_end)
+        tgor_util.exportSession.invalidate()
+
+        # Each scene only needs to be evaluated once per frame for all of its characters
+        self.sampler = self.iterSampleCharacters(context) if not all(job.cached for job in self.jobs) else None
+        return None
+
+    # Evaluate each frame once per scene and sample every character in it
+    def iterSampleCharacters(self, context):
+        jobs = [job for job in self.jobs if not job.cached]
+
+        # Poses of the original objects are only guaranteed to be up to date in the window's scene,
+        # characters of other scenes are sampled from their evaluated rigs
+        depsgraphs = {job.scene: context.evaluated_depsgraph_get() if job.scene == context.scene else job.scene.view_layers[0].depsgraph for job in jobs}
+        for frame in range(0, self.totalFrames):
+            for scene, depsgraph in depsgraphs.items():
+                with self.timer.phase('frame_set'):
+                    tgor_util.exportSession.frameSet(scene, self.frame_start + frame)
+                with self.timer.phase('matrix'):
+                    for job in jobs:
+                        if job.scene == scene:
+                            sl_sampler.samplePose(job.armature.evaluated_get(depsgraph), job.rest, job.samples.locations[frame], job.samples.rotations[frame])
+                            job.samples.sampled[frame] = True
+            yield float(frame + 1) / self.totalFrames
+
+    # Give the control rigs their actions back before the session ends
+    def restore(self, context):
+        if self._session:
+            for job in self.jobs:
+                job.restore()
+            tgor_util.exportSession.invalidate()
+        super().restore(context)
+
+    # Encode every character's samples and write them to its animation folder
+    def finish(self, context):
+        self.restore(context)
+
+        files = []
+        for job in self.jobs:
+            if not job.cached:
+                with self.timer.phase('collect'):
+                    job.samples.compress().convertToSL()
+                    if job.cacheKey:
+                        sl_sampler.sampleCache.put(job.cacheKey, job.samples, job.cacheFolder)
+
+            files += writeAnimations(self.action, job.bones, job.samples, self.frame_start, self.totalFrames, context.scene.render.fps, job.basePath, self.timer)
+
+        self.report({'INFO'}, "Timings: %s" % (self.timer.summary()))
+        tracePath = context.window_manager.sl_animation_properties.tracePath
+        if tracePath:
+            self.timer.write(bpy.path.abspath(tracePath), action=self.action.name, frames=self.totalFrames, 
+                characters=len(self.jobs), cached=len([job for job in self.jobs if job.cached]), files=files)
+
+        self.report({'INFO'}, "Exported to @ %s" % (", ".join(files)))
+        return {'FINISHED'}
 
-            # Add joints and data to anim
-            for name, bone in bones.items():
-                bone = bones[name]
-                locs = bone['locations']
-                rots = bone['rotations']
 
-                # Only add joint if there are any curves
-                if locs or rots:
 
-                    anim.add_joint(name, bone['priority'])
+class SL_OT_AnimationClearCache(Operator):
+    bl_idname = "object.sl_animation_clear_cache"
+    bl_label = "SL Clear Cache"
+    bl_description = ("Forget all sampled poses")
+    bl_options = {'REGISTER'}
 
-                    locs = [(frm, sl_const.leftRot @ loc) for frm,loc in locs] # Rotate for SL
-                    locs = [(frm, (loc.x, loc.y, loc.z)) for frm,loc in locs]
-                    anim.add_time_pos([name], locs, totalFrames)
+    def execute(self, context):
 
-                    rots = [(frm, rot.normalized()) for frm,rot in rots] # Normalise rotation
-                    rots = [(frm, (rot.x, rot.y, rot.z)) for frm,rot in rots]
-                    anim.add_time_rot([name], rots, totalFrames)
-            
-            # Write anim to file
-            anim.write(filePath)
-            anim.dump(logPath)
+        # Also remove cache files of the selected character if there are any
+        charRefHndlr = tgor_character.CharacterReferenceHandler(context)
+        sl_sampler.sampleCache.clear(charRefHndlr.animFolder if charRefHndlr.animFolder else None)
+        sl_sampler.restPoseCache.clear()
 
-        self.report({'INFO'}, "Exported to @ %s" % (filePath))
+        self.report({'INFO'}, "Cleared sample cache")
         return {'FINISHED'}
 
 
@@ -558,7 +973,7 @@ class SL_OT_AnimationAddSelectedBones(Operator):
                 return {'CANCELLED'}
         
             for bone in (context.selected_pose_bones if context.selected_pose_bones else []) + (context.selected_bones if context.selected_bones else []):
-                if action.sl_animation_bones.bones.find(bone.name) == -1 and bone.name in sl_const.validBones:
+                if action.sl_animation_bones.bones.find(bone.name) == -1 and bone.name in sl_const.skeleton.bones:
 
                     action.sl_animation_bones.bones.add()
                     action.sl_animation_bones.bones[-1].name = bone.name
@@ -600,6 +1015,8 @@ classes = (
     SL_UL_BonesList,
 
     SL_OT_AnimationExport,
+    SL_OT_AnimationExportCharacters,
+    SL_OT_AnimationClearCache,
     SL_OT_AnimationImport,
     SL_OT_AnimationAddBone,
     SL_OT_AnimationAddSelectedBones,
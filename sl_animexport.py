@@ -44,6 +44,7 @@ from io import BytesIO
 import struct
 import sys
 from xml.etree import ElementTree
+import numpy as np
 
 from . import sl_const
 
@@ -139,6 +140,19 @@ def F32_to_U16(val, lower, upper):
     # return the U16
     return int(math.floor(val*U16MAX))
 
+# F32_to_U16 for a whole array at once, gives the same values as the scalar version
+def F32_to_U16_array(vals, lower, upper):
+    vals = np.clip(np.asarray(vals, dtype=np.float64), lower, upper)
+    vals = (vals - lower) / (upper - lower)
+    return np.floor(vals*U16MAX).astype(np.uint16)
+
+# Quantize keys and pack them the way PosKey.pack and RotKey.pack do, one key per row
+def pack_keys(times, duration, vals, lower, upper):
+    data = np.empty((len(times), 4), dtype="<u2")
+    data[:,0] = F32_to_U16_array(times, 0.0, duration)
+    data[:,1:] = F32_to_U16_array(vals, lower, upper)
+    return data.tobytes()
+
 # translated from the C++ version in llquantize.h
 def U16_to_F32(ival, lower, upper):
     if ival < 0 or ival > U16MAX:
@@ -345,6 +359,46 @@ class RotationCurve(object):
         for k in self.keys:
             k.dump(f)
             
+class PackedPositionCurve(PositionCurve):
+    """
+    PositionCurve whose keys are quantized and packed all at once on construction,
+    which only uses numpy and may therefore run on another thread.
+    """
+    def __init__(self, times, duration, positions):
+        self.times = times
+        self.duration = duration
+        self.positions = positions
+        self.packed = pack_keys(times, duration, positions, -LL_MAX_PELVIS_OFFSET, LL_MAX_PELVIS_OFFSET)
+
+    # Only built when needed, e.g. for dump()
+    @property
+    def keys(self):
+        return [PosKey(time, self.duration, pos) for time, pos in zip(self.times.tolist(), self.positions.tolist())]
+
+    def pack(self, fp):
+        fp.pack("<i",len(self.times))
+        fp.buffer.write(self.packed)
+
+class PackedRotationCurve(RotationCurve):
+    """
+    RotationCurve whose keys are quantized and packed all at once on construction,
+    which only uses numpy and may therefore run on another thread.
+    """
+    def __init__(self, times, duration, rotations):
+        self.times = times
+        self.duration = duration
+        self.rotations = rotations
+        self.packed = pack_keys(times, duration, rotations, -1.0, 1.0)
+
+    # Only built when needed, e.g. for dump()
+    @property
+    def keys(self):
+        return [RotKey(time, self.duration, rot) for time, rot in zip(self.times.tolist(), self.rotations.tolist())]
+
+    def pack(self, fp):
+        fp.pack("<i",len(self.times))
+        fp.buffer.write(self.packed)
+
 class JointInfo(object):
     def __init__(self, name, priority):
         self.joint_name = name
@@ -575,6 +629,20 @@ class Anim(object):
                                             rot)
                                      for frame,rot in frame_rotations]
 
+    # Add already packed position curve
+    def add_pos_curve(self, joint_names, curve):
+        js = [joint for joint in self.joints if joint.joint_name in joint_names]
+        for j in js:
+            j.joint_priority = 4
+            j.position_curve = curve
+
+    # Add already packed rotation curve
+    def add_rot_curve(self, joint_names, curve):
+        js = [joint for joint in self.joints if joint.joint_name in joint_names]
+        for j in js:
+            j.joint_priority = 4
+            j.rotation_curve = curve
+
 def twistify(anim, joint_names, rot1, rot2):
     js = [joint for joint in anim.joints if joint.joint_name in joint_names]
     for j in js:
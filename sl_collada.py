@@ -0,0 +1,515 @@
+
+'''
+Collada files for SL: a writer that streams skinned meshes straight from arrays, and a patcher that
+fixes collision volume bind poses of files written by Blender's exporter in a single streaming pass.
+Neither ever holds the document in memory as a whole.
+'''
+
+import os
+import re
+import time
+import tempfile
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, quoteattr
+import numpy as np
+
+from . import sl_const
+
+####################################################################################################
+############################################# PATCHER ##############################################
+####################################################################################################
+
+# Start, end or empty tag (attribute values may contain '>')
+tagPattern = re.compile(r'<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+namePattern = re.compile(r'</?\s*(?:[\w.-]+:)?([\w.-]+)')
+paramPattern = re.compile(r'\sname\s*=\s*["\']([^"\']*)["\']')
+
+controllersStart = "<library_controllers"
+
+# Local name of a tag without namespace prefix, None for text, comments and declarations
+def tagName(token):
+    if not token.startswith('<') or token.startswith('<!') or token.startswith('<?'):
+        return None
+    return namePattern.match(token).group(1)
+
+# Scale inverse bind matrices (n x 4 x 4) of joints in the lookup in place, same as multiplying with
+# a scale matrix from the left. Returns whether anything was scaled.
+def scaleTransforms(joints, transforms, lookup):
+    scaled = False
+    for index, joint in enumerate(joints):
+        if joint in lookup:
+            inv = np.array([1.0 / s for s in lookup[joint]])
+            transforms[index, :3, :] *= inv[:, None]
+            scaled = True
+    return scaled
+
+# Scale the bind poses in the text of a TRANSFORM float_array (n x 16 floats), returns the text
+# unchanged if there is nothing to scale
+def scaleBindPoses(joints, text, lookup):
+    if not any(joint in lookup for joint in joints):
+        return text
+
+    transforms = np.array(text.split(), dtype=float).reshape((len(joints), 4, 4))
+    scaleTransforms(joints, transforms, lookup)
+
+    # Keep surrounding whitespace so the rest of the document is byte identical
+    stripped = text.strip()
+    start = text.find(stripped)
+    return text[:start] + ' '.join(map(str, transforms.reshape(-1).tolist())) + text[start + len(stripped):]
+
+# Write a text file to a temporary file next to it that replaces the file once complete
+@contextmanager
+def replaceFile(filePath):
+    handle, tempPath = tempfile.mkstemp(prefix=".tmp", suffix=os.path.splitext(filePath)[1], dir=os.path.dirname(os.path.abspath(filePath)))
+    try:
+        with os.fdopen(handle, "w", encoding='utf-8', newline='') as target:
+            yield target
+        os.replace(tempPath, filePath)
+    except:
+        os.remove(tempPath)
+        raise
+
+#-----------------------------------
+# Copies tokens to a target file, patching the TRANSFORM sources of skins on the way. Sources of a skin
+# are buffered until they end because the accessor saying what a source contains comes after its array.
+class BindPosePatcher():
+
+    def __init__(self, target, lookup):
+        self.target = target
+        self.lookup = lookup
+        self.inSkin = False
+        self.joints = None
+        self.source = None
+
+        # Output after a TRANSFORM source that came before its skin's joints is held back
+        self.held = None
+        self.pending = []
+        self.patched = 0
+
+    def write(self, text):
+        if self.held is None:
+            self.target.write(text)
+        else:
+            self.held.append(text)
+
+    # Handle one tag or text inside of library_controllers
+    def token(self, token):
+        name = tagName(token)
+        if self.source is not None:
+            self.source.append(token)
+            if name == 'source' and token.startswith('</'):
+                self.endSource()
+            return
+
+        if name == 'skin':
+            if token.startswith('</'):
+                self.release()
+                self.inSkin = False
+            elif not token.endswith('/>'):
+                self.inSkin = True
+                self.joints = None
+        elif name == 'source' and self.inSkin and not token.startswith('</') and not token.endswith('/>'):
+            self.source = [token]
+            return
+        self.write(token)
+
+    # Index of the text token of the first element with a name in a buffered source
+    def textIndex(self, tokens, name):
+        for index, token in enumerate(tokens[:-1]):
+            if tagName(token) == name and not token.startswith('</') and tagName(tokens[index + 1]) is None:
+                return index + 1
+        return None
+
+    def endSource(self):
+        tokens = self.source
+        self.source = None
+
+        params = [paramPattern.search(token) for token in tokens if tagName(token) == 'param']
+        param = params[0].group(1) if params and params[0] else None
+
+        if param == 'JOINT':
+            index = self.textIndex(tokens, 'Name_array')
+            self.joints = tokens[index].split() if index is not None else []
+            self.write(''.join(tokens))
+            self.release()
+
+        elif param == 'TRANSFORM' and self.textIndex(tokens, 'float_array') is not None:
+            if self.joints is None:
+                if self.held is None:
+                    self.held = []
+                self.pending.append(tokens)
+                self.held.append(tokens)
+            else:
+                self.patch(tokens)
+                self.write(''.join(tokens))
+
+        else:
+            self.write(''.join(tokens))
+
+    def patch(self, tokens):
+        index = self.textIndex(tokens, 'float_array')
+        patched = scaleBindPoses(self.joints, tokens[index], self.lookup)
+        if patched is not tokens[index]:
+            tokens[index] = patched
+            self.patched += 1
+
+    # Write held back output, patched if the joints are known by now
+    def release(self):
+        held, self.held = self.held, None
+        if held is None:
+            return
+
+        for tokens in self.pending:
+            if self.joints is not None:
+                self.patch(tokens)
+        self.pending = []
+        for item in held:
+            self.write(item if isinstance(item, str) else ''.join(item))
+
+    # Copy source to target, only library_controllers is split into tokens
+    def stream(self, source, chunkSize):
+        buffer = ""
+        inside = False
+        done = False
+        while not done:
+            chunk = source.read(chunkSize)
+            done = not chunk
+            buffer += chunk
+
+            while buffer:
+                if not inside:
+                    start = buffer.find(controllersStart)
+                    if start < 0:
+
+                        # The start of the next section could be cut off at the end of the chunk
+                        cut = len(buffer) if done else max(len(buffer) - len(controllersStart) + 1, 0)
+                        self.target.write(buffer[:cut])
+                        buffer = buffer[cut:]
+                        break
+                    self.target.write(buffer[:start])
+                    buffer = buffer[start:]
+                    inside = True
+
+                # Tags and text in between, text is only complete once the next tag has been read
+                position = 0
+                for match in tagPattern.finditer(buffer):
+                    if match.start() > position:
+                        self.token(buffer[position:match.start()])
+                    self.token(match.group(0))
+                    position = match.end()
+                    if tagName(match.group(0)) == 'library_controllers' and match.group(0).startswith('</'):
+                        inside = False
+                        break
+                buffer = buffer[position:]
+
+                if inside:
+                    if done:
+                        self.token(buffer)
+                        buffer = ""
+                    break
+
+        # Document ended within a skin
+        if self.source is not None:
+            self.write(''.join(self.source))
+            self.source = None
+        self.release()
+
+# Scale bind poses of joints in the lookup (SL collision volumes by default) so meshes don't appear
+# anorexic in SL. The patched document is streamed to a temporary file next to the original that
+# replaces it once complete. Returns the number of patched skins.
+def patchCollada(filePath, lookup=None, chunkSize=1 << 20):
+    lookup = sl_const.colladaLookup if lookup is None else lookup
+    with replaceFile(filePath) as target, open(filePath, "r", encoding='utf-8', newline='') as source:
+        patcher = BindPosePatcher(target, lookup)
+        patcher.stream(source, chunkSize)
+    return patcher.patched
+
+####################################################################################################
+############################################# WRITER ###############################################
+####################################################################################################
+
+colladaNamespace = "http://www.collada.org/2005/11/COLLADASchema"
+
+# Blender's -Y forward becomes +X forward in SL, same as exporting with forward -X and up Z
+colladaOrientation = np.array(sl_const.leftRot, dtype=float)
+
+# Characters that are valid in ids, everything else is replaced
+def colladaId(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+# Adding 0 turns -0 into 0
+def formatFloats(values):
+    return ' '.join(map('{:.7g}'.format, (np.asarray(values, dtype=float).reshape(-1) + 0.0).tolist()))
+
+def formatInts(values):
+    return ' '.join(map(str, np.asarray(values).reshape(-1).tolist()))
+
+def translation(offset):
+    matrix = np.eye(4)
+    matrix[:3, 3] = offset
+    return matrix
+
+#-----------------------------------
+# Geometry and skin weights of a mesh object pulled with foreach_get, weights are flat
+# (vertex, group, weight) arrays
+class SkinnedMesh():
+
+    defaultMaterial = ("default", (0.8, 0.8, 0.8, 1.0))
+
+    def __init__(self, obj, weights):
+        mesh = obj.data
+        self.name = obj.name
+        self.id = colladaId(obj.name)
+        self.matrix = np.array(obj.matrix_world, dtype=float)
+        self.groups = [group.name for group in obj.vertex_groups]
+        self.weights = weights
+
+        self.positions = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', self.positions)
+        self.positions = self.positions.reshape((-1, 3))
+
+        # Triangles as loop indices
+        mesh.calc_loop_triangles()
+        loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get('loops', loops)
+        materials = np.empty(len(mesh.loop_triangles), dtype=np.int32)
+        mesh.loop_triangles.foreach_get('material_index', materials)
+        loopVertices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', loopVertices)
+
+        # Split normals are stored on the mesh since Blender 4.1
+        normals = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+        if hasattr(mesh, 'corner_normals'):
+            mesh.corner_normals.foreach_get('vector', normals)
+        else:
+            mesh.calc_normals_split()
+            mesh.loops.foreach_get('normal', normals)
+
+        # Shared normals and uvs are only written once
+        self.normals, normalIndices = np.unique(normals.reshape((-1, 3)), axis=0, return_inverse=True)
+        columns = [loopVertices[loops], normalIndices.reshape(-1)[loops]]
+
+        # Active uv map only
+        self.uvs = None
+        if mesh.uv_layers.active:
+            uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+            mesh.uv_layers.active.data.foreach_get('uv', uvs)
+            self.uvs, uvIndices = np.unique(uvs.reshape((-1, 2)), axis=0, return_inverse=True)
+            columns.append(uvIndices.reshape(-1)[loops])
+
+        # Material slots as (name, diffuse color)
+        self.materials = [(slot.material.name, tuple(slot.material.diffuse_color)) if slot.material else self.defaultMaterial for slot in obj.material_slots]
+        self.materials = self.materials or [self.defaultMaterial]
+        materials = np.clip(materials, 0, len(self.materials) - 1)
+
+        # Corners of each triangle (vertex, normal[, uv] per corner) grouped by material slot
+        corners = np.stack(columns, axis=1).reshape((-1, 3 * len(columns)))
+        order = np.argsort(materials, kind='stable')
+        self.triangles = []
+        for chunk in np.split(order, np.flatnonzero(np.diff(materials[order])) + 1):
+            if chunk.size:
+                self.triangles.append((self.materials[materials[chunk[0]]][0], corners[chunk]))
+
+#-----------------------------------
+# Streams a Collada document of skinned meshes and their armature tailored to SL. Joints only have
+# translations (like Blender's exporter in OpenSim compatibility mode), bind poses of joints in the
+# lookup are scaled right away so the file doesn't need patching.
+class ColladaWriter():
+
+    def __init__(self, target, armature, lookup):
+        self.target = target
+        self.armature = armature
+        self.armatureId = colladaId(armature.name)
+        self.armatureMatrix = colladaOrientation @ np.array(armature.matrix_world, dtype=float)
+        self.lookup = lookup
+        self.bones = {bone.name: bone for bone in armature.data.bones}
+
+    def write(self, *lines):
+        self.target.write('\n'.join(lines) + '\n')
+
+    def source(self, id, arrayType, count, text, stride, params):
+        self.write(
+            '        <source id="%s">' % (id),
+            '          <%s id="%s-array" count="%d">%s</%s>' % (arrayType, id, count * stride, text, arrayType),
+            '          <technique_common>',
+            '            <accessor source="#%s-array" count="%d" stride="%d">' % (id, count, stride))
+        for name, paramType in params:
+            self.write('              <param name="%s" type="%s"/>' % (name, paramType))
+        self.write(
+            '            </accessor>',
+            '          </technique_common>',
+            '        </source>')
+
+    # Source of an (n, stride) float array with one param per column
+    def floatSource(self, id, values, names):
+        self.source(id, 'float_array', len(values), formatFloats(values), len(names), [(name, 'float') for name in names])
+
+    def materials(self, meshes):
+        materials = {}
+        for mesh in meshes:
+            for name, color in mesh.materials:
+                materials.setdefault(name, color)
+
+        self.write('  <library_effects>')
+        for name, color in materials.items():
+            self.write(
+                '    <effect id="%s-effect">' % (colladaId(name)),
+                '      <profile_COMMON>',
+                '        <technique sid="common">',
+                '          <lambert>',
+                '            <diffuse><color sid="diffuse">%s</color></diffuse>' % (formatFloats(color)),
+                '          </lambert>',
+                '        </technique>',
+                '      </profile_COMMON>',
+                '    </effect>')
+        self.write('  </library_effects>', '  <library_materials>')
+        for name in materials:
+            self.write(
+                '    <material id="%s-material" name=%s>' % (colladaId(name), quoteattr(name)),
+                '      <instance_effect url="#%s-effect"/>' % (colladaId(name)),
+                '    </material>')
+        self.write('  </library_materials>')
+
+    def geometry(self, mesh):
+        self.write('    <geometry id="%s-mesh" name=%s>' % (mesh.id, quoteattr(mesh.name)), '      <mesh>')
+        self.floatSource(mesh.id + "-positions", mesh.positions, ('X', 'Y', 'Z'))
+        self.floatSource(mesh.id + "-normals", mesh.normals, ('X', 'Y', 'Z'))
+        if mesh.uvs is not None:
+            self.floatSource(mesh.id + "-map-0", mesh.uvs, ('S', 'T'))
+        self.write(
+            '        <vertices id="%s-vertices">' % (mesh.id),
+            '          <input semantic="POSITION" source="#%s-positions"/>' % (mesh.id),
+            '        </vertices>')
+
+        for material, corners in mesh.triangles:
+            self.write(
+                '        <triangles material="%s-material" count="%d">' % (colladaId(material), len(corners)),
+                '          <input semantic="VERTEX" source="#%s-vertices" offset="0"/>' % (mesh.id),
+                '          <input semantic="NORMAL" source="#%s-normals" offset="1"/>' % (mesh.id))
+            if mesh.uvs is not None:
+                self.write('          <input semantic="TEXCOORD" source="#%s-map-0" offset="2" set="0"/>' % (mesh.id))
+            self.write('          <p>%s</p>' % (formatInts(corners)), '        </triangles>')
+        self.write('      </mesh>', '    </geometry>')
+
+    def controller(self, mesh):
+
+        # Joints are the mesh's vertex groups that belong to a deform bone, only those get a node
+        joints = [name for name in mesh.groups if name in self.bones and self.bones[name].use_deform]
+        jointIndex = np.array([joints.index(name) if name in joints else -1 for name in mesh.groups], dtype=np.int32)
+
+        vertices, groups, weights = mesh.weights
+        joint = jointIndex[groups]
+        valid = joint >= 0
+        order = np.argsort(vertices[valid], kind='stable')
+        vertices, joint, weights = vertices[valid][order], joint[valid][order], weights[valid][order]
+
+        # Inverse bind matrices of translation only joints
+        inverseBinds = np.zeros((len(joints), 4, 4))
+        for index, name in enumerate(joints):
+            inverseBinds[index] = np.linalg.inv(self.armatureMatrix @ translation(self.bones[name].head_local))
+        scaleTransforms(joints, inverseBinds, self.lookup)
+
+        self.write(
+            '    <controller id="%s-skin" name=%s>' % (mesh.id, quoteattr(self.armature.name)),
+            '      <skin source="#%s-mesh">' % (mesh.id),
+            '        <bind_shape_matrix>%s</bind_shape_matrix>' % (formatFloats(colladaOrientation @ mesh.matrix)))
+        self.source(mesh.id + "-skin-joints", 'Name_array', len(joints), ' '.join(escape(name) for name in joints), 1, [('JOINT', 'name')])
+        self.source(mesh.id + "-skin-bind_poses", 'float_array', len(joints), formatFloats(inverseBinds), 16, [('TRANSFORM', 'float4x4')])
+        self.floatSource(mesh.id + "-skin-weights", weights.reshape((-1, 1)), ('WEIGHT',))
+        self.write(
+            '        <joints>',
+            '          <input semantic="JOINT" source="#%s-skin-joints"/>' % (mesh.id),
+            '          <input semantic="INV_BIND_MATRIX" source="#%s-skin-bind_poses"/>' % (mesh.id),
+            '        </joints>',
+            '        <vertex_weights count="%d">' % (len(mesh.positions)),
+            '          <input semantic="JOINT" source="#%s-skin-joints" offset="0"/>' % (mesh.id),
+            '          <input semantic="WEIGHT" source="#%s-skin-weights" offset="1"/>' % (mesh.id),
+            '          <vcount>%s</vcount>' % (formatInts(np.bincount(vertices, minlength=len(mesh.positions)))),
+            '          <v>%s</v>' % (formatInts(np.stack([joint, np.arange(len(joint))], axis=1))),
+            '        </vertex_weights>',
+            '      </skin>',
+            '    </controller>')
+
+    # Node of a deform bone with the offset to its parent joint, other bones are skipped
+    def jointNode(self, bone, parentHead, indent, roots):
+        if not bone.use_deform:
+            for child in bone.children:
+                self.jointNode(child, parentHead, indent, roots)
+            return
+
+        id = colladaId(bone.name)
+        head = np.array(bone.head_local, dtype=float)
+        if parentHead is None:
+            roots.append(id)
+        offset = head - parentHead if parentHead is not None else head
+
+        self.write(
+            '%s<node id="%s_%s" name=%s sid=%s type="JOINT">' % (indent, self.armatureId, id, quoteattr(bone.name), quoteattr(bone.name)),
+            '%s  <matrix sid="transform">%s</matrix>' % (indent, formatFloats(translation(offset))))
+        for child in bone.children:
+            self.jointNode(child, head, indent + '  ', roots)
+        self.write('%s</node>' % (indent))
+
+    def visualScene(self, meshes):
+        self.write(
+            '  <library_visual_scenes>',
+            '    <visual_scene id="Scene" name="Scene">',
+            '      <node id="%s" name=%s type="NODE">' % (self.armatureId, quoteattr(self.armature.name)),
+            '        <matrix sid="transform">%s</matrix>' % (formatFloats(self.armatureMatrix)))
+        roots = []
+        for bone in self.armature.data.bones:
+            if bone.parent is None:
+                self.jointNode(bone, None, '        ', roots)
+        self.write('      </node>')
+
+        for mesh in meshes:
+            self.write(
+                '      <node id="%s" name=%s type="NODE">' % (mesh.id, quoteattr(mesh.name)),
+                '        <matrix sid="transform">%s</matrix>' % (formatFloats(np.eye(4))),
+                '        <instance_controller url="#%s-skin">' % (mesh.id))
+            for root in roots:
+                self.write('          <skeleton>#%s_%s</skeleton>' % (self.armatureId, root))
+            self.write('          <bind_material>', '            <technique_common>')
+            for material in dict.fromkeys(material for material, _ in mesh.triangles):
+                self.write('              <instance_material symbol="%s-material" target="#%s-material"/>' % (colladaId(material), colladaId(material)))
+            self.write(
+                '            </technique_common>',
+                '          </bind_material>',
+                '        </instance_controller>',
+                '      </node>')
+        self.write('    </visual_scene>', '  </library_visual_scenes>')
+
+    def document(self, meshes):
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.write(
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<COLLADA xmlns="%s" version="1.4.1">' % (colladaNamespace),
+            '  <asset>',
+            '    <contributor><authoring_tool>TGOR Animation and Export Toolset</authoring_tool></contributor>',
+            '    <created>%s</created>' % (now),
+            '    <modified>%s</modified>' % (now),
+            '    <unit name="meter" meter="1"/>',
+            '    <up_axis>Z_UP</up_axis>',
+            '  </asset>')
+        self.materials(meshes)
+
+        self.write('  <library_geometries>')
+        for mesh in meshes:
+            self.geometry(mesh)
+        self.write('  </library_geometries>', '  <library_controllers>')
+        for mesh in meshes:
+            self.controller(mesh)
+        self.write('  </library_controllers>')
+
+        self.visualScene(meshes)
+        self.write(
+            '  <scene>',
+            '    <instance_visual_scene url="#Scene"/>',
+            '  </scene>',
+            '</COLLADA>')
+
+# Write skinned meshes deformed by an armature as Collada for SL, meshes are sorted by name
+def writeCollada(filePath, armature, meshes, lookup=None):
+    lookup = sl_const.colladaLookup if lookup is None else lookup
+    with replaceFile(filePath) as target:
+        ColladaWriter(target, armature, lookup).document(sorted(meshes, key=lambda mesh: mesh.name))
@@ -1,5 +1,7 @@
 
 from mathutils import Matrix, Vector, Euler
+from collections import namedtuple
+from types import MappingProxyType
 import numpy as np
 
 validBones = [
@@ -23,6 +25,52 @@ validBones = [
     'mHindLimb4Left', 'mHindLimb3Left', 'mHindLimb2Left', 'mHindLimb1Left', 'mHindLimb4Right', 'mHindLimb3Right', 'mHindLimb2Right', 'mHindLimb1Right', 
     'mHindLimbsRoot', 'mPelvis', 'PELVIS', 'BUTT']
 
+# Parent of each bone and collision volume in the SL skeleton (None for the root)
+boneParents = {
+    'mPelvis': None, 'PELVIS': 'mPelvis', 'BUTT': 'mPelvis',
+    'mSpine1': 'mPelvis', 'mSpine2': 'mSpine1', 'mTorso': 'mSpine2', 'mSpine3': 'mTorso', 'mSpine4': 'mSpine3', 'mChest': 'mSpine4',
+    'BELLY': 'mTorso', 'LEFT_HANDLE': 'mTorso', 'RIGHT_HANDLE': 'mTorso', 'LOWER_BACK': 'mTorso',
+    'CHEST': 'mChest', 'LEFT_PEC': 'mChest', 'RIGHT_PEC': 'mChest', 'UPPER_BACK': 'mChest',
+    'mNeck': 'mChest', 'NECK': 'mNeck', 'mHead': 'mNeck', 'HEAD': 'mHead', 'mSkull': 'mHead', 'mEyeRight': 'mHead', 'mEyeLeft': 'mHead',
+    'mFaceRoot': 'mHead', 'mFaceEyeAltRight': 'mFaceRoot', 'mFaceEyeAltLeft': 'mFaceRoot', 'mFaceForeheadLeft': 'mFaceRoot', 
+    'mFaceForeheadRight': 'mFaceRoot', 'mFaceEyebrowOuterLeft': 'mFaceRoot', 'mFaceEyebrowCenterLeft': 'mFaceRoot', 
+    'mFaceEyebrowInnerLeft': 'mFaceRoot', 'mFaceEyebrowOuterRight': 'mFaceRoot', 'mFaceEyebrowCenterRight': 'mFaceRoot', 
+    'mFaceEyebrowInnerRight': 'mFaceRoot', 'mFaceEyeLidUpperLeft': 'mFaceRoot', 'mFaceEyeLidLowerLeft': 'mFaceRoot', 
+    'mFaceEyeLidUpperRight': 'mFaceRoot', 'mFaceEyeLidLowerRight': 'mFaceRoot', 'mFaceEar1Left': 'mFaceRoot', 'mFaceEar2Left': 'mFaceEar1Left', 
+    'mFaceEar1Right': 'mFaceRoot', 'mFaceEar2Right': 'mFaceEar1Right', 'mFaceNoseLeft': 'mFaceRoot', 'mFaceNoseCenter': 'mFaceRoot', 
+    'mFaceNoseRight': 'mFaceRoot', 'mFaceCheekLowerLeft': 'mFaceRoot', 'mFaceCheekUpperLeft': 'mFaceRoot', 'mFaceCheekLowerRight': 'mFaceRoot', 
+    'mFaceCheekUpperRight': 'mFaceRoot', 'mFaceJaw': 'mFaceRoot', 'mFaceChin': 'mFaceJaw', 'mFaceTeethLower': 'mFaceJaw', 
+    'mFaceLipLowerLeft': 'mFaceTeethLower', 'mFaceLipLowerRight': 'mFaceTeethLower', 'mFaceLipLowerCenter': 'mFaceTeethLower', 
+    'mFaceTongueBase': 'mFaceTeethLower', 'mFaceTongueTip': 'mFaceTongueBase', 'mFaceJawShaper': 'mFaceRoot', 'mFaceForeheadCenter': 'mFaceRoot', 
+    'mFaceNoseBase': 'mFaceRoot', 'mFaceTeethUpper': 'mFaceRoot', 'mFaceLipUpperLeft': 'mFaceTeethUpper', 'mFaceLipUpperRight': 'mFaceTeethUpper', 
+    'mFaceLipCornerLeft': 'mFaceTeethUpper', 'mFaceLipCornerRight': 'mFaceTeethUpper', 'mFaceLipUpperCenter': 'mFaceTeethUpper', 
+    'mFaceEyecornerInnerLeft': 'mFaceRoot', 'mFaceEyecornerInnerRight': 'mFaceRoot', 'mFaceNoseBridge': 'mFaceRoot',
+    'mCollarLeft': 'mChest', 'L_CLAVICLE': 'mCollarLeft', 'mShoulderLeft': 'mCollarLeft', 'L_UPPER_ARM': 'mShoulderLeft', 
+    'mElbowLeft': 'mShoulderLeft', 'L_LOWER_ARM': 'mElbowLeft', 'mWristLeft': 'mElbowLeft', 'L_HAND': 'mWristLeft', 
+    'mHandMiddle1Left': 'mWristLeft', 'mHandMiddle2Left': 'mHandMiddle1Left', 'mHandMiddle3Left': 'mHandMiddle2Left', 
+    'mHandIndex1Left': 'mWristLeft', 'mHandIndex2Left': 'mHandIndex1Left', 'mHandIndex3Left': 'mHandIndex2Left', 
+    'mHandRing1Left': 'mWristLeft', 'mHandRing2Left': 'mHandRing1Left', 'mHandRing3Left': 'mHandRing2Left', 
+    'mHandPinky1Left': 'mWristLeft', 'mHandPinky2Left': 'mHandPinky1Left', 'mHandPinky3Left': 'mHandPinky2Left', 
+    'mHandThumb1Left': 'mWristLeft', 'mHandThumb2Left': 'mHandThumb1Left', 'mHandThumb3Left': 'mHandThumb2Left',
+    'mCollarRight': 'mChest', 'R_CLAVICLE': 'mCollarRight', 'mShoulderRight': 'mCollarRight', 'R_UPPER_ARM': 'mShoulderRight', 
+    'mElbowRight': 'mShoulderRight', 'R_LOWER_ARM': 'mElbowRight', 'mWristRight': 'mElbowRight', 'R_HAND': 'mWristRight', 
+    'mHandMiddle1Right': 'mWristRight', 'mHandMiddle2Right': 'mHandMiddle1Right', 'mHandMiddle3Right': 'mHandMiddle2Right', 
+    'mHandIndex1Right': 'mWristRight', 'mHandIndex2Right': 'mHandIndex1Right', 'mHandIndex3Right': 'mHandIndex2Right', 
+    'mHandRing1Right': 'mWristRight', 'mHandRing2Right': 'mHandRing1Right', 'mHandRing3Right': 'mHandRing2Right', 
+    'mHandPinky1Right': 'mWristRight', 'mHandPinky2Right': 'mHandPinky1Right', 'mHandPinky3Right': 'mHandPinky2Right', 
+    'mHandThumb1Right': 'mWristRight', 'mHandThumb2Right': 'mHandThumb1Right', 'mHandThumb3Right': 'mHandThumb2Right',
+    'mWingsRoot': 'mChest', 'mWing1Left': 'mWingsRoot', 'mWing2Left': 'mWing1Left', 'mWing3Left': 'mWing2Left', 'mWing4Left': 'mWing3Left', 
+    'mWing4FanLeft': 'mWing3Left', 'mWing1Right': 'mWingsRoot', 'mWing2Right': 'mWing1Right', 'mWing3Right': 'mWing2Right', 
+    'mWing4Right': 'mWing3Right', 'mWing4FanRight': 'mWing3Right',
+    'mHipRight': 'mPelvis', 'R_UPPER_LEG': 'mHipRight', 'mKneeRight': 'mHipRight', 'R_LOWER_LEG': 'mKneeRight', 'mAnkleRight': 'mKneeRight', 
+    'R_FOOT': 'mAnkleRight', 'mFootRight': 'mAnkleRight', 'mToeRight': 'mFootRight',
+    'mHipLeft': 'mPelvis', 'L_UPPER_LEG': 'mHipLeft', 'mKneeLeft': 'mHipLeft', 'L_LOWER_LEG': 'mKneeLeft', 'mAnkleLeft': 'mKneeLeft', 
+    'L_FOOT': 'mAnkleLeft', 'mFootLeft': 'mAnkleLeft', 'mToeLeft': 'mFootLeft',
+    'mTail1': 'mPelvis', 'mTail2': 'mTail1', 'mTail3': 'mTail2', 'mTail4': 'mTail3', 'mTail5': 'mTail4', 'mTail6': 'mTail5', 'mGroin': 'mPelvis',
+    'mHindLimbsRoot': 'mPelvis', 'mHindLimb1Left': 'mHindLimbsRoot', 'mHindLimb2Left': 'mHindLimb1Left', 'mHindLimb3Left': 'mHindLimb2Left', 
+    'mHindLimb4Left': 'mHindLimb3Left', 'mHindLimb1Right': 'mHindLimbsRoot', 'mHindLimb2Right': 'mHindLimb1Right', 
+    'mHindLimb3Right': 'mHindLimb2Right', 'mHindLimb4Right': 'mHindLimb3Right'}
+
 renameList = [
         ("!Slit_L", "mHindLimb1Left"),
         ("!Slit_R", "mHindLimb2Left"),
@@ -44,4 +92,51 @@ colladaLookup = {
     'PELVIS': np.array([0.12, 0.16, 0.17]), 'BUTT': np.array([0.1, 0.1, 0.1])}
 
 rightRot = Matrix(((0.0, 1.0, 0.0, 0.0), (-1.0, 0.0, 0.0, 0.0), (0.0, 0.0, 1.0, 0.0), (0.0, 0.0, 0.0, 1.0)))
-leftRot = Matrix(((0.0, -1.0, 0.0, 0.0), (1.0, 0.0, 0.0, 0.0), (0.0, 0.0, 1.0, 0.0), (0.0, 0.0, 0.0, 1.0)))
\ No newline at end of file
+leftRot = Matrix(((0.0, -1.0, 0.0, 0.0), (1.0, 0.0, 0.0, 0.0), (0.0, 0.0, 1.0, 0.0), (0.0, 0.0, 0.0, 1.0)))
+
+# Immutable model of the SL skeleton, use for all bone lookups instead of scanning validBones
+Skeleton = namedtuple('Skeleton', [
+    'names',        # Bone names in validBones order
+    'bones',        # Frozenset of bone names for membership tests
+    'index',        # Bone name to index into names
+    'parents',      # Parent index of each bone, -1 for the root
+    'volumes',      # Whether each bone is a collision volume
+    'toSL',         # Blender to SL bone renames
+    'toBlender',    # SL to Blender bone renames
+    'mirror',       # Index of the bone on the other side of each bone, itself if centered
+])
+
+# Name of the bone on the other side, e.g. mWristLeft <-> mWristRight and L_HAND <-> R_HAND
+def mirrorName(name):
+    for left, right in (('Left', 'Right'), ('LEFT_', 'RIGHT_')):
+        if left in name:
+            return name.replace(left, right)
+        if right in name:
+            return name.replace(right, left)
+    if name.startswith('L_'):
+        return 'R_' + name[2:]
+    if name.startswith('R_'):
+        return 'L_' + name[2:]
+    return name
+
+def compileSkeleton(names, parents, volumes, renames):
+    index = {name: i for i, name in enumerate(names)}
+    
+    parentIndices = np.array([index[parents[name]] if parents[name] else -1 for name in names], dtype=np.int32)
+    parentIndices.flags.writeable = False
+    volumeFlags = np.array([name in volumes for name in names], dtype=bool)
+    volumeFlags.flags.writeable = False
+    mirrorIndices = np.array([index.get(mirrorName(name), i) for i, name in enumerate(names)], dtype=np.int32)
+    mirrorIndices.flags.writeable = False
+
+    return Skeleton(
+        names = tuple(names),
+        bones = frozenset(names),
+        index = MappingProxyType(index),
+        parents = parentIndices,
+        volumes = volumeFlags,
+        toSL = MappingProxyType(dict(renames)),
+        toBlender = MappingProxyType({newname: name for (name, newname) in renames}),
+        mirror = mirrorIndices)
+
+skeleton = compileSkeleton(validBones, boneParents, colladaLookup, renameList)
@@ -5,12 +5,17 @@ from bpy.types import Operator, Panel, UIList, PropertyGroup
 from bpy.props import StringProperty, IntProperty, FloatProperty, BoolProperty, EnumProperty
 from bpy.props import CollectionProperty, PointerProperty
 
-import xml.etree.ElementTree as ElementTree
 import numpy as np
-import re, os
+import os
+import glob
+import time
+import shutil
+import tempfile
 
+from . import sl_collada
 from . import sl_const
 from . import tgor_character
+from . import tgor_launcher
 from . import tgor_util
 
 ####################################################################################################
@@ -55,6 +60,17 @@ def meshListC_callback(scene, context):
 def meshListD_callback(scene, context):			
     return meshlist[96:128]
 
+# Levels of detail SL takes on upload, decimated ones get the suffixes the uploader of the SL viewer
+# picks up on its own when the full detail file is loaded
+lodLevels = [
+    ("high", "High", "Full detail mesh"),
+    ("medium", "Medium", "Mesh decimated to the medium LOD share"),
+    ("low", "Low", "Mesh decimated to the low LOD share"),
+    ("lowest", "Lowest", "Mesh decimated to the lowest LOD share"),
+]
+lodSuffixes = {'high': "", 'medium': "_LOD2", 'low': "_LOD1", 'lowest': "_LOD0"}
+lodOrder = ('medium', 'low', 'lowest')
+
 class SLMeshExportProperties(PropertyGroup):
     
     file_path: StringProperty(
@@ -70,6 +86,30 @@ class SLMeshExportProperties(PropertyGroup):
             default=True
         )
 
+    writer: EnumProperty(
+            name="Writer",
+            description="How to write the collada file",
+            items=[
+                ("sl", "SL", "Write geometry and skin straight from the mesh data, only what SL needs"),
+                ("blender", "Blender", "Blender's collada exporter, bind poses are patched afterwards"),
+            ],
+            default="sl"
+        )
+
+    processes: IntProperty(
+            name="Processes",
+            description="Background Blender processes to export each selected mesh to its own file with, exports all meshes into one file in this instance if 1",
+            default=1,
+            min=1,
+            max=64
+        )
+
+    skipUnchanged: BoolProperty(
+            name="Skip Unchanged",
+            description="Don't export files whose meshes and settings are the same as when they were last exported (objects referenced by modifiers only count by name)",
+            default=False
+        )
+
     meshesA: EnumProperty(
             name="Meshes",
             items=meshListA_callback,
@@ -98,8 +138,279 @@ class SLMeshExportProperties(PropertyGroup):
             options={'ENUM_FLAG'}
         )
     
+    lodMedium: FloatProperty(
+            name="Medium",
+            description="Share of faces kept in the medium LOD",
+            default=0.5,
+            min=0.01,
+            max=1.0,
+            subtype='FACTOR'
+        )
+
+    lodLow: FloatProperty(
+            name="Low",
+            description="Share of faces kept in the low LOD",
+            default=0.25,
+            min=0.01,
+            max=1.0,
+            subtype='FACTOR'
+        )
+
+    lodLowest: FloatProperty(
+            name="Lowest",
+            description="Share of faces kept in the lowest LOD",
+            default=0.1,
+            min=0.01,
+            max=1.0,
+            subtype='FACTOR'
+        )
+
+    # Selected mesh names in name order, so the file they're exported to doesn't depend on set order
     def getMeshes(self):
-        return self.meshesA | self.meshesB | self.meshesC | self.meshesD
+        return sorted(self.meshesA | self.meshesB | self.meshesC | self.meshesD)
+
+    # Share of faces kept at a level of detail
+    def lodRatio(self, lod):
+        return {'high': 1.0, 'medium': self.lodMedium, 'low': self.lodLow, 'lowest': self.lodLowest}[lod]
+
+####################################################################################################
+############################################# PREPARATION ##########################################
+####################################################################################################
+
+# Groups of SL bones that have weights or a marked descendant bone, only the hierarchy below
+# the armature's first bone is considered
+def markedGroups(armature, names, maxWeight):
+    marked = np.zeros(len(names), dtype=bool)
+    if armature is None or not armature.data.bones:
+        return marked
+
+    bones = armature.data.bones
+    boneIndex = {bone.name: index for index, bone in enumerate(bones)}
+    groupIndex = {name: index for index, name in enumerate(names)}
+    parents = np.array([boneIndex[bone.parent.name] if bone.parent else -1 for bone in bones], dtype=np.int32)
+    groups = np.array([groupIndex.get(bone.name, -1) for bone in bones], dtype=np.int32)
+
+    # Depth and root of every bone by walking all bones up the hierarchy at once
+    depth = np.zeros(len(bones), dtype=np.int32)
+    root = np.arange(len(bones), dtype=np.int32)
+    ancestor = parents.copy()
+    while (ancestor >= 0).any():
+        up = ancestor >= 0
+        depth[up] += 1
+        root[up] = ancestor[up]
+        ancestor[up] = parents[ancestor[up]]
+
+    # Children before parents so marks only need to be passed up once
+    hasMark = np.zeros(len(bones), dtype=bool)
+    for index in np.argsort(-depth, kind='stable').tolist():
+        if root[index] != 0:
+            continue
+
+        group = groups[index]
+        if group >= 0 and (hasMark[index] or maxWeight[group] > 0.0) and bones[index].name in sl_const.skeleton.bones:
+            marked[group] = True
+            hasMark[index] = True
+        if hasMark[index] and parents[index] >= 0:
+            hasMark[parents[index]] = True
+    return marked
+
+# Weights of all vertex groups of a mesh object as dense (vertices, groups) matrices. Membership is kept
+# separately because a vertex can be in a group with a weight of 0. Cleanup stages only change the
+# matrices, write applies the result to the object at once.
+class WeightMatrix():
+
+    def __init__(self, obj):
+        indices, groups, weights = tgor_util.readWeights(obj)
+        shape = (len(obj.data.vertices), len(obj.vertex_groups))
+        self.names = [group.name for group in obj.vertex_groups]
+        self.removed = np.zeros(len(self.names), dtype=bool)
+
+        self.originalWeights = np.zeros(shape, dtype=np.float32)
+        self.originalMembers = np.zeros(shape, dtype=bool)
+        self.originalWeights[indices, groups] = weights
+        self.originalMembers[indices, groups] = True
+        self.weights = self.originalWeights.copy()
+        self.members = self.originalMembers.copy()
+
+    # Assignments as flat (vertex, group, weight) arrays ordered by vertex, like readWeights
+    def assignments(self):
+        vertices, groups = np.nonzero(self.members)
+        return vertices, groups, self.weights[vertices, groups]
+
+    # Largest weight of every group
+    def maxWeights(self):
+        return np.max(np.where(self.members, self.weights, 0.0), axis=0, initial=0.0)
+
+    def remove(self, groups):
+        self.removed |= groups
+        self.members[:, groups] = False
+        self.weights[:, groups] = 0.0
+
+    # Remove all groups not used in SL skeleton
+    def removeUnused(self):
+        self.remove(np.array([name not in sl_const.skeleton.bones for name in self.names], dtype=bool))
+
+    # Remove all groups without weights unless they're needed to keep the SL hierarchy of the armature
+    def removeEmpty(self, armature):
+        maxWeight = self.maxWeights()
+        self.remove((maxWeight <= 0.0) & ~markedGroups(armature, self.names, maxWeight) & ~self.removed)
+
+    # Only keep the limit biggest weights per vertex, normalize them and drop the ones at or below threshold
+    def fix(self, limit, threshold):
+        if 0 < limit < self.members.shape[1]:
+            scores = np.where(self.members, self.weights, -1.0)
+            biggest = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+            keep = np.zeros_like(self.members)
+            np.put_along_axis(keep, biggest, True, axis=1)
+            self.members &= keep
+            self.weights[~self.members] = 0.0
+
+        norm = self.weights.sum(axis=1, keepdims=True)
+        np.divide(self.weights, norm, out=self.weights, where=norm > 0.0)
+
+        self.members &= self.weights > threshold
+        self.weights[~self.members] = 0.0
+
+    # Write changed weights and memberships to the object's vertex groups, one remove call per group
+    # and one add call per distinct weight of a group. Removed groups are deleted last, back to front
+    # so indices stay valid.
+    def write(self, obj):
+        for index, vertexGroup in enumerate(obj.vertex_groups):
+            if self.removed[index]:
+                continue
+
+            lost = np.flatnonzero(self.originalMembers[:, index] & ~self.members[:, index])
+            if lost.size:
+                vertexGroup.remove(lost.tolist())
+
+            changed = np.flatnonzero(self.members[:, index] & (~self.originalMembers[:, index] | (self.weights[:, index] != self.originalWeights[:, index])))
+            if not changed.size:
+                continue
+
+            values, inverse, counts = np.unique(self.weights[changed, index], return_inverse=True, return_counts=True)
+            batches = np.split(changed[np.argsort(inverse, kind='stable')], np.cumsum(counts)[:-1])
+            for value, batch in zip(values.tolist(), batches):
+                vertexGroup.add(batch.tolist(), value, 'REPLACE')
+
+        for index in np.flatnonzero(self.removed)[::-1].tolist():
+            obj.vertex_groups.remove(obj.vertex_groups[index])
+
+        # Matrices now match the object again
+        keep = ~self.removed
+        self.names = [name for name, kept in zip(self.names, keep.tolist()) if kept]
+        self.removed = self.removed[keep]
+        self.weights = self.weights[:, keep]
+        self.members = self.members[:, keep]
+        self.originalWeights = self.weights.copy()
+        self.originalMembers = self.members.copy()
+
+# Weight problems SL only complains about after upload, found in one pass over a mesh's weight matrix:
+# vertices with more influences than the limit, unnormalized or no weights and weighted groups of
+# bones SL doesn't know
+class WeightAudit():
+
+    def __init__(self, matrix, limit=4, tolerance=0.001):
+        weights = np.where(matrix.members, matrix.weights, 0.0)
+        influences = matrix.members.sum(axis=1)
+        totals = weights.sum(axis=1)
+
+        self.vertices = len(influences)
+        self.limit = limit
+        self.histogram = np.bincount(influences, minlength=limit + 1)
+        self.overLimit = int((influences > limit).sum())
+        self.unweighted = int((totals <= 0.0).sum())
+        self.unnormalized = int(((totals > 0.0) & (np.abs(totals - 1.0) > tolerance)).sum())
+
+        # Groups that are renamed to SL bones on export are fine
+        weighted = (weights > 0.0).any(axis=0)
+        self.foreignGroups = [name for name, used in zip(matrix.names, weighted.tolist())
+            if used and name not in sl_const.skeleton.bones and name not in sl_const.skeleton.toSL]
+
+    def problems(self):
+        return bool(self.overLimit or self.unnormalized or self.unweighted or self.foreignGroups)
+
+    # One line per mesh, influence histogram as influences:vertices
+    def summary(self, name):
+        histogram = " ".join("%d:%d" % (count, vertices) for count, vertices in enumerate(self.histogram.tolist()) if vertices)
+        text = "%s: %d vertices, influences %s" % (name, self.vertices, histogram or "-")
+        if self.overLimit:
+            text += ", %d over %d" % (self.overLimit, self.limit)
+        if self.unnormalized:
+            text += ", %d unnormalized" % (self.unnormalized)
+        if self.unweighted:
+            text += ", %d unweighted" % (self.unweighted)
+        if self.foreignGroups:
+            text += ", non-SL groups: %s" % (", ".join(self.foreignGroups))
+        return text
+
+# Summaries of meshes whose weights have problems. Audits the meshes' own weights, the export fixes
+# what it can, so auditing its prepared weights would hide those problems or report its own rounding.
+def weightProblems(meshes, limit=4, tolerance=0.001):
+    audits = [(obj.name, WeightAudit(WeightMatrix(obj), limit, tolerance)) for obj in meshes]
+    return [audit.summary(name) for name, audit in audits if audit.problems()]
+
+# Armature a mesh object is parented to, if any
+def parentArmature(obj):
+    if not obj.parent is None and obj.parent.type == 'ARMATURE':
+        return obj.parent
+    return None
+
+# Apply all visible modifiers except armatures, returns whether all of them could be applied
+def applyModifiers(context, obj):
+    success = True
+
+    # copying context for the operator's override
+    contx = context.copy()
+    contx['object'] = obj
+
+    for mod in obj.modifiers[:]:
+        if not mod.type == 'ARMATURE':
+
+            contx['modifier'] = mod
+            
+            try:
+                # Only apply if visible in viewport
+                if mod.show_viewport:
+                    bpy.ops.object.modifier_apply(contx, apply_as='DATA', modifier=mod.name)
+            except:
+                success = False
+    return success
+
+# Rename bones of an armature to SL names ('to_sl') or back ('to_blender'), vertex groups of meshes
+# using the armature are renamed along
+def renameBones(armature, operation):
+
+    # Reverse the renaming if desired
+    namelist = sl_const.skeleton.toBlender if operation == 'to_blender' else sl_const.skeleton.toSL
+
+    for (name, newname) in namelist.items():
+
+        # get the pose bone with name
+        bone = armature.pose.bones.get(name)
+
+        # rename if no bone of that name
+        if not bone is None:
+            bone.name = newname
+
+# Prepare export copies (with modifiers already applied) for the SL export in one go: rename bones to SL,
+# then read the weights of every mesh once, remove unused and empty groups, fix weightmaps and write the
+# weights back once. Returns the weight matrices of the meshes so they don't need to be read again.
+def prepareMeshes(objects, limit=4, threshold=0.01):
+    meshes = [obj for obj in objects if obj.type == 'MESH']
+    armatures = [obj for obj in objects if obj.type == 'ARMATURE']
+
+    for armature in armatures:
+        renameBones(armature, 'to_sl')
+
+    matrices = {}
+    for obj in meshes:
+        matrix = WeightMatrix(obj)
+        matrix.removeUnused()
+        matrix.removeEmpty(parentArmature(obj))
+        matrix.fix(limit, threshold)
+        matrix.write(obj)
+        matrices[obj] = matrix
+    return matrices
 
 ####################################################################################################
 ############################################# OPERATORS ############################################
@@ -114,7 +425,8 @@ class SL_OT_FixWeightmaps(Operator):
     limit: IntProperty(
             name = "Limit",
             description = "Max amount of weights per vertex",
-            default = 4
+            default = 4,
+            min = 1
         )
 
     threshold: FloatProperty(
@@ -129,37 +441,9 @@ class SL_OT_FixWeightmaps(Operator):
         for obj in context.selected_objects:
             if obj.type == 'MESH':
                 FoundAny = True
-                for vertex in obj.data.vertices:
-                    
-                    limit = min(self.limit, len(vertex.groups))
-                    
-                    # Get weights of remaining
-                    weights = []
-                    for group in vertex.groups:
-                        weights.append((group.group, group.weight))
-
-                    # Only keep n groups with biggest weight
-                    weights.sort(key=lambda t: t[1])
-                    for (idx, _) in weights[0:-limit]:
-                        obj.vertex_groups[idx].remove([vertex.index])
-
-                    # Normalize all weights
-                    norm = 0.0
-                    for group in vertex.groups:
-                        norm += group.weight
-                    if norm > 0.0:
-                        for group in vertex.groups:
-                            group.weight /= norm
-
-                    # Grab weight data
-                    cleans = []
-                    for group in vertex.groups:
-                        if group.weight <= self.threshold:
-                            cleans.append(group.group)
-
-                    # Remove groups that are 0
-                    for clean in cleans:
-                        obj.vertex_groups[clean].remove([vertex.index])
+                matrix = WeightMatrix(obj)
+                matrix.fix(self.limit, self.threshold)
+                matrix.write(obj)
 
         if not FoundAny:
         	self.report({'ERROR'}, "No Mesh selected")
@@ -168,6 +452,42 @@ class SL_OT_FixWeightmaps(Operator):
         return {'FINISHED'}
 
 
+class SL_OT_AuditWeights(Operator):
+    bl_idname = "object.sl_mesh_audit_weights"
+    bl_label = "Audit weights"
+    bl_description = ("Report weights SL would reject or mangle, without changing anything")
+    bl_options = {'REGISTER'}
+
+    limit: IntProperty(
+            name = "Limit",
+            description = "Max amount of weights per vertex",
+            default = 4,
+            min = 1
+        )
+
+    tolerance: FloatProperty(
+            name = "Tolerance",
+            description = "How far the weights of a vertex may sum up from 1",
+            default = 0.001,
+            min = 0.0
+        )
+
+    def execute(self, context):
+
+        audits = [(obj.name, WeightAudit(WeightMatrix(obj), self.limit, self.tolerance)) for obj in context.selected_objects if obj.type == 'MESH']
+        if not audits:
+        	self.report({'ERROR'}, "No Mesh selected")
+        	return {'CANCELLED'}
+
+        # One line per mesh, meshes with problems as warnings
+        for name, audit in audits:
+            self.report({'WARNING'} if audit.problems() else {'INFO'}, audit.summary(name))
+
+        if not any(audit.problems() for name, audit in audits):
+            self.report({'INFO'}, "No weight problems in %d meshes" % (len(audits)))
+        return {'FINISHED'}
+
+
 class SL_OT_ApplyModifiers(Operator):
     bl_idname = "object.sl_mesh_apply_modifiers"
     bl_label = "Apply Modifiers"
@@ -181,23 +501,8 @@ class SL_OT_ApplyModifiers(Operator):
         for obj in context.selected_objects:
             if obj.type == 'MESH':
                 FoundAny = True
-
-                # copying context for the operator's override
-                contx = bpy.context.copy()
-                contx['object'] = obj
-
-                for mod in obj.modifiers[:]:
-                    if not mod.type == 'ARMATURE':
-
-                        contx['modifier'] = mod
-                        
-                        try:
-                            # Only apply if visible in viewport
-                            if mod.show_viewport:
-                                bpy.ops.object.modifier_apply(contx, apply_as='DATA', modifier=mod.name)
-                        except:
-                            error = True
-                            pass
+                if not applyModifiers(context, obj):
+                    error = True
         
         # Display error if we failed
         if error:
@@ -232,21 +537,7 @@ class SL_OT_RenameBones(Operator):
         for obj in context.selected_objects:
             if obj.type == 'ARMATURE':
                 FoundAny = True
-                
-                namelist = sl_const.renameList
-
-                # Reverse the renaming list if desired
-                if self.operation == 'to_blender':
-                    namelist = [(newname, name) for (name, newname) in namelist]
-
-                for (name, newname) in namelist:
-
-                    # get the pose bone with name
-                    bone = obj.pose.bones.get(name)
-
-                    # rename if no bone of that name
-                    if not bone is None:
-                        bone.name = newname
+                renameBones(obj, self.operation)
 
         if not FoundAny:
         	self.report({'ERROR'}, "No Armature selected")
@@ -266,51 +557,9 @@ class SL_OT_RemoveEmptyGroups(Operator):
         for obj in context.selected_objects:
             if obj.type == 'MESH':
                 FoundAny = True
-                
-                # Initialse weight for all groups to 0 
-                maxWeight = {}
-                for group in obj.vertex_groups:
-                    maxWeight[group.index] = 0
-
-                # Get group with max weight
-                for vertex in obj.data.vertices:
-                    for group in vertex.groups:
-                        weight = obj.vertex_groups[group.group].weight(vertex.index)
-                        if (weight > maxWeight[group.group]):
-                            maxWeight[group.group] = weight
-
-
-                # Figure which bones ought not to be decimated
-                marked = []
-                def mark(bone):
-
-
-                    # See whether yourself or a child is marked
-                    hasMark = False
-                    for child in bone.children:
-                        if mark(child):
-                            hasMark = True
-                    
-                    # Get group index for this bone
-                    group = obj.vertex_groups.find(bone.name)
-                    if group >= 0:
-
-                        # Register if marked
-                        if (hasMark or (maxWeight[group] > 0.0)) and (bone.name in sl_const.validBones):
-                            marked.append(group)
-                            return True
-                        
-                    return hasMark
-                
-                if not obj.parent is None and obj.parent.type == 'ARMATURE': 
-                    mark(obj.parent.data.bones[0])
-
-                # Remove the groups if zero weights and not marked
-                keys = list(maxWeight.keys())
-                keys.sort(reverse=True)
-                for key in keys:
-                    if (maxWeight[key] <= 0) and (key not in marked):
-                        obj.vertex_groups.remove(obj.vertex_groups[key])
+                matrix = WeightMatrix(obj)
+                matrix.removeEmpty(parentArmature(obj))
+                matrix.write(obj)
 
         if not FoundAny:
         	self.report({'ERROR'}, "No Mesh selected")
@@ -330,16 +579,9 @@ class SL_OT_RemoveUnusedGroups(Operator):
         for obj in context.selected_objects:
             if obj.type == 'MESH':
                 FoundAny = True
-                
-                # Cannot remove during for loop
-                removes = []
-                for group in obj.vertex_groups:
-                    if group.name not in sl_const.validBones:
-                        removes.append(group)
-                
-                # Actually remove
-                for remove in removes:
-                    obj.vertex_groups.remove(remove)
+                matrix = WeightMatrix(obj)
+                matrix.removeUnused()
+                matrix.write(obj)
 
         if not FoundAny:
         	self.report({'ERROR'}, "No Mesh selected")
@@ -353,7 +595,133 @@ class SL_OT_MeshExport(Operator):
     bl_description = ("Do all preparations above and export mesh to the specified folder")
     bl_options = {'REGISTER', 'UNDO'}
 
+    lod: EnumProperty(
+            name="LOD",
+            description="Level of detail to export",
+            items=lodLevels,
+            default="high",
+            options={'SKIP_SAVE'}
+        )
+
+    # Export selected objects with the settings SL expects
+    def colladaExport(self, filePath):
+        bpy.ops.wm.collada_export(
+            filepath=filePath,
+            prop_bc_export_ui_section = 'main',
+            apply_modifiers = True,
+            export_mesh_type = 0,
+            export_mesh_type_selection = 'view',
+            export_global_forward_selection = '-X',
+            export_global_up_selection = 'Z',
+            apply_global_orientation = True,
+            selected = True,
+            include_children = False,
+            include_armatures = True,
+            include_shapekeys = False,
+            deform_bones_only = True,
+            include_animations = True,
+            include_all_actions = True,
+            export_animation_type_selection = 'sample',
+            sampling_rate = 1,
+            keep_smooth_curves = False,
+            keep_keyframes = False,
+            keep_flat_curves = False,
+            active_uv_only = True,
+            use_texture_copies = True,
+            triangulate = True,
+            use_object_instantiation = False,
+            use_blender_profile = True,
+            sort_by_name = True,
+            export_object_transformation_type = 0,
+            export_object_transformation_type_selection = 'matrix',
+            export_animation_transformation_type = 0,
+            export_animation_transformation_type_selection = 'matrix',
+            open_sim = True,
+            limit_precision = False,
+            keep_bind_info = False)
+
+    # Write prepared copies given as (mesh, weight matrix), bind poses are scaled so meshes don't appear anorexic in SL
+    def write(self, context, filePath, deformRig, meshes):
+        settings = context.window_manager.sl_mesh_export
+        if settings.writer == 'sl' and deformRig:
+            lookup = sl_const.colladaLookup if settings.patchCollada else {}
+            sl_collada.writeCollada(filePath, deformRig, [sl_collada.SkinnedMesh(mesh, matrix.assignments()) for mesh, matrix in meshes], lookup)
+            return
+
+        self.colladaExport(filePath)
+        if settings.patchCollada:
+            sl_collada.patchCollada(filePath)
+
+    # Settings the exported files depend on, recorded in the export manifest
+    def exportSettings(self, context, lod):
+        settings = context.window_manager.sl_mesh_export
+        return {'format': "sl_mesh", 'writer': settings.writer, 'patchCollada': settings.patchCollada, 'lod': lod, 'ratio': settings.lodRatio(lod)}
+
+    # File a level of detail of meshes is exported to, named after the first mesh
+    def filePath(self, meshFolder, meshes, lod):
+        return bpy.path.abspath(os.path.join(meshFolder, tgor_util.makeValidFilename(meshes[0].name) + lodSuffixes[lod] + ".dae"))
+
+    # Run one batch export per (meshes, lod) in background Blender processes working on a saved copy of
+    # the file (so unsaved changes are included), returns the finished jobs in the same order
+    def exportInBackground(self, context, meshFolder, exports):
+        settings = context.window_manager.sl_mesh_export
+        character = context.scene.tgor_character_selection.characters_selection
+
+        directory = tempfile.mkdtemp(prefix="slmesh")
+        try:
+            blendFile = os.path.join(directory, "meshes.blend")
+            bpy.ops.wm.save_as_mainfile(filepath=blendFile, copy=True)
+
+            # Relative paths would resolve against the copy, so the folder is passed on as absolute path
+            arguments = ["--character", character, "--formats", "sl_mesh", "--mesh-folder", bpy.path.abspath(meshFolder),
+                "--sl-mesh-writer", settings.writer, "--patch-collada", "on" if settings.patchCollada else "off", "--no-manifest"]
+            jobs = [tgor_launcher.Job(blendFile, tgor_launcher.blenderCommand(bpy.app.binary_path, blendFile, tgor_launcher.batchScript,
+                arguments + ["--sl-mesh-lod", lod, "--meshes"] + [glob.escape(mesh.name) for mesh in meshes])) for meshes, lod in exports]
+            return tgor_launcher.runJobs(jobs, settings.processes)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    # Export each mesh to its own file in background processes
+    def exportSeparately(self, context, meshes, deformRig, meshFolder):
+        settings = context.window_manager.sl_mesh_export
+        start = time.perf_counter()
+
+        # Skip meshes whose files would come out the same
+        manifest = tgor_util.ExportManifest(bpy.path.abspath(meshFolder), settings.skipUnchanged)
+        exportSettings = self.exportSettings(context, self.lod)
+        filePaths = {mesh: self.filePath(meshFolder, [mesh], self.lod) for mesh in meshes}
+        hashes = {mesh: manifest.hashes([mesh], deformRig) for mesh in meshes}
+        unchanged = [mesh for mesh in meshes if manifest.unchanged(filePaths[mesh], exportSettings, hashes[mesh])]
+        meshes = [mesh for mesh in meshes if mesh not in unchanged]
+        if not meshes:
+            self.report({'INFO'}, "All %d meshes are unchanged, nothing exported" % (len(unchanged)))
+            return {'FINISHED'}
+
+        jobs = self.exportInBackground(context, meshFolder, [([mesh], self.lod) for mesh in meshes])
+
+        # Combined report, output of failed exports goes to the console
+        failed = [mesh.name for mesh, job in zip(meshes, jobs) if not job.succeeded()]
+        for mesh, job in zip(meshes, jobs):
+            if job.succeeded():
+                manifest.record(filePaths[mesh], exportSettings, hashes[mesh])
+            else:
+                print("SL mesh export of %s failed:\n%s" % (mesh.name, job.output))
+        manifest.save()
+
+        if failed:
+            self.report({'ERROR'}, "Exported %d of %d meshes, failed: %s (see console)" % (len(meshes) - len(failed), len(meshes), ", ".join(failed)))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "Exported %d meshes to %s in %.1fs, %d unchanged" % (len(meshes), meshFolder, time.perf_counter() - start, len(unchanged)))
+        return {'FINISHED'}
+
+    # Frame of the user is restored once the export (or the batch it's part of) is done
     def execute(self, context):
+        with tgor_util.exportSession.scope(context.scene):
+            return self.export(context)
+
+    # Character, meshes and folder to export, None after reporting what's missing
+    def exportTargets(self, context):
 
         # Create a class that houses userful and repetetive character references
         charRefHndlr = tgor_character.CharacterReferenceHandler(context)
@@ -362,7 +730,7 @@ class SL_OT_MeshExport(Operator):
         # stop if no scene
         if not characterScene :
         	self.report({'ERROR'}, "Character setup is invalid, no scene.")
-        	return {'FINISHED'}
+        	return None
         
         # Get the mesh object reference from the mesh name operator's input string property
         meshes = context.window_manager.sl_mesh_export.getMeshes()
@@ -372,7 +740,7 @@ class SL_OT_MeshExport(Operator):
         # Stop if no mesh
         if meshesToExport == []:
         	self.report({'ERROR'}, "No valid mesh supplied to operator properties")
-        	return {'FINISHED'}
+        	return None
         
         # Get export path
         meshFolder = charRefHndlr.meshFolder
@@ -380,16 +748,51 @@ class SL_OT_MeshExport(Operator):
         # Stop if no paths gotten
         if not meshFolder:
         	self.report({'ERROR'}, "Character doesn't have mesh export path defined")
-        	return {'FINISHED'}
+        	return None
         
         # Check path as absolute path TODO: Relative paths https://docs.blender.org/api/blender_python_api_2_77_0/bpy.path.html
         if not os.path.isdir(bpy.path.abspath(meshFolder)):
         	self.report({'ERROR'}, "Path '" + meshFolder + "' doesn't point to an existing directory (has to be absolute path).")
-        	return {'FINISHED'}
+        	return None
+
+        return charRefHndlr, meshesToExport, meshFolder
+
+    def export(self, context):
+        targets = self.exportTargets(context)
+        if not targets:
+            return {'FINISHED'}
+        charRefHndlr, meshesToExport, meshFolder = targets
+        settings = context.window_manager.sl_mesh_export
         
-        # getting the full fbx export file path
-        filePath = bpy.path.abspath(os.path.join( meshFolder, tgor_util.makeValidFilename(meshesToExport[0].name) + ".dae"))
-        # self.report({'WARNING'}, filePath)
+        # Export meshes to separate files in parallel if asked to
+        if settings.processes > 1 and len(meshesToExport) > 1 and self.lod == 'high':
+            return self.exportSeparately(context, meshesToExport, charRefHndlr.deformRig, meshFolder)
+
+        # getting the full collada export file path
+        filePath = self.filePath(meshFolder, meshesToExport, self.lod)
+
+        # Skip the export if the file would come out the same
+        manifest = tgor_util.ExportManifest(bpy.path.abspath(meshFolder), settings.skipUnchanged)
+        exportSettings = self.exportSettings(context, self.lod)
+        hashes = manifest.hashes(meshesToExport, charRefHndlr.deformRig)
+        if manifest.unchanged(filePath, exportSettings, hashes):
+            self.report({'INFO'}, "%s is up to date, nothing exported" % (filePath))
+            return {'FINISHED'}
+
+        problems = weightProblems(meshesToExport)
+        self.exportFile(context, charRefHndlr, meshesToExport, filePath, settings.lodRatio(self.lod))
+        manifest.record(filePath, exportSettings, hashes)
+        manifest.save()
+
+        if problems:
+            self.report({'WARNING'}, "Exported to @ %s with weight problems: %s" % (filePath, "; ".join(problems)))
+            return {'FINISHED'}
+
+        self.report({'INFO'}, "Exported to @ %s" % (filePath))
+        return {'FINISHED'}
+
+    # Export meshes decimated to a share of their faces into one file
+    def exportFile(self, context, charRefHndlr, meshesToExport, filePath, ratio):
         
         # -----------------------------		
         # Scene preparation
@@ -397,8 +800,8 @@ class SL_OT_MeshExport(Operator):
         # Go to object mode
         tgor_util.exitPoseMode(context)
         
-        # Set timeline to 0 frame
-        context.scene.frame_set(0)
+        # Set timeline to 0 frame (the frame of the user is restored when the export session ends)
+        tgor_util.exportSession.frameSet(context.scene, 0)
         	
         # Go to object mode
         if context.object:
@@ -409,134 +812,84 @@ class SL_OT_MeshExport(Operator):
         for ob in bpy.data.objects:
         	ob.select_set(False)
         
-        # Make mesh visible, seletable, and remember how they were 
+        # Make mesh visible so they get evaluated, and remember how they were 
         meshToExportWasHidden = [bool(meshToExport.hide_get()) for meshToExport in meshesToExport]		
-        meshToExportWasSelectable = [bool(meshToExport.hide_select) for meshToExport in meshesToExport]
         for meshToExport in meshesToExport:
-        	meshToExport.hide_select = False
         	meshToExport.hide_set(False)
-        	meshToExport.select_set(True)
         
-        if charRefHndlr.deformRig :
-            charRefHndlr.deformRig.select_set(True)
+        # -----------------------------		
+        # Export from temporary copies of the evaluated meshes and rigs (copies are selected)
+        rigs = [rig for rig in (charRefHndlr.deformRig, charRefHndlr.controlRig) if rig]
+        copies = None
+        try:
+            copies = tgor_util.ExportCopies(context, meshesToExport, rigs, ratio)
+
+            # All preparations above in one pass over the copies' weights
+            matrices = prepareMeshes(copies.copies.values())
 
-        if charRefHndlr.controlRig :
-            charRefHndlr.controlRig.select_set(True)
+            self.write(context, filePath, copies.get(charRefHndlr.deformRig), [(copies.get(meshToExport), matrices[copies.get(meshToExport)]) for meshToExport in meshesToExport])
 
         # -----------------------------		
-        # Making changes to scene
-        
-        # Duplicate (new objects should stay selected)
-        bpy.ops.object.duplicate()
-        
-        bpy.ops.object.sl_mesh_apply_modifiers()
-        bpy.ops.object.sl_mesh_rename_bones(operation='to_sl')
-        bpy.ops.object.sl_mesh_remove_unused_groups()
-        bpy.ops.object.sl_mesh_remove_empty_groups()
-        bpy.ops.object.sl_mesh_fix_weightmaps()
-        
-        bpy.ops.wm.collada_export(
-            filepath=filePath,
-            prop_bc_export_ui_section = 'main',
-            apply_modifiers = True,
-            export_mesh_type = 0,
-            export_mesh_type_selection = 'view',
-            export_global_forward_selection = '-X',
-            export_global_up_selection = 'Z',
-            apply_global_orientation = True,
-            selected = True,
-            include_children = False,
-            include_armatures = True,
-            include_shapekeys = False,
-            deform_bones_only = True,
-            include_animations = True,
-            include_all_actions = True,
-            export_animation_type_selection = 'sample',
-            sampling_rate = 1,
-            keep_smooth_curves = False,
-            keep_keyframes = False,
-            keep_flat_curves = False,
-            active_uv_only = True,
-            use_texture_copies = True,
-            triangulate = True,
-            use_object_instantiation = False,
-            use_blender_profile = True,
-            sort_by_name = True,
-            export_object_transformation_type = 0,
-            export_object_transformation_type_selection = 'matrix',
-            export_animation_transformation_type = 0,
-            export_animation_transformation_type_selection = 'matrix',
-            open_sim = True,
-            limit_precision = False,
-            keep_bind_info = False)
+        # Cleanup
+        finally:
+            if copies:
+                copies.cleanup()
+            for meshToExport, hide in zip(meshesToExport, meshToExportWasHidden):
+            	meshToExport.hide_set(hide)
+
+class SL_OT_MeshExportLODs(SL_OT_MeshExport):
+    bl_idname = "object.sl_mesh_export_lods"
+    bl_label = "SL Mesh LODs"
+    bl_description = ("Export decimated medium, low and lowest LODs of the meshes next to their collada file")
+    bl_options = {'REGISTER', 'UNDO'}
 
-		# -----------------------------		
-		# Cleanup
-		
-		# Delete duplicated stuff
-        bpy.ops.object.delete(use_global=False)
-        
-        for meshToExport, hide, hide_select in zip(meshesToExport, meshToExportWasHidden, meshToExportWasSelectable):
-        	meshToExport.hide_set(hide)
-        	meshToExport.hide_select = hide_select
-
-        if context.window_manager.sl_mesh_export.patchCollada:
-
-            # Read namespace first because elementtree needs to know before parsing
-            tree = ElementTree.parse(filePath)
-            root = tree.getroot()
-            ns = re.match(r'{(.*)}', root.tag).group(0)
-            ElementTree.register_namespace('', ns[1:-1])
-
-            # Parse again
-            tree = ElementTree.parse(filePath)
-            root = tree.getroot()
-
-            for libcontrollers in root.findall(f'{ns}library_controllers'):
-                for controller in libcontrollers.findall(f'{ns}controller'):
-                    for skin in controller.findall(f'{ns}skin'):
-
-                        jointElem = None
-                        transformElem = None
-
-                        # Grab joint names and transforms from document
-                        for source in skin.findall(f'{ns}source'):
-                            accessor = source.find(f'{ns}technique_common').find(f'{ns}accessor').find(f'{ns}param').get('name')
-                            if accessor == 'JOINT':
-                                jointElem = source.find(f'{ns}Name_array')
-                            elif accessor == 'TRANSFORM':
-                                transformElem = source.find(f'{ns}float_array')
-
-                        # Extract joint names and transforms (stored in n x 16 list)
-                        joints = jointElem.text.split(' ')
-                        transforms = np.fromstring(transformElem.text, dtype=float, sep=' ').reshape((len(joints), 16))
-
-                        # Transform if a corresponding scale exists
-                        for idx, joint in enumerate(joints):
-                            if joint in sl_const.colladaLookup:
-                                
-                                # Get 4x4 transform from correct row
-                                T = transforms[idx, :].reshape((4,4))
-
-                                # Do transformation
-                                scale = sl_const.colladaLookup[joint]
-                                inv = np.array([1.0/s for s in scale])
-
-                                # Create transform, for now just scaling
-                                transform = np.eye(4)
-                                transform[:3, :3] = np.diag(inv)
-                                T = np.matmul(transform, T)
-                                
-                                # Set back in row format
-                                transforms[idx, :] = T.reshape(16)
-
-                        # Write the transforms back
-                        transformElem.text = ' '.join(map(str, transforms.reshape((len(joints) * 16))))
-
-            outFile = open(filePath, "wb")
-            tree.write(outFile, encoding='utf-8', xml_declaration=True)
-        
-        self.report({'INFO'}, "Exported to @ %s" % (filePath))
+    def execute(self, context):
+        with tgor_util.exportSession.scope(context.scene):
+            return self.exportLODs(context)
+
+    def exportLODs(self, context):
+        targets = self.exportTargets(context)
+        if not targets:
+            return {'FINISHED'}
+        charRefHndlr, meshesToExport, meshFolder = targets
+        settings = context.window_manager.sl_mesh_export
+        start = time.perf_counter()
+
+        # LODs are cached by the hashes of their source meshes
+        manifest = tgor_util.ExportManifest(bpy.path.abspath(meshFolder), settings.skipUnchanged)
+        hashes = manifest.hashes(meshesToExport, charRefHndlr.deformRig)
+        filePaths = {lod: self.filePath(meshFolder, meshesToExport, lod) for lod in lodOrder}
+        lods = [lod for lod in lodOrder if not manifest.unchanged(filePaths[lod], self.exportSettings(context, lod), hashes)]
+        if not lods:
+            self.report({'INFO'}, "LODs of %s are up to date, nothing exported" % (meshesToExport[0].name))
+            return {'FINISHED'}
+
+        # Every LOD in its own background process, or one after another in this instance
+        failed = []
+        problems = weightProblems(meshesToExport)
+        if settings.processes > 1 and len(lods) > 1:
+            jobs = self.exportInBackground(context, meshFolder, [(meshesToExport, lod) for lod in lods])
+            for lod, job in zip(lods, jobs):
+                if job.succeeded():
+                    manifest.record(filePaths[lod], self.exportSettings(context, lod), hashes)
+                else:
+                    failed.append(lod)
+                    print("SL mesh export of %s LOD failed:\n%s" % (lod, job.output))
+        else:
+            for lod in lods:
+                self.exportFile(context, charRefHndlr, meshesToExport, filePaths[lod], settings.lodRatio(lod))
+                manifest.record(filePaths[lod], self.exportSettings(context, lod), hashes)
+        manifest.save()
+
+        if failed:
+            self.report({'ERROR'}, "Exported %d of %d LODs, failed: %s (see console)" % (len(lods) - len(failed), len(lods), ", ".join(failed)))
+            return {'CANCELLED'}
+
+        if problems:
+            self.report({'WARNING'}, "Exported %d LODs with weight problems: %s" % (len(lods), "; ".join(problems)))
+            return {'FINISHED'}
+
+        self.report({'INFO'}, "Exported %d LODs to %s in %.1fs, %d unchanged" % (len(lods), meshFolder, time.perf_counter() - start, len(lodOrder) - len(lods)))
         return {'FINISHED'}
 
 
@@ -564,6 +917,7 @@ class SL_PT_MeshExportPanel(Panel):
         col.operator("object.sl_mesh_remove_unused_groups", icon='EDITMODE_HLT')
         col.operator("object.sl_mesh_remove_empty_groups", icon='MESH_DATA')
         col.operator("object.sl_mesh_fix_weightmaps", icon='MOD_VERTEX_WEIGHT')
+        col.operator("object.sl_mesh_audit_weights", icon='VIEWZOOM')
 
         row.separator()
 
@@ -581,11 +935,13 @@ class SL_PT_MeshExportPanel(Panel):
 
 classes = (
     SL_OT_FixWeightmaps,
+    SL_OT_AuditWeights,
     SL_OT_ApplyModifiers,
     SL_OT_RenameBones,
     SL_OT_RemoveEmptyGroups,
     SL_OT_RemoveUnusedGroups,
     SL_OT_MeshExport,
+    SL_OT_MeshExportLODs,
 
     #SL_PT_MeshExportPanel,
 
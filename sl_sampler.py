@@ -0,0 +1,396 @@
+
+import bpy
+
+import os
+import copy
+import struct
+import zipfile
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from mathutils import Matrix, Vector, Euler, Quaternion
+
+from . import sl_const
+from . import tgor_util
+
+'''
+Sampling of armature poses for the SL animation export.
+
+Evaluating the timeline with frame_set is by far the most expensive part of an SL export,
+while the reduction and header settings of an action are comparatively cheap to apply.
+Sampled local transforms are therefore kept in a cache keyed by the action's fcurve data,
+the rig and the frame range so changing export settings only requires re-encoding.
+'''
+
+####################################################################################################
+############################################# REST POSE ############################################
+####################################################################################################
+
+# Rest pose constants of the SL joints of an armature, depend on armature data only
+class RestPose(object):
+    def __init__(self, armature, joints):
+        self.joints = tuple(joints)
+
+        # Matrices per joint for sampling with mathutils, offsets as array
+        self.transforms = []
+        self.bases = []
+        self.offsets = np.zeros((len(self.joints), 3), dtype=np.float32)
+
+        for index, joint in enumerate(self.joints):
+
+            # Get initial pose local transform
+            dataBone = armature.data.bones[joint]
+            dataChild = dataBone.matrix_local
+
+            # Get initial pose parent transform (assume origin if root)
+            if dataBone.parent:
+                dataParent = dataBone.parent.matrix_local
+                offset = dataChild.to_translation() - dataParent.to_translation()
+            else:
+                dataParent = Matrix()
+                offset = Vector((0,0,0))
+
+            self.transforms.append(dataChild.inverted() @ dataParent) # (PT^-1 * T)^-1 = T1^-1 * PT
+            self.bases.append(dataChild.to_3x3().to_4x4()) # Rotation (and scale) only
+            self.offsets[index] = offset
+
+        # Shared between exports, nobody may change them
+        self.offsets.flags.writeable = False
+
+# Rest poses by armature data, recomputed only when the rest pose of the armature changed
+class RestPoseCache(object):
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, armature, joints):
+        digest = hashlib.sha1()
+        restHash(armature, digest)
+        digest = digest.digest()
+
+        key = (armature.data.as_pointer(), tuple(joints))
+        entry = self.entries.get(key)
+        if entry and entry[0] == digest:
+            return entry[1]
+
+        rest = RestPose(armature, joints)
+        self.entries[key] = (digest, rest)
+        return rest
+
+    def clear(self):
+        self.entries.clear()
+
+restPoseCache = RestPoseCache()
+
+# Rest pose of the given joints, shared by all exports of the same armature data
+def restPose(armature, joints):
+    return restPoseCache.get(armature, joints)
+
+####################################################################################################
+############################################# SAMPLING #############################################
+####################################################################################################
+
+# Sampled curves of all joints, preallocated for every frame in the range
+class Samples(object):
+    def __init__(self, joints, totalFrames, offsets):
+        self.joints = tuple(joints)
+        self.frames = np.arange(totalFrames, dtype=np.int32)
+        self.sampled = np.zeros(totalFrames, dtype=bool)
+
+        # Frame x joint x (x,y,z) and (w,x,y,z)
+        self.locations = np.zeros((totalFrames, len(self.joints), 3), dtype=np.float32)
+        self.rotations = np.zeros((totalFrames, len(self.joints), 4), dtype=np.float32)
+
+        # Rest pose offset of each joint
+        self.offsets = np.array(offsets, dtype=np.float32).reshape((len(self.joints), 3))
+
+    # Drop frames that weren't sampled
+    def compress(self):
+        if not self.sampled.all():
+            self.frames = np.flatnonzero(self.sampled).astype(np.int32)
+            self.locations = self.locations[self.frames]
+            self.rotations = self.rotations[self.frames]
+        return self
+
+    # Rotate locations to SL space and normalise rotations, in place
+    def convertToSL(self):
+        rotate = np.array(sl_const.leftRot.to_3x3(), dtype=np.float32)
+        self.locations[...] = self.locations @ rotate.T
+        self.offsets[...] = self.offsets @ rotate.T
+        self.rotations /= np.linalg.norm(self.rotations, axis=-1, keepdims=True)
+        return self
+
+    # Swap left and right joints and reflect poses along the SL Y axis, expects samples in SL space
+    def mirrored(self):
+        skeleton = sl_const.skeleton
+        mirror = copy.copy(self)
+        mirror.joints = tuple(skeleton.names[skeleton.mirror[skeleton.index[joint]]] for joint in self.joints)
+
+        # Rotation axes are pseudovectors, so the components along the mirror plane flip instead
+        reflect = np.array([1.0, -1.0, 1.0], dtype=np.float32)
+        mirror.locations = self.locations * reflect
+        mirror.offsets = self.offsets * reflect
+        mirror.rotations = self.rotations * np.array([1.0, -1.0, 1.0, -1.0], dtype=np.float32)
+        return mirror
+
+    # Plain arrays only, so loading a file from a shared folder can't run any code
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, joints=np.array(self.joints, dtype=str), frames=self.frames, sampled=self.sampled, 
+                locations=self.locations, rotations=self.rotations, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            samples = cls(data['joints'].tolist(), len(data['sampled']), data['offsets'])
+            samples.frames = data['frames']
+            samples.sampled = data['sampled']
+            samples.locations = data['locations']
+            samples.rotations = data['rotations']
+        return samples
+
+# Sample local location and rotation of all joints at the currently evaluated frame into one row
+def samplePose(armature, rest, locations, rotations):
+    for index, name in enumerate(rest.joints):
+
+        # Get current pose and pose parent transform
+        poseBone = armature.pose.bones[name]
+        poseChild = poseBone.matrix
+        poseParent = poseBone.parent.matrix if poseBone.parent else Matrix()
+        poseTransform = poseParent.inverted() @ poseChild
+
+        # Transform in bone space
+        B = rest.bases[index]
+        T = rest.transforms[index] @ poseTransform
+        matrix = B @ T @ B.transposed() # Without scaling B^-1 = B^T
+
+        # poseTransform:        from "pose" to "pose parent" space
+        # rest.transforms:      from "data parent" to "data" space
+        # => T:                 from "pose" to "data" space
+
+        # B:                    from "data" to "global" space
+        # B':                   from "global" to "data" space
+        # => B * T * B':        from "global" to "global" space
+
+        # matrix: Difference between "pose" and "data" in global space
+
+        # Compute translation (rest offset is added for all joints at once)
+        locations[index] = matrix.to_translation()
+
+        # Compute rotation
+        rotations[index] = (sl_const.leftRot @ matrix @ sl_const.rightRot).to_quaternion()
+    locations += rest.offsets
+
+# Preallocate samples for all joints in a rest pose
+def allocateSamples(rest, totalFrames):
+    return Samples(rest.joints, totalFrames, rest.offsets)
+
+# Sample all joints over a frame range into samples, yields progress after every frame
+def iterSampleAction(context, armature, rest, frame_start, totalFrames, samples, timer=None):
+    timer = timer or tgor_util.PhaseTimer()
+    for frame in range(0, totalFrames):
+        with timer.phase('frame_set'):
+            tgor_util.exportSession.frameSet(context.scene, frame_start + frame)
+        with timer.phase('matrix'):
+            samplePose(armature, rest, samples.locations[frame], samples.rotations[frame])
+        samples.sampled[frame] = True
+        yield float(frame + 1) / totalFrames
+
+# Run a sampler to completion, the current frame is restored when the export session ends
+def runSampler(context, sampler, samples):
+    with tgor_util.exportSession.scope(context.scene):
+        for progress in sampler:
+            pass
+    return samples.compress().convertToSL()
+
+# Sample all joints over a frame range
+def sampleAction(context, armature, rest, frame_start, totalFrames):
+    samples = allocateSamples(rest, totalFrames)
+    return runSampler(context, iterSampleAction(context, armature, rest, frame_start, totalFrames, samples), samples)
+
+# Frames relative to frame_start that have a keyframe in any fcurve of the given actions, e.g. of the
+# action selected for export and the ones assigned to the rigs driving the sampled one
+def keyframeFrames(actions, frame_start, totalFrames):
+    frames = set()
+    for action in set(action for action in actions if action):
+        for fcurve in action.fcurves:
+            count = len(fcurve.keyframe_points)
+            coords = np.empty(count * 2, dtype=np.float32)
+            fcurve.keyframe_points.foreach_get('co', coords)
+            frames.update(int(round(x)) - frame_start for x in coords[0::2])
+    return {frame for frame in frames if 0 <= frame < totalFrames}
+
+# Largest difference of a pose to the linear interpolation between two other poses
+def poseDeviation(samples, first, last, middle, ratio):
+
+    # Same linear curve model that is used when optimising the curves
+    deviation = 0.0
+    for curves in (samples.locations, samples.rotations):
+        linear = curves[first] + (curves[last] - curves[first]) * ratio
+        deviation = max(deviation, float(np.max(np.linalg.norm(linear - curves[middle], axis=-1), initial=0.0)))
+    return deviation
+
+# Sample keyframes and coarse intervals first, then refine spans that aren't linear within threshold
+def iterSampleAdaptive(context, armature, rest, frame_start, totalFrames, keyframes, step, threshold, samples, timer=None):
+    timer = timer or tgor_util.PhaseTimer()
+
+    def evaluate(frame):
+        with timer.phase('frame_set'):
+            tgor_util.exportSession.frameSet(context.scene, frame_start + frame)
+        with timer.phase('matrix'):
+            samplePose(armature, rest, samples.locations[frame], samples.rotations[frame])
+        samples.sampled[frame] = True
+
+    # Always include range borders
+    frames = sorted(set(range(0, totalFrames, step)) | set(keyframes) | {0, totalFrames - 1})
+    for index, frame in enumerate(frames):
+        evaluate(frame)
+        yield float(index + 1) / totalFrames
+    
+    # Bisect spans until every sampled midpoint is explained by its neighbours
+    evaluated = len(frames)
+    spans = [(first, last) for first, last in zip(frames[:-1], frames[1:]) if last - first > 1]
+    while spans:
+        first, last = spans.pop()
+        middle = (first + last) // 2
+        evaluate(middle)
+        evaluated += 1
+
+        ratio = float(middle - first) / (last - first)
+        with timer.phase('refine'):
+            deviation = poseDeviation(samples, first, last, middle, ratio)
+        if deviation > threshold:
+            spans += [(a, b) for a, b in ((first, middle), (middle, last)) if b - a > 1]
+
+        # Remaining spans need at least one more evaluation each
+        yield float(evaluated) / min(evaluated + len(spans), totalFrames)
+
+# Sample keyframes and coarse intervals first, then refine where needed
+def sampleAdaptive(context, armature, rest, frame_start, totalFrames, keyframes, step, threshold):
+    samples = allocateSamples(rest, totalFrames)
+    return runSampler(context, iterSampleAdaptive(context, armature, rest, frame_start, totalFrames, keyframes, step, threshold, samples), samples)
+
+####################################################################################################
+############################################# CACHE ################################################
+####################################################################################################
+
+# Hash keyframes, handles and modifiers of all fcurves in an action
+def actionHash(action, digest):
+    for fcurve in action.fcurves:
+        digest.update(fcurve.data_path.encode())
+        digest.update(struct.pack("<i?", fcurve.array_index, fcurve.mute))
+
+        count = len(fcurve.keyframe_points)
+        for attribute in ('co', 'handle_left', 'handle_right'):
+            values = np.empty(count * 2, dtype=np.float32)
+            fcurve.keyframe_points.foreach_get(attribute, values)
+            digest.update(values.tobytes())
+
+        digest.update("".join(point.interpolation + point.easing for point in fcurve.keyframe_points).encode())
+        digest.update("".join(modifier.type for modifier in fcurve.modifiers).encode())
+
+# Hash rest pose of an armature
+def restHash(armature, digest):
+    bones = armature.data.bones
+    matrices = np.empty(len(bones) * 16, dtype=np.float32)
+    bones.foreach_get('matrix_local', matrices)
+    digest.update(",".join(bone.name for bone in bones).encode())
+    digest.update(matrices.tobytes())
+
+# Hash everything that animates an object: assigned action, NLA strips, drivers and bone constraints
+def animationHash(obj, digest):
+    animationData = obj.animation_data
+    if animationData:
+        if animationData.action:
+            actionHash(animationData.action, digest)
+
+        for track in animationData.nla_tracks:
+            digest.update(repr((track.name, track.mute, track.is_solo)).encode())
+            for strip in track.strips:
+                digest.update(repr((strip.name, strip.mute, strip.frame_start, strip.frame_end, strip.action_frame_start,
+                    strip.action_frame_end, strip.scale, strip.repeat, strip.blend_type, strip.influence)).encode())
+                if strip.action:
+                    actionHash(strip.action, digest)
+
+        for fcurve in animationData.drivers:
+            driver = fcurve.driver
+            variables = [(variable.name, variable.type, [(target.id.name if target.id else None, target.data_path, target.bone_target, 
+                target.transform_type, target.transform_space) for target in variable.targets]) for variable in driver.variables]
+            digest.update(repr((fcurve.data_path, fcurve.array_index, fcurve.mute, driver.type, driver.expression, variables)).encode())
+
+    if obj.pose:
+        for poseBone in obj.pose.bones:
+            for constraint in poseBone.constraints:
+                digest.update(repr((poseBone.name, constraint.type, tgor_util.rnaSettings(constraint))).encode())
+
+# Build cache key from the sampled rig, the frame range and sampling options. The sampled rig is usually
+# driven by another one (e.g. the deform rig follows the control rig through constraints), so the action
+# selected for export and the animation of those source rigs are part of the key as well.
+def sampleKey(armature, frame_start, frame_end, joints, options="", action=None, sources=()):
+    digest = hashlib.sha1()
+    digest.update(armature.name.encode())
+    digest.update(struct.pack("<ii", frame_start, frame_end))
+    digest.update(options.encode())
+    digest.update(",".join(joints).encode())
+    restHash(armature, digest)
+
+    if action:
+        digest.update(action.name.encode())
+        actionHash(action, digest)
+
+    for obj in [armature] + [source for source in sources if source and source != armature]:
+        digest.update(obj.name.encode())
+        animationHash(obj, digest)
+    return digest.hexdigest()
+
+class SampleCache(object):
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def path(self, key, folder):
+        return os.path.join(bpy.path.abspath(folder), ".slcache", key + ".npz")
+
+    def get(self, key, folder=None):
+
+        # Look in memory first
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        # Fall back to disk if desired
+        if folder:
+            path = self.path(key, folder)
+            if os.path.isfile(path):
+                # Ignore broken files and files written in an older format
+                try:
+                    samples = Samples.load(path)
+                except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                    return None
+                self.put(key, samples)
+                return samples
+        return None
+
+    def put(self, key, samples, folder=None):
+        self.entries[key] = samples
+        self.entries.move_to_end(key)
+
+        # Forget least recently used entries
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+        if folder:
+            path = self.path(key, folder)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            samples.save(path)
+
+    def clear(self, folder=None):
+        self.entries.clear()
+
+        if folder:
+            directory = os.path.dirname(self.path("", folder))
+            if os.path.isdir(directory):
+                for filename in os.listdir(directory):
+                    if filename.endswith((".npz", ".pickle")):
+                        os.remove(os.path.join(directory, filename))
+
+sampleCache = SampleCache()
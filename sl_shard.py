@@ -0,0 +1,157 @@
+
+'''
+Samples a frame range of an armature in a background Blender, the SL animation export starts one
+of these per shard to split long actions over several processes:
+
+blender -b copy.blend --python sl_shard.py -- --armature Rig --frame-start 100 --frames 250 --output shard.npz
+
+Samples are written unconverted, the exporting instance merges all shards and converts them to SL.
+'''
+
+import sys
+import os
+
+if __name__ == "__main__":
+
+    # Run as script: hand over to this module inside the add-on package so relative imports work
+    import importlib
+    import addon_utils
+
+    package = None
+    for module in addon_utils.modules():
+        if module.bl_info.get("name") == "TGOR Animation and Export Toolset":
+            addon_utils.enable(module.__name__, default_set=False)
+            package = module.__name__
+            break
+
+    # Add-on isn't installed, import it from where this script is
+    if not package:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        sys.path.insert(0, os.path.dirname(directory))
+        package = os.path.basename(directory)
+        importlib.import_module(package).register()
+
+    sys.exit(importlib.import_module(package + ".sl_shard").main())
+
+import bpy
+
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+from . import sl_const
+from . import sl_sampler
+from . import tgor_launcher
+from . import tgor_util
+
+# Script executed inside of each background Blender instance
+shardScript = os.path.abspath(__file__)
+
+# Printed after every sampled frame so the exporting instance can show progress
+progressPrefix = "SL shard frame"
+
+# Starting a background Blender costs seconds, shorter shards aren't worth it
+minShardFrames = 250
+
+class ShardError(Exception):
+    pass
+
+####################################################################################################
+############################################# EXPORTER #############################################
+####################################################################################################
+
+# Number of shards worth using for a frame range, sampling in this instance is better below 2
+def shardCount(totalFrames, processes):
+    return min(processes, totalFrames // minShardFrames)
+
+# Sample contiguous frame ranges in background Blender processes working on a saved copy of the file,
+# then merge them into samples. Yields progress while waiting so it can run in a modal operator.
+def iterSampleShards(context, armature, rest, frame_start, totalFrames, samples, processes, timer=None):
+    timer = timer or tgor_util.PhaseTimer()
+    directory = tempfile.mkdtemp(prefix="slshard")
+    jobs = []
+    try:
+        with timer.phase('save'):
+            blendFile = os.path.join(directory, "shard.blend")
+            bpy.ops.wm.save_as_mainfile(filepath=blendFile, copy=True)
+
+        # Split range into shards of about equal length
+        bounds = np.linspace(0, totalFrames, shardCount(totalFrames, processes) + 1).astype(int)
+        for index, (first, last) in enumerate(zip(bounds[:-1].tolist(), bounds[1:].tolist())):
+            output = os.path.join(directory, "shard%d.npz" % (index))
+            arguments = ["--armature", armature.name, "--frame-start", str(frame_start + first), "--frames", str(last - first), "--output", output]
+            job = tgor_launcher.Job(blendFile, tgor_launcher.blenderCommand(bpy.app.binary_path, blendFile, shardScript, arguments))
+            try:
+                job.start(os.path.join(directory, "shard%d.log" % (index)))
+            except OSError as error:
+                raise ShardError("Couldn't start %s: %s" % (bpy.app.binary_path, error))
+
+            # Only started jobs need to be killed
+            jobs.append((job, first, last, output))
+
+        # Wait for all processes, time spent waiting is what sampling costs this instance
+        start = time.perf_counter()
+        while None in [job.poll() for job, _, _, _ in jobs]:
+            sampled = sum(job.output.count(progressPrefix) for job, _, _, _ in jobs)
+            time.sleep(0.01)
+            yield min(float(sampled) / totalFrames, 0.99)
+        timer.add('shards', time.perf_counter() - start)
+
+        with timer.phase('merge'):
+            for job, first, last, output in jobs:
+                if not job.succeeded() or not os.path.isfile(output):
+                    raise ShardError("Sampling frames %d to %d failed:\n%s" % (frame_start + first, frame_start + last - 1, job.output[-2000:]))
+
+                with np.load(output) as shard:
+                    if tuple(shard['joints'].tolist()) != samples.joints:
+                        raise ShardError("Sampled joints of frames %d to %d don't match" % (frame_start + first, frame_start + last - 1))
+                    samples.locations[first:last] = shard['locations']
+                    samples.rotations[first:last] = shard['rotations']
+                samples.sampled[first:last] = True
+        yield 1.0
+
+    # Also runs when the export is cancelled
+    finally:
+        for job, _, _, _ in jobs:
+            job.kill()
+        shutil.rmtree(directory, ignore_errors=True)
+
+####################################################################################################
+############################################# WORKER ###############################################
+####################################################################################################
+
+# Sample a frame range of an armature and save it as .npz
+def sampleShard(context, armature, frame_start, totalFrames, output):
+    joints = [bone.name for bone in armature.pose.bones if bone.name in sl_const.skeleton.bones]
+    rest = sl_sampler.restPose(armature, joints)
+    samples = sl_sampler.allocateSamples(rest, totalFrames)
+
+    for frame, progress in enumerate(sl_sampler.iterSampleAction(context, armature, rest, frame_start, totalFrames, samples)):
+        print("%s %d" % (progressPrefix, frame_start + frame), flush=True)
+
+    np.savez(output, joints=np.array(samples.joints), locations=samples.locations, rotations=samples.rotations)
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog="sl_shard", description="Sample a frame range of an armature for the SL animation export")
+    parser.add_argument("--armature", required=True, help="Armature object to sample")
+    parser.add_argument("--frame-start", type=int, required=True, help="First frame to sample")
+    parser.add_argument("--frames", type=int, required=True, help="Number of frames to sample")
+    parser.add_argument("--output", required=True, help=".npz file to write samples to")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+
+    # Blender's own arguments end at "--"
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parseArguments(argv)
+
+    armature = bpy.data.objects.get(args.armature)
+    if not armature or armature.type != 'ARMATURE':
+        print("Armature %s doesn't exist" % (args.armature))
+        return 1
+
+    sampleShard(bpy.context, armature, args.frame_start, args.frames, args.output)
+    return 0
@@ -0,0 +1,188 @@
+'''
+Round trip test of the SL collada writer, run in a background Blender:
+
+blender -b --factory-startup --python tests/sl_collada_roundtrip.py
+
+Builds a transformed rig with a non-deform bone between two deform bones and a skinned mesh parented
+to it, writes them with the writer the SL mesh export uses and checks that the document is consistent:
+every skin joint has a joint node, vcount covers every vertex and v only points at existing joints and
+weights. The file is then imported with Blender's collada importer and compared vertex by vertex.
+'''
+
+import sys
+import os
+import shutil
+import tempfile
+import importlib
+import xml.etree.ElementTree as ET
+
+import bpy
+import numpy as np
+
+# Test this checkout rather than whatever version of the add-on is installed
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+namespace = {'c': "http://www.collada.org/2005/11/COLLADASchema"}
+
+#-----------------------------------
+# Bone name: (head, tail, parent, deform), 'ctrl' has weights but isn't a joint
+fixtureRig = {
+    'mPelvis': ((0.0, 0.0, 1.0), (0.0, 0.0, 1.1), None, True),
+    'mTorso': ((0.0, 0.0, 1.1), (0.0, 0.02, 1.3), 'mPelvis', True),
+    'ctrl': ((0.0, 0.02, 1.3), (0.0, 0.3, 1.3), 'mTorso', False),
+    'mChest': ((0.0, 0.02, 1.3), (0.0, 0.0, 1.5), 'ctrl', True),
+}
+
+def buildRig(context):
+    armature = bpy.data.objects.new("Rig", bpy.data.armatures.new("Rig"))
+    context.scene.collection.objects.link(armature)
+    context.view_layer.objects.active = armature
+    armature.location = (0.3, -0.2, 0.1)
+    armature.rotation_euler = (0.0, 0.0, 0.4)
+
+    bpy.ops.object.mode_set(mode='EDIT')
+    for bone, (head, tail, parent, deform) in fixtureRig.items():
+        editBone = armature.data.edit_bones.new(bone)
+        editBone.head = head
+        editBone.tail = tail
+        editBone.use_deform = deform
+    for bone, (head, tail, parent, deform) in fixtureRig.items():
+        if parent:
+            armature.data.edit_bones[bone].parent = armature.data.edit_bones[parent]
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return armature
+
+# Cylinder along the rig, weighted to the bones by height
+def buildMesh(context, armature):
+    bpy.ops.mesh.primitive_cylinder_add(vertices=12, radius=0.2, depth=0.6, location=(0.0, 0.0, 1.25))
+    obj = context.active_object
+    obj.name = "Body"
+    obj.parent = armature
+    obj.location = (0.05, 0.0, 0.02)
+
+    heights = np.array([vertex.co.z for vertex in obj.data.vertices])
+    for name, center in (('mPelvis', -0.3), ('mTorso', 0.0), ('ctrl', 0.1), ('mChest', 0.3)):
+        group = obj.vertex_groups.new(name=name)
+        for index, height in enumerate(heights):
+            weight = max(0.0, 1.0 - abs(height - center) / 0.4)
+            if weight > 0.0:
+                group.add([index], weight, 'REPLACE')
+
+    modifier = obj.modifiers.new("Armature", 'ARMATURE')
+    modifier.object = armature
+    return obj
+
+#-----------------------------------
+# Check that skins, joints and joint nodes of a written document fit together, returns list of problems
+def checkDocument(filePath):
+    problems = []
+    root = ET.parse(filePath).getroot()
+
+    nodes = {node.get('sid') for node in root.iterfind('.//c:node[@type="JOINT"]', namespace)}
+    ids = {node.get('id') for node in root.iterfind('.//c:node', namespace)}
+    for skeleton in root.iterfind('.//c:skeleton', namespace):
+        if skeleton.text.lstrip('#') not in ids:
+            problems.append("skeleton %s has no node" % (skeleton.text))
+
+    for controller in root.iterfind('.//c:controller', namespace):
+        skin = controller.find('c:skin', namespace)
+        geometry = root.find('.//c:geometry[@id="%s"]' % (skin.get('source').lstrip('#')), namespace)
+        positions = geometry.find('.//c:source[@id="%s"]/c:float_array' % (geometry.get('id').replace("-mesh", "-positions")), namespace)
+        vertexCount = int(positions.get('count')) // 3
+
+        joints = skin.find('.//c:Name_array', namespace).text.split()
+        binds = skin.find('.//c:source[@id="%s"]/c:float_array' % (skin.get('source').lstrip('#').replace("-mesh", "-skin-bind_poses")), namespace)
+        weightCount = int(skin.find('.//c:source[@id="%s"]/c:float_array' % (skin.get('source').lstrip('#').replace("-mesh", "-skin-weights")), namespace).get('count'))
+
+        for joint in joints:
+            if joint not in nodes:
+                problems.append("%s: skin joint %s has no joint node" % (controller.get('id'), joint))
+        if int(binds.get('count')) != 16 * len(joints):
+            problems.append("%s: %s bind pose values for %d joints" % (controller.get('id'), binds.get('count'), len(joints)))
+
+        vertexWeights = skin.find('c:vertex_weights', namespace)
+        vcount = np.array(vertexWeights.find('c:vcount', namespace).text.split(), dtype=int)
+        v = np.array(vertexWeights.find('c:v', namespace).text.split(), dtype=int).reshape((-1, 2))
+        if int(vertexWeights.get('count')) != vertexCount or len(vcount) != vertexCount:
+            problems.append("%s: vcount has %d entries for %d vertices" % (controller.get('id'), len(vcount), vertexCount))
+        if vcount.sum() != len(v):
+            problems.append("%s: vcount adds up to %d, v has %d pairs" % (controller.get('id'), vcount.sum(), len(v)))
+        if len(v) and (v[:, 0].max() >= len(joints) or v[:, 0].min() < 0):
+            problems.append("%s: v points at joints beyond %d" % (controller.get('id'), len(joints)))
+        if len(v) and v[:, 1].max() >= weightCount:
+            problems.append("%s: v points at weights beyond %d" % (controller.get('id'), weightCount))
+    return problems
+
+# World space positions and weights by group name of every vertex
+def vertexState(obj):
+    positions = np.array([obj.matrix_world @ vertex.co for vertex in obj.data.vertices])
+    names = [group.name for group in obj.vertex_groups]
+    weights = [{names[group.group]: group.weight for group in vertex.groups} for vertex in obj.data.vertices]
+    return positions, weights
+
+# Import the document and compare it against the exported mesh, returns list of problems
+def checkImport(context, filePath, obj, orientation):
+    problems = []
+    before = set(bpy.data.objects)
+    bpy.ops.wm.collada_import(filepath=filePath)
+    imported = [new for new in set(bpy.data.objects) - before if new.type == 'MESH']
+    if len(imported) != 1:
+        return ["expected one imported mesh, got %d" % (len(imported))]
+    context.view_layer.update()
+
+    positions, weights = vertexState(obj)
+    importedPositions, importedWeights = vertexState(imported[0])
+    if len(positions) != len(importedPositions):
+        return ["%d vertices imported, %d exported" % (len(importedPositions), len(positions))]
+
+    # The writer turns everything into SL orientation
+    expected = positions @ orientation[:3, :3].T + orientation[:3, 3]
+    error = np.abs(expected - importedPositions).max()
+    if error > 1e-4:
+        problems.append("vertices moved by up to %.5f" % (error))
+
+    for index, (exported, actual) in enumerate(zip(weights, importedWeights)):
+        exported = {name: weight for name, weight in exported.items() if fixtureRig[name][3]}
+        actual = {name: weight for name, weight in actual.items() if weight > 0.0}
+        if exported.keys() != actual.keys() or any(abs(exported[name] - actual[name]) > 1e-5 for name in exported):
+            problems.append("vertex %d weights: %s != %s" % (index, exported, actual))
+    return problems[:20]
+
+def main():
+    context = bpy.context
+    armature = buildRig(context)
+    obj = buildMesh(context, armature)
+
+    failed = 0
+    folder = tempfile.mkdtemp(prefix="slcollada")
+    copies = tgor_util.ExportCopies(context, [obj], [armature])
+    try:
+        filePath = os.path.join(folder, "roundtrip.dae")
+        copy = copies.get(obj)
+        sl_collada.writeCollada(filePath, copies.get(armature), [sl_collada.SkinnedMesh(copy, tgor_util.readWeights(copy))], {})
+
+        for name, check in (('document', lambda: checkDocument(filePath)), ('import', lambda: checkImport(context, filePath, copy, sl_collada.colladaOrientation))):
+            problems = check()
+            print("%s: %s" % (name, "FAILED" if problems else "OK"))
+            for problem in problems:
+                print("    " + problem)
+            failed += 1 if problems else 0
+    finally:
+        copies.cleanup()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+
+    # Start from an empty file so the fixture doesn't collide with anything
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+
+    sys.path.insert(0, os.path.dirname(repository))
+    package = importlib.import_module(os.path.basename(repository))
+    package.register()
+
+    tgor_util = importlib.import_module(package.__name__ + ".tgor_util")
+    sl_collada = importlib.import_module(package.__name__ + ".sl_collada")
+
+    sys.exit(main())
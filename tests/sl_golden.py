@@ -0,0 +1,228 @@
+
+'''
+Golden file regression test of the SL animation export math, run in a background Blender:
+
+blender -b --factory-startup --python tests/sl_golden.py -- [--update] [--fixtures wave walk]
+
+Every fixture builds a small rig and action from scratch, samples and encodes it with the same code
+the SL export uses and compares the result key by key against tests/golden/<fixture>.anim, allowing
+one quantization step of difference. After verifying new exports in SL, --update rewrites the goldens.
+'''
+
+import sys
+import os
+import math
+import shutil
+import argparse
+import tempfile
+import importlib
+
+import bpy
+from mathutils import Euler, Vector
+
+# Test this checkout rather than whatever version of the add-on is installed
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+goldenFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+#-----------------------------------
+# Bone name: (head, tail, roll, parent), rolls and angles are deliberately uneven so the
+# bone space conversion can't get away with axis mixups
+fixtureRig = {
+    'mPelvis': ((0.0, 0.0, 1.0), (0.0, 0.0, 1.1), 0.0, None),
+    'mTorso': ((0.0, 0.0, 1.1), (0.0, 0.02, 1.3), 0.1, 'mPelvis'),
+    'mChest': ((0.0, 0.02, 1.3), (0.0, 0.0, 1.5), 0.0, 'mTorso'),
+    'mNeck': ((0.0, 0.0, 1.5), (0.0, -0.02, 1.6), 0.0, 'mChest'),
+    'mHead': ((0.0, -0.02, 1.6), (0.0, -0.02, 1.75), 0.0, 'mNeck'),
+    'mCollarLeft': ((0.05, 0.0, 1.45), (0.15, 0.01, 1.46), 0.3, 'mChest'),
+    'mShoulderLeft': ((0.15, 0.01, 1.46), (0.4, 0.02, 1.44), -0.2, 'mCollarLeft'),
+    'mElbowLeft': ((0.4, 0.02, 1.44), (0.65, -0.05, 1.43), 0.5, 'mShoulderLeft'),
+    'mCollarRight': ((-0.05, 0.0, 1.45), (-0.15, 0.01, 1.46), -0.3, 'mChest'),
+    'mShoulderRight': ((-0.15, 0.01, 1.46), (-0.4, 0.02, 1.44), 0.2, 'mCollarRight'),
+    'mElbowRight': ((-0.4, 0.02, 1.44), (-0.65, -0.05, 1.43), -0.5, 'mShoulderRight'),
+    'mHipLeft': ((0.1, 0.0, 1.0), (0.1, 0.0, 0.55), 0.0, 'mPelvis'),
+    'mHipRight': ((-0.1, 0.0, 1.0), (-0.1, 0.0, 0.55), 0.0, 'mPelvis'),
+}
+
+# Keys of a fixture action: bone: [(frame, euler rotation, location)]
+def waveKeys():
+    keys = {}
+    keys['mShoulderLeft'] = [(frame, (0.0, -0.3, 0.4 + 0.6 * math.sin(frame / 4.0)), None) for frame in range(1, 25, 3)]
+    keys['mElbowLeft'] = [(frame, (0.2 * math.cos(frame / 3.0), 0.0, 1.2), None) for frame in range(1, 25, 4)]
+    keys['mHead'] = [(1, (0.0, 0.0, 0.0), None), (12, (0.1, 0.2, -0.1), None), (24, (0.0, 0.0, 0.0), None)]
+    return keys
+
+def walkKeys():
+    keys = {}
+    keys['mPelvis'] = [(frame, (0.0, 0.0, 0.05 * math.sin(frame / 2.0)), (0.0, 0.0, 0.03 * abs(math.sin(frame / 4.0)))) for frame in range(1, 33, 2)]
+    keys['mTorso'] = [(frame, (0.05, 0.0, -0.08 * math.sin(frame / 2.0)), None) for frame in range(1, 33, 4)]
+    keys['mHipLeft'] = [(frame, (0.5 * math.sin(frame / 4.0), 0.0, 0.0), None) for frame in range(1, 33, 2)]
+    keys['mHipRight'] = [(frame, (-0.5 * math.sin(frame / 4.0), 0.0, 0.0), None) for frame in range(1, 33, 2)]
+    keys['mShoulderLeft'] = [(frame, (-0.3 * math.sin(frame / 4.0), 0.0, -1.2), None) for frame in range(1, 33, 4)]
+    keys['mShoulderRight'] = [(frame, (0.3 * math.sin(frame / 4.0), 0.0, 1.2), None) for frame in range(1, 33, 4)]
+    return keys
+
+# Fixture name: (keys, frame range, export settings)
+fixtures = {
+    'wave': (waveKeys, (1, 24), {'optimisation': True, 'threshold': 0.0001, 'mirror': True}),
+    'wave_raw': (waveKeys, (1, 24), {'optimisation': False}),
+    'walk': (walkKeys, (1, 32), {'optimisation': True, 'threshold': 0.001, 'loop': True, 'priority': 4}),
+}
+
+#-----------------------------------
+def buildRig(context, name):
+    armature = bpy.data.objects.new(name, bpy.data.armatures.new(name))
+    context.scene.collection.objects.link(armature)
+    context.view_layer.objects.active = armature
+
+    bpy.ops.object.mode_set(mode='EDIT')
+    for bone, (head, tail, roll, parent) in fixtureRig.items():
+        editBone = armature.data.edit_bones.new(bone)
+        editBone.head = head
+        editBone.tail = tail
+        editBone.roll = roll
+    for bone, (head, tail, roll, parent) in fixtureRig.items():
+        if parent:
+            armature.data.edit_bones[bone].parent = armature.data.edit_bones[parent]
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return armature
+
+def buildAction(armature, name, keys):
+    armature.animation_data_create()
+    action = bpy.data.actions.new(name)
+    armature.animation_data.action = action
+
+    for bone, boneKeys in keys.items():
+        poseBone = armature.pose.bones[bone]
+        poseBone.rotation_mode = 'QUATERNION'
+        for frame, rotation, location in boneKeys:
+            poseBone.rotation_quaternion = Euler(rotation).to_quaternion()
+            poseBone.keyframe_insert("rotation_quaternion", frame=frame)
+            if location:
+                poseBone.location = Vector(location)
+                poseBone.keyframe_insert("location", frame=frame)
+    return action
+
+# Export a fixture the way the SL export does, returns written .anim files
+def exportFixture(context, name, folder):
+    keys, (frame_start, frame_end), settings = fixtures[name]
+    armature = buildRig(context, name)
+    action = buildAction(armature, name, keys())
+    for attribute, value in settings.items():
+        setattr(action.sl_animation_export, attribute, value)
+
+    joints = [bone.name for bone in armature.pose.bones if bone.name in sl_const.skeleton.bones]
+    totalFrames = frame_end - frame_start + 1
+    rest = sl_sampler.restPose(armature, joints)
+    samples = sl_sampler.sampleAction(context, armature, rest, frame_start, totalFrames)
+    bones = sl_animation.boneSettings(context, action, joints)
+    files = sl_animation.writeAnimations(action, bones, samples, frame_start, totalFrames, context.scene.render.fps, os.path.join(folder, name))
+
+    # Leave nothing behind for the next fixture
+    data = armature.data
+    bpy.data.objects.remove(armature)
+    bpy.data.armatures.remove(data)
+    bpy.data.actions.remove(action)
+    return files
+
+#-----------------------------------
+# Compare two anims key by key, returns list of differences
+def compareAnims(expected, actual):
+    positionStep = 2.0 * sl_animexport.LL_MAX_PELVIS_OFFSET * sl_animexport.OOU16MAX
+    rotationStep = 2.0 * sl_animexport.OOU16MAX
+    differences = []
+
+    for field in ('version', 'sub_version', 'base_priority', 'loop', 'hand_pose'):
+        if getattr(expected, field) != getattr(actual, field):
+            differences.append("%s: %s != %s" % (field, getattr(expected, field), getattr(actual, field)))
+    for field in ('duration', 'loop_in_point', 'loop_out_point', 'ease_in_duration', 'ease_out_duration'):
+        if abs(getattr(expected, field) - getattr(actual, field)) > 1e-5:
+            differences.append("%s: %.5f != %.5f" % (field, getattr(expected, field), getattr(actual, field)))
+
+    expectedJoints = [joint.joint_name for joint in expected.joints]
+    actualJoints = [joint.joint_name for joint in actual.joints]
+    if expectedJoints != actualJoints:
+        differences.append("joints: %s != %s" % (expectedJoints, actualJoints))
+        return differences
+
+    for expectedJoint, actualJoint in zip(expected.joints, actual.joints):
+        name = expectedJoint.joint_name
+        if expectedJoint.joint_priority != actualJoint.joint_priority:
+            differences.append("%s priority: %d != %d" % (name, expectedJoint.joint_priority, actualJoint.joint_priority))
+
+        curves = (
+            ('position', expectedJoint.position_curve.keys, actualJoint.position_curve.keys, lambda key: key.position, positionStep),
+            ('rotation', expectedJoint.rotation_curve.keys, actualJoint.rotation_curve.keys, lambda key: key.rotation, rotationStep))
+        for curve, expectedKeys, actualKeys, value, step in curves:
+            if len(expectedKeys) != len(actualKeys):
+                differences.append("%s %s keys: %d != %d" % (name, curve, len(expectedKeys), len(actualKeys)))
+                continue
+
+            for index, (expectedKey, actualKey) in enumerate(zip(expectedKeys, actualKeys)):
+                if abs(expectedKey.time_short - actualKey.time_short) > 1:
+                    differences.append("%s %s key %d time: %d != %d" % (name, curve, index, expectedKey.time_short, actualKey.time_short))
+                error = max(abs(a - b) for a, b in zip(value(expectedKey), value(actualKey)))
+                if error > step * 1.5:
+                    differences.append("%s %s key %d: %s != %s" % (name, curve, index,
+                        ", ".join("%.4f" % v for v in value(expectedKey)), ", ".join("%.4f" % v for v in value(actualKey))))
+    return differences
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog="sl_golden", description="Compare SL animation exports of fixture rigs against golden files")
+    parser.add_argument("--update", action='store_true', help="Write exports as new golden files instead of comparing")
+    parser.add_argument("--fixtures", nargs='+', choices=sorted(fixtures.keys()), default=sorted(fixtures.keys()), help="Fixtures to run (default: all)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+
+    # Blender's own arguments end at "--"
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parseArguments(argv)
+
+    context = bpy.context
+    context.scene.render.fps = 24
+
+    failed = 0
+    folder = tempfile.mkdtemp(prefix="slgolden")
+    try:
+        for name in args.fixtures:
+            for filePath in exportFixture(context, name, folder):
+                filename = os.path.basename(filePath)
+                goldenPath = os.path.join(goldenFolder, filename)
+
+                if args.update:
+                    os.makedirs(goldenFolder, exist_ok=True)
+                    shutil.copyfile(filePath, goldenPath)
+                    print("%s: updated" % (filename))
+                    continue
+
+                if not os.path.isfile(goldenPath):
+                    print("%s: FAILED, no golden file (run with --update)" % (filename))
+                    failed += 1
+                    continue
+
+                differences = compareAnims(sl_animexport.Anim(goldenPath), sl_animexport.Anim(filePath))
+                print("%s: %s" % (filename, "FAILED" if differences else "OK"))
+                for difference in differences[:20]:
+                    print("    " + difference)
+                failed += 1 if differences else 0
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+
+    # Start from an empty file so fixtures don't collide with anything
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+
+    sys.path.insert(0, os.path.dirname(repository))
+    package = importlib.import_module(os.path.basename(repository))
+    package.register()
+
+    sl_const = importlib.import_module(package.__name__ + ".sl_const")
+    sl_sampler = importlib.import_module(package.__name__ + ".sl_sampler")
+    sl_animation = importlib.import_module(package.__name__ + ".sl_animation")
+    sl_animexport = importlib.import_module(package.__name__ + ".sl_animexport")
+
+    sys.exit(main())
@@ -0,0 +1,180 @@
+
+'''
+Headless export of characters without relying on UI selection state, run inside Blender with
+
+blender -b file.blend --python tgor_batch.py -- --character Name --actions "Walk*" --formats sl_anim sl_mesh ue_anim
+
+The characters, actions and meshes are selected the same way a user would in the panels, then
+the regular export operators are called. See tgor_launcher to run many .blend files in parallel.
+'''
+
+import sys
+import os
+
+if __name__ == "__main__":
+
+	# Run as script: hand over to this module inside the add-on package so relative imports work
+	import importlib
+	import addon_utils
+
+	package = None
+	for module in addon_utils.modules():
+		if module.bl_info.get("name") == "TGOR Animation and Export Toolset":
+			addon_utils.enable(module.__name__, default_set=False)
+			package = module.__name__
+			break
+
+	# Add-on isn't installed, import it from where this script is
+	if not package:
+		directory = os.path.dirname(os.path.abspath(__file__))
+		sys.path.insert(0, os.path.dirname(directory))
+		package = os.path.basename(directory)
+		importlib.import_module(package).register()
+
+	sys.exit(importlib.import_module(package + ".tgor_batch").main())
+
+import bpy
+
+import argparse
+import fnmatch
+
+from . import sl_mesh
+from . import tgor_character
+from . import tgor_util
+
+# Export formats and the operators that handle them
+exportOperators = {
+	'sl_anim': "object.sl_animation_export",
+	'sl_mesh': "object.sl_mesh_export",
+	'ue_anim': "object.tgor_export_character_animation",
+	'sl_ue_anim': "object.tgor_export_character_animation_combined",
+	'ue_mesh': "object.tgor_export_character_skel_mesh",
+}
+
+animationFormats = ('sl_anim', 'ue_anim', 'sl_ue_anim')
+meshFormats = ('sl_mesh', 'ue_mesh')
+
+#-----------------------------------
+# Select character the same way the character panel does
+def selectCharacter(context, name):
+	if context.scene.tgor_character_selection.characters.get(name) is None:
+		return None
+
+	context.scene.tgor_character_selection.characters_selection = name
+	return tgor_character.CharacterReferenceHandler(context)
+
+# Assign action to the character's control rig and select it in the action list
+def selectAction(context, charRefHndlr, action):
+	charRefHndlr.animationData.action = action
+	charRefHndlr.action = action
+	context.scene.tgor_character_selection.action_selection = bpy.data.actions.find(action.name)
+	tgor_character.rangeUpdateCallback(None, context)
+	tgor_util.exportSession.invalidate()
+
+	# The SL exporter samples the active object
+	tgor_util.exitPoseMode(context)
+	for ob in context.selected_objects:
+		ob.select_set(False)
+	context.view_layer.objects.active = charRefHndlr.controlRig
+	charRefHndlr.controlRig.select_set(True)
+
+# Fill the mesh selection enums like the export panel would
+def selectMeshes(context, charRefHndlr, patterns):
+	meshes = [ob.name for ob in charRefHndlr.characterScene.objects if tgor_util.exportableMesh(charRefHndlr.deformRig, ob)]
+	sl_mesh.meshlist = sorted([(name, name, "") for name in meshes])
+
+	selected = {name for name in meshes if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)}
+	names = [name for name, _, _ in sl_mesh.meshlist]
+	settings = context.window_manager.sl_mesh_export
+	settings.meshesA = selected.intersection(names[:32])
+	settings.meshesB = selected.intersection(names[32:64])
+	settings.meshesC = selected.intersection(names[64:96])
+	settings.meshesD = selected.intersection(names[96:128])
+	return sorted(selected)
+
+# Run an export operator with properties, returns whether it finished
+def runExport(exportFormat, **properties):
+	operator = bpy.ops
+	for part in exportOperators[exportFormat].split("."):
+		operator = getattr(operator, part)
+
+	try:
+		return 'FINISHED' in operator('EXEC_DEFAULT', **properties)
+	except RuntimeError as error:
+		print("%s failed: %s" % (exportFormat, error))
+		return False
+
+# Export matching actions and meshes of one character, returns list of (format, name, success).
+# Properties are passed on to the export operator of each format.
+def exportCharacter(context, name, actionPatterns, meshPatterns, formats, properties={}):
+	results = []
+
+	charRefHndlr = selectCharacter(context, name)
+	if not charRefHndlr or charRefHndlr.error:
+		print("Character %s: %s" % (name, charRefHndlr.statusMsg if charRefHndlr else "doesn't exist"))
+		return [(exportFormat, name, False) for exportFormat in formats]
+
+	# Remember the assigned action so the file is left as it was
+	oldAction = charRefHndlr.animationData.action
+
+	animFormats = [exportFormat for exportFormat in formats if exportFormat in animationFormats]
+	if animFormats:
+		actions = [action for action in bpy.data.actions if any(fnmatch.fnmatchcase(action.name, pattern) for pattern in actionPatterns)]
+		for action in actions:
+			selectAction(context, charRefHndlr, action)
+			for exportFormat in animFormats:
+				results.append((exportFormat, action.name, runExport(exportFormat, **properties.get(exportFormat, {}))))
+
+	charRefHndlr.animationData.action = oldAction
+	tgor_util.exportSession.invalidate()
+
+	for exportFormat in [exportFormat for exportFormat in formats if exportFormat in meshFormats]:
+		meshes = selectMeshes(context, charRefHndlr, meshPatterns)
+		if meshes:
+			results.append((exportFormat, ", ".join(meshes), runExport(exportFormat, **properties.get(exportFormat, {}))))
+
+	return results
+
+def parseArguments(argv):
+	parser = argparse.ArgumentParser(prog="tgor_batch", description="Export characters of the loaded .blend file")
+	parser.add_argument("--character", action='append', default=[], help="Character to export, can be repeated (default: all)")
+	parser.add_argument("--actions", nargs='+', default=["*"], help="Action name patterns to export (default: all)")
+	parser.add_argument("--meshes", nargs='+', default=["*"], help="Mesh name patterns to export (default: all)")
+	parser.add_argument("--formats", nargs='+', choices=sorted(exportOperators.keys()), default=['sl_anim'], help="What to export")
+	parser.add_argument("--include-character-name", action='store_true', help="Prefix exported animation files with the character name")
+	parser.add_argument("--mesh-folder", default=None, help="Folder to export meshes to instead of the character's")
+	parser.add_argument("--sl-mesh-writer", choices=['sl', 'blender'], default=None, help="Collada writer of the SL mesh export (default: as saved)")
+	parser.add_argument("--patch-collada", choices=['on', 'off'], default=None, help="Scale collision volume bind poses of SL meshes (default: as saved)")
+	parser.add_argument("--sl-mesh-lod", choices=['high', 'medium', 'low', 'lowest'], default=None, help="Level of detail of SL meshes to export (default: high)")
+	parser.add_argument("--no-manifest", action='store_true', help="Export meshes even if unchanged and don't record them in the export manifest")
+	return parser.parse_args(argv)
+
+def main(argv=None):
+
+	# Blender's own arguments end at "--"
+	if argv is None:
+		argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+	args = parseArguments(argv)
+
+	context = bpy.context
+	context.window_manager.tgor_action_settings.exportAnimCharacterName = args.include_character_name
+	if args.sl_mesh_writer:
+		context.window_manager.sl_mesh_export.writer = args.sl_mesh_writer
+	if args.patch_collada:
+		context.window_manager.sl_mesh_export.patchCollada = args.patch_collada == 'on'
+	tgor_util.ExportManifest.enabled = not args.no_manifest
+	names = args.character or [character.name for character in context.scene.tgor_character_selection.characters]
+	properties = {'sl_mesh': {'lod': args.sl_mesh_lod}} if args.sl_mesh_lod else {}
+
+	# Exports skip redundant frame changes within the session, the frame is restored once at the end
+	results = []
+	with tgor_util.exportSession.scope(context.scene):
+		for name in names:
+			if args.mesh_folder and context.scene.tgor_character_selection.characters.get(name):
+				context.scene.tgor_character_selection.characters[name].meshFolder = args.mesh_folder
+			results += exportCharacter(context, name, args.actions, args.meshes, args.formats, properties)
+
+	for exportFormat, name, success in results:
+		print("%s %s: %s" % (exportFormat, name, "OK" if success else "FAILED"))
+
+	return 0 if results and all(success for _, _, success in results) else 1
@@ -69,15 +69,15 @@ class CharacterReferenceHandler():
 	animFolder = ""
 	
 	
-	def __init__(self, context):
+	def __init__(self, context, name=None):
 		scene = context.scene
 		data = bpy.data
 		self.warning = False	
 		self.error = False
 		self.statusMsg = ""
 		
-		# Get what is the selected name in the UI list
-		selectedName = scene.tgor_character_selection.characters_selection
+		# Get what is the selected name in the UI list, unless a character is asked for by name
+		selectedName = name or scene.tgor_character_selection.characters_selection
 		
 		# Get the property collection of the character
 		selectedCharacter = scene.tgor_character_selection.characters.get(selectedName)
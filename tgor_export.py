@@ -7,10 +7,12 @@ from bpy.props import CollectionProperty, PointerProperty
 import re
 import os
 import math
+import numpy as np
 from mathutils import Matrix, Vector, Euler, Quaternion
 
 from . import sl_animation
 from . import sl_mesh
+from . import sl_sampler
 from . import tgor_character
 from . import tgor_util
 
@@ -43,6 +45,13 @@ class TGORActionSettingsProperty(PropertyGroup):
 			default=False
 		)
 
+	# Skeletal mesh exports only write files whose meshes changed
+	skipUnchanged: BoolProperty(
+			name="Skip Unchanged",
+			description="Don't export skeletal meshes that are the same as when they were last exported (objects referenced by modifiers only count by name)",
+			default=False
+		)
+
 	# Cached name of the selected object's action													
 	exportMode: EnumProperty(
 			name="Export Mode",
@@ -56,6 +65,255 @@ class TGORActionSettingsProperty(PropertyGroup):
 		)
 
 
+####################################################################################################
+############################################# BAKING ###############################################
+####################################################################################################
+
+# Duplicate of a character's deform rig that gets baked and exported as "Armature" for UE
+class DeformRigDuplicate():
+
+	def __init__(self, context, deformRig):
+		self.error = None
+		self.deformRig = deformRig
+		self.dupDeformRig = None
+		self.bakedAction = None
+
+		# Check if there is any object named Armature in the scene, because if there is, it will break UE4 export/import pipeline
+		self.previousArmature = bpy.data.objects.get("Armature")
+		if self.previousArmature:
+			self.previousArmature.name = "Armature_"
+		
+		# ------------------------------------------------------------------
+		# Scene preparation	
+		
+		# Go to object mode
+		tgor_util.exitPoseMode(context)
+		
+		# Deselect all
+		for ob in bpy.data.objects:
+			ob.select_set(False)
+		
+		# Make deform rig visible, selectable and remember how it was 
+		self.deformRigWasHidden = bool(deformRig.hide_get())
+		deformRig.hide_set(False)
+		
+		self.deformRigWasSelectable = bool(deformRig.hide_select)
+		deformRig.hide_select = False
+		
+		# Select deform rig 
+		deformRig.select_set(True)
+		
+		# Make rig as active object
+		context.view_layer.objects.active = deformRig
+		
+		# Before duplication, make sure the object is visible and on correct layer
+		if not context.object in context.visible_objects:
+			self.error = "Can't unhide deformRig, it's either on another scene layer or locked invisible."
+			return
+
+		# -----------------------------		
+		# Making changes to scene
+		
+		# Duplicate (new objects should be selected)
+		bpy.ops.object.duplicate()
+		self.dupDeformRig = context.view_layer.objects.active
+		
+		# Make sure duplication worked
+		if self.dupDeformRig == deformRig:
+			self.dupDeformRig = None
+			self.error = "Duplication of deform rig didn't work. Make sure its visible and accessiable."
+			return
+
+		# New rig hasn't been evaluated at any frame yet
+		tgor_util.exportSession.invalidate()
+
+	# Bake action (make a temporary action for it, removing all constraints)
+	def bake(self, frame_start, frame_end):
+		bpy.ops.nla.bake(frame_start=frame_start, frame_end=frame_end, visual_keying=True, clear_constraints=True, bake_types={'POSE'})
+		tgor_util.exportSession.invalidate()
+		
+		# Store the reference to that action
+		self.bakedAction = self.dupDeformRig.animation_data.action
+	
+	# Export selected as FBX (with special UE4 settings)
+	def export(self, context, filePath):
+
+		# Rename duplicated rig to "Armature"
+		self.dupDeformRig.name = "Armature"
+
+		# The fbx exporter steps through every frame to bake the animation. The baked rig doesn't depend
+		# on anything anymore, so it gets a scene of its own where a frame only evaluates its action.
+		scene = context.scene
+		exportScene = bpy.data.scenes.new("TGOR_Export")
+		try:
+			exportScene.frame_start = scene.frame_start
+			exportScene.frame_end = scene.frame_end
+			exportScene.render.fps = scene.render.fps
+			exportScene.render.fps_base = scene.render.fps_base
+			exportScene.unit_settings.system = scene.unit_settings.system
+			exportScene.unit_settings.scale_length = scene.unit_settings.scale_length
+
+			viewLayer = exportScene.view_layers[0]
+			exportScene.collection.objects.link(self.dupDeformRig)
+			self.dupDeformRig.select_set(True, view_layer=viewLayer)
+			viewLayer.objects.active = self.dupDeformRig
+
+			override = {'scene': exportScene, 'view_layer': viewLayer, 'active_object': self.dupDeformRig, 'selected_objects': [self.dupDeformRig]}
+
+			# Blender 3.2 and later only take context overrides through temp_override
+			if hasattr(context, "temp_override"):
+				with context.temp_override(**override):
+					self.exportFbx(filePath)
+			else:
+				self.exportFbx(filePath, override)
+		finally:
+			bpy.data.scenes.remove(exportScene)
+
+	def exportFbx(self, filePath, *override):
+		bpy.ops.export_scene.fbx(*override,
+			filepath = filePath,
+			axis_forward = '-Y',
+			axis_up = 'Z',
+			#version = 'BIN7400',
+			#ui_tab = 'MAIN',
+			use_selection = True,
+			global_scale = 1.0,
+			apply_unit_scale = True,
+			apply_scale_options = 'FBX_SCALE_NONE',
+			bake_space_transform = False,
+			object_types = {'ARMATURE'},
+			use_mesh_modifiers = True,
+			use_mesh_modifiers_render = True,
+			mesh_smooth_type = 'OFF',
+			use_mesh_edges = False,
+			use_tspace = False,
+			use_custom_props = False,
+			add_leaf_bones = False,
+			primary_bone_axis = 'Y',
+			secondary_bone_axis = 'X',
+			use_armature_deform_only = True,
+			armature_nodetype = 'NULL',
+			bake_anim = True,
+			bake_anim_use_all_bones = True,
+			bake_anim_use_nla_strips = False,
+			bake_anim_use_all_actions = False,
+			bake_anim_force_startend_keying = True,
+			bake_anim_step = 1.0,
+			bake_anim_simplify_factor = 0.0,
+			#use_anim = True,
+			#use_anim_action_all = True,
+			#use_default_take = True,
+			#use_anim_optimize = True,
+			#anim_optimize_precision = 6.0,
+			path_mode = 'AUTO',
+			embed_textures = False,
+			batch_mode = 'OFF',
+			use_batch_own_dir = True,
+		)
+			
+	# Delete duplicate and restore the scene, returns error message if something went wrong
+	def cleanup(self, context):
+				
+		# Delete action
+		if self.bakedAction:
+			bpy.data.actions.remove(self.bakedAction)
+			self.bakedAction = None
+		
+		# Delete duplicated stuff
+		if self.dupDeformRig:
+			for ob in context.selected_objects:
+				ob.select_set(False)
+			self.dupDeformRig.select_set(True)
+			bpy.ops.object.delete(use_global=False)
+			self.dupDeformRig = None
+				
+		# Check if nothing vital got deleted
+		if not self.deformRig:
+			return "Something went wrong during the script and the objects got deleted. Try undoing the last step and verify if fbx got exported."
+		
+		# Restore object visibility settings  
+		self.deformRig.hide_set(self.deformRigWasHidden)
+		self.deformRig.hide_select = self.deformRigWasSelectable
+
+		# Rename armature back if renamed
+		if self.previousArmature:
+			self.previousArmature.name = "Armature"
+			self.previousArmature = None
+		return None
+
+# Records the visual pose of the duplicated deform rig while the timeline is evaluated elsewhere,
+# then keys it the same way a visual nla.bake would without evaluating the frames again
+class PoseRecorder():
+
+	def __init__(self, armature, frame_start, frame_end):
+		self.armature = armature
+		self.frame_start = frame_start
+		self.frames = np.arange(frame_start, frame_end + 1, dtype=np.float32)
+		self.bones = [poseBone.name for poseBone in armature.pose.bones]
+
+		# Frame x bone x location, rotation (w,x,y,z) and scale
+		shape = (len(self.frames), len(self.bones))
+		self.locations = np.zeros(shape + (3,), dtype=np.float32)
+		self.rotations = np.zeros(shape + (4,), dtype=np.float32)
+		self.scales = np.ones(shape + (3,), dtype=np.float32)
+
+	def contains(self, frame):
+		return 0 <= frame - self.frame_start < len(self.frames)
+
+	# Record local transforms of all bones at the currently evaluated frame
+	def record(self, frame):
+		row = frame - self.frame_start
+		for index, poseBone in enumerate(self.armature.pose.bones):
+			matrix = self.armature.convert_space(pose_bone=poseBone, matrix=poseBone.matrix, from_space='POSE', to_space='LOCAL')
+			location, rotation, scale = matrix.decompose()
+
+			# Keep quaternions continuous like nla.bake does
+			if row > 0:
+				rotation.make_compatible(Quaternion(self.rotations[row - 1, index]))
+
+			self.locations[row, index] = location
+			self.rotations[row, index] = rotation
+			self.scales[row, index] = scale
+
+	# Euler angles of recorded rotations, each compatible to the one before so channels don't flip by 2 pi
+	def eulers(self, rotations, mode):
+		eulers = []
+		previous = None
+		for rotation in rotations:
+			previous = Quaternion(rotation).to_euler(mode, previous) if previous is not None else Quaternion(rotation).to_euler(mode)
+			eulers.append(previous)
+		return np.array(eulers, dtype=np.float32)
+
+	# Write recorded poses into a new action on the armature and remove constraints
+	def bake(self, name):
+		action = bpy.data.actions.new(name)
+		if not self.armature.animation_data:
+			self.armature.animation_data_create()
+		self.armature.animation_data.action = action
+
+		for index, poseBone in enumerate(self.armature.pose.bones):
+			while poseBone.constraints:
+				poseBone.constraints.remove(poseBone.constraints[0])
+
+			# Key rotation in the mode the bone uses
+			rotations = self.rotations[:, index]
+			if poseBone.rotation_mode == 'QUATERNION':
+				rotationPath = 'rotation_quaternion'
+			elif poseBone.rotation_mode == 'AXIS_ANGLE':
+				rotationPath = 'rotation_axis_angle'
+				rotations = np.array([(angle, *axis) for axis, angle in (Quaternion(rotation).to_axis_angle() for rotation in rotations)], dtype=np.float32)
+			else:
+				rotationPath = 'rotation_euler'
+				rotations = self.eulers(rotations, poseBone.rotation_mode)
+
+			for dataPath, values in (('location', self.locations[:, index]), (rotationPath, rotations), ('scale', self.scales[:, index])):
+				for component in range(values.shape[1]):
+					fcurve = action.fcurves.new('pose.bones["%s"].%s' % (poseBone.name, dataPath), index=component, action_group=poseBone.name)
+					fcurve.keyframe_points.add(len(self.frames))
+					fcurve.keyframe_points.foreach_set('co', np.stack((self.frames, values[:, component]), axis=-1).ravel())
+					fcurve.update()
+		return action
+
 ####################################################################################################
 ############################################# OPERATORS ############################################
 ####################################################################################################
@@ -97,8 +355,12 @@ class TGOR_OT_ExportSkelMesh(Operator):
 				
 		return
 		
-	
+	# Frame of the user is restored once the export (or the batch it's part of) is done
 	def execute(self, context):
+		with tgor_util.exportSession.scope(context.scene):
+			return self.export(context)
+	
+	def export(self, context):
 		
 		# Create a class that houses userful and repetetive character references
 		charRefHndlr = tgor_character.CharacterReferenceHandler(context)
@@ -150,14 +412,24 @@ class TGOR_OT_ExportSkelMesh(Operator):
 		filePath = bpy.path.abspath(os.path.join( meshFolder, tgor_util.makeValidFilename(meshesToExport[0].name) + ".fbx"))
 		# self.report({'WARNING'}, filePath)
 		
+		# Skip the export if the file would come out the same
+		manifest = tgor_util.ExportManifest(bpy.path.abspath(meshFolder), context.window_manager.tgor_action_settings.skipUnchanged)
+		exportSettings = {'format': "ue_mesh"}
+		hashes = manifest.hashes(meshesToExport, deformRig)
+		if manifest.unchanged(filePath, exportSettings, hashes):
+			if previousArmature:
+				previousArmature.name = "Armature"
+			self.report({'INFO'}, "Mesh @ %s is up to date, nothing exported" % (filePath))
+			return {'FINISHED'}
+		
 		# -----------------------------		
 		# Scene preparation
 		
 		# Go to object mode
 		tgor_util.exitPoseMode(context)
 		
-		# Set timeline to 0 frame
-		context.scene.frame_set(0)
+		# Set timeline to 0 frame (the frame of the user is restored when the export session ends)
+		tgor_util.exportSession.frameSet(context.scene, 0)
 			
 		# Go to object mode
 		if context.object:
@@ -168,43 +440,40 @@ class TGOR_OT_ExportSkelMesh(Operator):
 		for ob in bpy.data.objects:
 			ob.select_set(False)
 		
-		# Make mesh and deform rig visible, seletable, and remember how they were 
-		deformRigWasHidden = bool(deformRig.hide_get())
-		deformRig.hide_set(False)
-		
-		deformRigWasSelectable = bool(deformRig.hide_select)
-		deformRig.hide_select = False
-		
+		# Make mesh visible so they get evaluated, and remember how they were 
 		meshToExportWasHidden = [bool(meshToExport.hide_get()) for meshToExport in meshesToExport]		
-		meshToExportWasSelectable = [bool(meshToExport.hide_select) for meshToExport in meshesToExport]
 		for meshToExport in meshesToExport:
-			meshToExport.hide_select = False
 			meshToExport.hide_set(False)
-			meshToExport.select_set(True)
 		
-		# Select deform rig 
-		deformRig.select_set(True)
-		
-		# Make rig as active object
-		context.view_layer.objects.active = deformRig
-		
-		# Before duplication, make sure the object is visible and on correct layer
-		if not context.object in context.visible_objects:
-			self.report({'ERROR'}, "Can't unhide deformRig, it's either on another scene layer or locked invisible.")
-			return {'FINISHED'}
+		# -----------------------------		
+		# Export from temporary copies of the evaluated meshes and deform rig (copies are selected)
+		copies = None
+		try:
+			copies = tgor_util.ExportCopies(context, meshesToExport, [deformRig])
+			self.exportCopies(copies.get(deformRig), filePath)
 		
 		# -----------------------------		
-		# Making changes to scene
+		# Cleanup
+		finally:
+			if copies:
+				copies.cleanup()
+			for meshToExport, hide in zip(meshesToExport, meshToExportWasHidden):
+				meshToExport.hide_set(hide)
+
+			# Rename armature back if renamed
+			if previousArmature:
+				previousArmature.name = "Armature"
 		
-		# Duplicate (new objects should stay selected)
-		bpy.ops.object.duplicate()
-		dupDeformRig = context.view_layer.objects.active
+		manifest.record(filePath, exportSettings, hashes)
+		manifest.save()
+		
+		# Report a message about export
+		self.report({'INFO'}, "Mesh exported @ "+filePath)
+		return {'FINISHED'}
+
+	# Export the selected copies, the deform rig copy is posed at rest
+	def exportCopies(self, dupDeformRig, filePath):
 		
-		# Make sure duplication worked
-		if dupDeformRig == deformRig:
-			self.report({'ERROR'}, "Duplication of deform rig didn't work. Make sure its visible and accessiable.")
-			return {'FINISHED'}
-			
 		# Rename duplicated rig to "Armature"
 		dupDeformRig.name = "Armature"
 		
@@ -253,34 +522,7 @@ class TGOR_OT_ExportSkelMesh(Operator):
 			batch_mode = 'OFF',
 			use_batch_own_dir = True
 		)
-		
-		# -----------------------------		
-		# Cleanup
-		
-		# Delete duplicated stuff
-		bpy.ops.object.delete(use_global=False)
-		
-		# Check if nothing vital got deleted
-		if not deformRig:
-			self.report({'ERROR'}, "Something went wrong during the script and the objects got deleted. Try undoing the last step and verify if fbx got exported.")
-			return {'FINISHED'}
-		
-		# Restore object visibility settings  
-		deformRig.hide_set(deformRigWasHidden)
-		deformRig.hide_select = deformRigWasSelectable
 
-		for meshToExport, hide, hide_select in zip(meshesToExport, meshToExportWasHidden, meshToExportWasSelectable):
-			meshToExport.hide_set(hide)
-			meshToExport.hide_select = hide_select
-
-		# Rename armature back if renamed
-		if previousArmature:
-			previousArmature.name = "Armature"
-		
-		# Report a message about export
-		self.report({'INFO'}, "Mesh exported @ "+filePath)
-		return {'FINISHED'}
-		
 
 # ------------------------------------------------------------------
 # Export animation
@@ -290,184 +532,162 @@ class TGOR_OT_ExportAnimation(Operator):
 	bl_description = "Export current action as animated skeletal mesh fbx"
 			
 	def execute(self, context):
-		selectedName = context.scene.tgor_character_selection.characters_selection
 				
 		# -----------------------------	
 		# Preparations
 				
 		# Create a class that houses userful and repetetive character references
 		charRefHndlr = tgor_character.CharacterReferenceHandler(context)
-				
-		# Get deform rig
-		deformRig = charRefHndlr.deformRig
-		# Stop if there is no deform rig
-		if not deformRig :
-			self.report({'ERROR'}, "Character setup is invalid, no deform rig to export.")
-			return {'FINISHED'}
-		
 		
-		
-		# Get control rig
-		controlRig = charRefHndlr.controlRig
-		# Stop if there is no control rig
-		if not controlRig :
-			self.report({'ERROR'}, "Character setup is invalid, no control rig to get animations from.")
+		error = animationExportError(charRefHndlr)
+		if error:
+			self.report({'ERROR'}, error)
 			return {'FINISHED'}
 		
+		filePath = animationFilePath(context, charRefHndlr, ".fbx")
 		
-		
-		# Check if both rigs aren't identical
-		if deformRig == controlRig:
-			self.report({'ERROR'}, "Control rig and deform rig are the same, this is not how the script is intended to be used.")
-			return {'FINISHED'}
-		
-		
-		
-		# Get action
-		action = charRefHndlr.action
-		# Stop if there is no action
-		if not action :
-			self.report({'ERROR'}, "Control rig doesn't have any action assigned to it, nothing to export.")
-			return {'FINISHED'}
-		
-		# Check if there is any object named Armature in the scene, because if there is, it will break UE4 export/import pipeline
-		previousArmature = bpy.data.objects.get("Armature")
-		if previousArmature:
-			previousArmature.name = "Armature_"
-		
-		# Stop if no paths gotten
-		if not charRefHndlr.animFolder:
-			self.report({'ERROR'}, "Character doesn't have animation export path defined.")
-			return {'FINISHED'}
-		
-		# Check path as absolute path TODO: Relative paths https://docs.blender.org/api/blender_python_api_2_77_0/bpy.path.html
-		if not os.path.isdir(bpy.path.abspath(charRefHndlr.animFolder)):
-			self.report({'ERROR'}, "Path '" + charRefHndlr.animFolder + "' doesn't point to an existing directory (has to be absolute path).")
-			return {'FINISHED'}
-		
-		# getting the full fbx export file path
-		includeCharacterName = context.window_manager.tgor_action_settings.exportAnimCharacterName
-		filename = tgor_util.makeValidFilename(selectedName+"_"+action.name if includeCharacterName else action.name)+".fbx"
-		filePath = bpy.path.abspath(os.path.join(charRefHndlr.animFolder, filename))
-		
-		# ------------------------------------------------------------------
-		# Scene preparation	
-		
-		# Go to object mode
-		tgor_util.exitPoseMode(context)
-		
-		# Deselect all
-		for ob in bpy.data.objects:
-			ob.select_set(False)
-		
-		# Make deform rig visible, selectable and remember how it was 
-		deformRigWasHidden = bool(deformRig.hide_get())
-		deformRig.hide_set(False)
-		
-		deformRigWasSelectable = bool(deformRig.hide_select)
-		deformRig.hide_select = False
-		
-		# Select deform rig 
-		deformRig.select_set(True)
-		
-		# Make rig as active object
-		context.view_layer.objects.active = deformRig
-		
-		# Before duplication, make sure the object is visible and on correct layer
-		if not context.object in context.visible_objects:
-			self.report({'ERROR'}, "Can't unhide deformRig, it's either on another scene layer or locked invisible.")
-			return {'FINISHED'}
-
 		# -----------------------------		
 		# Making changes to scene
 		
-		# Duplicate (new objects should be selected)
-		bpy.ops.object.duplicate()
-		dupDeformRig = context.view_layer.objects.active
-		
-		# Make sure duplication worked
-		if dupDeformRig == deformRig:
-			self.report({'ERROR'}, "Duplication of deform rig didn't work. Make sure its visible and accessiable.")
+		duplicate = DeformRigDuplicate(context, charRefHndlr.deformRig)
+		if duplicate.error:
+			self.report({'ERROR'}, duplicate.error)
+			duplicate.cleanup(context)
 			return {'FINISHED'}
 		
-		# bake action (make a temporary action for it, current frame range only, removing all constraints)
-		bpy.ops.nla.bake(frame_start=context.scene.frame_start, frame_end=context.scene.frame_end, visual_keying=True, clear_constraints=True, bake_types={'POSE'})
-		
-		# Store the reference to that action
-		bakedAction = dupDeformRig.animation_data.action
-		
-		# Rename duplicated rig to "Armature"
-		dupDeformRig.name = "Armature"
-	
-		# -----------------------------		
-		# Export selected as FBX (with special UE4 settings)
-		bpy.ops.export_scene.fbx(
-			filepath = filePath,
-			axis_forward = '-Y',
-			axis_up = 'Z',
-			#version = 'BIN7400',
-			#ui_tab = 'MAIN',
-			use_selection = True,
-			global_scale = 1.0,
-			apply_unit_scale = True,
-			apply_scale_options = 'FBX_SCALE_NONE',
-			bake_space_transform = False,
-			object_types = {'ARMATURE'},
-			use_mesh_modifiers = True,
-			use_mesh_modifiers_render = True,
-			mesh_smooth_type = 'OFF',
-			use_mesh_edges = False,
-			use_tspace = False,
-			use_custom_props = False,
-			add_leaf_bones = False,
-			primary_bone_axis = 'Y',
-			secondary_bone_axis = 'X',
-			use_armature_deform_only = True,
-			armature_nodetype = 'NULL',
-			bake_anim = True,
-			bake_anim_use_all_bones = True,
-			bake_anim_use_nla_strips = False,
-			bake_anim_use_all_actions = False,
-			bake_anim_force_startend_keying = True,
-			bake_anim_step = 1.0,
-			bake_anim_simplify_factor = 0.0,
-			#use_anim = True,
-			#use_anim_action_all = True,
-			#use_default_take = True,
-			#use_anim_optimize = True,
-			#anim_optimize_precision = 6.0,
-			path_mode = 'AUTO',
-			embed_textures = False,
-			batch_mode = 'OFF',
-			use_batch_own_dir = True,
-		)
+		# Current frame range only
+		duplicate.bake(context.scene.frame_start, context.scene.frame_end)
+		duplicate.export(context, filePath)
 			
 		# -----------------------------		
 		# Cleanup
-				
-		# Delete action
-		bpy.data.actions.remove(bakedAction)
 		
-		# Delete duplicated stuff
-		bpy.ops.object.delete(use_global=False)
-				
-		# Check if nothing vital got deleted
-		if not deformRig and controlRig:
-			self.report({'ERROR'}, "Something went wrong during the script and the objects got deleted. Try undoing the last step and verify if fbx got exported.")
+		error = duplicate.cleanup(context)
+		if error:
+			self.report({'ERROR'}, error)
 			return {'FINISHED'}
 		
-		# Restore object visibility settings  
-		deformRig.hide_set(deformRigWasHidden)
-		deformRig.hide_select = deformRigWasSelectable
-
-		# Rename armature back if renamed
-		if previousArmature:
-			previousArmature.name = "Armature"
-		
 		# Report a message about export
 		self.report({'INFO'}, "Animation exported @ "+filePath)
 		return {'FINISHED'}
 	
+# Check character setup for animation export, returns error message or None
+def animationExportError(charRefHndlr):
+		
+	# Get deform rig
+	deformRig = charRefHndlr.deformRig
+	# Stop if there is no deform rig
+	if not deformRig :
+		return "Character setup is invalid, no deform rig to export."
+	
+	# Get control rig
+	controlRig = charRefHndlr.controlRig
+	# Stop if there is no control rig
+	if not controlRig :
+		return "Character setup is invalid, no control rig to get animations from."
+	
+	# Check if both rigs aren't identical
+	if deformRig == controlRig:
+		return "Control rig and deform rig are the same, this is not how the script is intended to be used."
+	
+	# Get action
+	action = charRefHndlr.action
+	# Stop if there is no action
+	if not action :
+		return "Control rig doesn't have any action assigned to it, nothing to export."
+	
+	# Stop if no paths gotten
+	if not charRefHndlr.animFolder:
+		return "Character doesn't have animation export path defined."
+	
+	# Check path as absolute path TODO: Relative paths https://docs.blender.org/api/blender_python_api_2_77_0/bpy.path.html
+	if not os.path.isdir(bpy.path.abspath(charRefHndlr.animFolder)):
+		return "Path '" + charRefHndlr.animFolder + "' doesn't point to an existing directory (has to be absolute path)."
+	return None
+
+# getting the full export file path of the current action
+def animationFilePath(context, charRefHndlr, extension):
+	selectedName = context.scene.tgor_character_selection.characters_selection
+	includeCharacterName = context.window_manager.tgor_action_settings.exportAnimCharacterName
+	filename = tgor_util.makeValidFilename(selectedName+"_"+charRefHndlr.action.name if includeCharacterName else charRefHndlr.action.name)+extension
+	return bpy.path.abspath(os.path.join(charRefHndlr.animFolder, filename))
+
+# SL and UE export of the current action, evaluating the character at each frame only once for both
+class TGOR_OT_ExportAnimationCombined(sl_animation.SL_OT_AnimationExport):
+	bl_label = "Export SL and UE Animation"
+	bl_idname = "object.tgor_export_character_animation_combined"
+	bl_description = "Export current action as SL animation and animated skeletal mesh fbx, sampling the character once per frame"
+
+	_duplicate = None
+
+	def prepare(self, context):
+		charRefHndlr = tgor_character.CharacterReferenceHandler(context)
+		error = animationExportError(charRefHndlr)
+		if error:
+			self.report({'ERROR'}, error)
+			return {'CANCELLED'}
+
+		# SL samples the active rig as the SL export does
+		result = super().prepare(context)
+		if result:
+			return result
+		self.fbxPath = animationFilePath(context, charRefHndlr, ".fbx")
+
+		self._duplicate = DeformRigDuplicate(context, charRefHndlr.deformRig)
+		if self._duplicate.error:
+			self.report({'ERROR'}, self._duplicate.error)
+			self.restore(context)
+			return {'CANCELLED'}
+
+		self.recorder = PoseRecorder(self._duplicate.dupDeformRig, context.scene.frame_start, context.scene.frame_end)
+		self.sampler = self.iterSampleCombined(context)
+		return None
+
+	# Full sampling, every frame in range gets evaluated for UE anyways so skipping frames saves nothing.
+	# Samples are cached under this mode too.
+	def samplingMode(self, context, action):
+		return False, False
+
+	# Evaluate each frame needed by either target once, feeding both the SL samples and the UE recorder
+	def iterSampleCombined(self, context):
+		slFrames = range(0) if self.cached else range(self.frame_start, self.frame_start + self.totalFrames)
+		frames = sorted(set(slFrames) | set(range(self.recorder.frame_start, self.recorder.frame_start + len(self.recorder.frames))))
+		for index, frame in enumerate(frames):
+			with self.timer.phase('frame_set'):
+				tgor_util.exportSession.frameSet(context.scene, frame)
+			if frame in slFrames:
+				row = frame - self.frame_start
+				with self.timer.phase('matrix'):
+					sl_sampler.samplePose(self.armature, self.rest, self.samples.locations[row], self.samples.rotations[row])
+				self.samples.sampled[row] = True
+			if self.recorder.contains(frame):
+				with self.timer.phase('record'):
+					self.recorder.record(frame)
+			yield float(index + 1) / len(frames)
+
+	def finish(self, context):
+		with self.timer.phase('bake'):
+			self._duplicate.bakedAction = self.recorder.bake(self.action.name + "_baked")
+		with self.timer.phase('fbx'):
+			self._duplicate.export(context, self.fbxPath)
+		error = self._duplicate.cleanup(context)
+		self._duplicate = None
+		if error:
+			self.report({'ERROR'}, error)
+			self.restore(context)
+			return {'FINISHED'}
+
+		result = super().finish(context)
+		self.report({'INFO'}, "Animation exported @ "+self.fbxPath)
+		return result
+
+	# Remove the duplicate rig along with the session if the export didn't get to do so
+	def restore(self, context):
+		if self._duplicate:
+			self._duplicate.cleanup(context)
+			self._duplicate = None
+		super().restore(context)
+	
 		
 
 # ------------------------------------------------------------------
@@ -605,6 +825,7 @@ class TGOR_OT_ActionDelOperator(Operator):
 classes = (
 	TGOR_OT_ExportSkelMesh,
 	TGOR_OT_ExportAnimation,
+	TGOR_OT_ExportAnimationCombined,
 	TGOR_OT_ActionCopyOperator,
 	TGOR_OT_ActionAddOperator,
 	TGOR_OT_ActionDelOperator,
@@ -0,0 +1,144 @@
+
+'''
+Runs jobs in background Blender instances, this module doesn't depend on bpy so it can be used
+from within Blender as well as from a plain python interpreter, e.g. on CI or render nodes:
+
+python tgor_launcher.py --blender /path/to/blender --jobs 4 a.blend b.blend -- --character Name --formats sl_anim ue_anim
+
+Everything after "--" is passed on to tgor_batch, which is run once per .blend file.
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Script executed inside of each background Blender instance by default
+batchScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgor_batch.py")
+
+#-----------------------------------
+# Result of one background Blender run
+class Job():
+
+	def __init__(self, blendFile, command):
+		self.blendFile = blendFile
+		self.command = command
+		self.returncode = None
+		self.output = ""
+		self.duration = 0.0
+
+	def succeeded(self):
+		return self.returncode == 0
+
+	# Start without waiting, output goes to a log file so a full pipe can't stall the process
+	def start(self, logPath):
+		self.log = open(logPath, "w+b")
+		self.logOffset = 0
+		self.started = time.perf_counter()
+		try:
+			self.process = subprocess.Popen(self.command, stdout=self.log, stderr=subprocess.STDOUT)
+		except OSError:
+			self.log.close()
+			raise
+
+	# Read output written so far, returns the return code once the process exited
+	def poll(self):
+		if self.returncode is not None:
+			return self.returncode
+
+		returncode = self.process.poll()
+		self.log.seek(self.logOffset)
+		output = self.log.read()
+		self.logOffset += len(output)
+		self.output += output.decode(errors='replace')
+
+		if returncode is not None:
+			self.returncode = returncode
+			self.duration = time.perf_counter() - self.started
+			self.log.close()
+		return self.returncode
+
+	# Nothing to do if the process never started
+	def kill(self):
+		if self.returncode is None and getattr(self, "process", None):
+			self.process.kill()
+			self.process.wait()
+			self.poll()
+
+#-----------------------------------
+# Build command line to run a python script in a background Blender with script arguments
+def blenderCommand(blender, blendFile, script, arguments=[], factoryStartup=False):
+	command = [blender, "-b", blendFile]
+
+	# Factory startup skips user add-ons, the script is then responsible of loading what it needs
+	if factoryStartup:
+		command += ["--factory-startup"]
+	return command + ["--python", script, "--"] + list(arguments)
+
+# Run a job to completion, output is captured so concurrent jobs don't interleave
+def runJob(job, timeout=None):
+	start = time.perf_counter()
+	try:
+		process = subprocess.run(job.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+		job.returncode = process.returncode
+		job.output = process.stdout.decode(errors='replace')
+	except subprocess.TimeoutExpired as error:
+		job.returncode = -1
+		job.output = (error.output or b"").decode(errors='replace') + "\nTimed out after %ss" % (timeout)
+	except OSError as error:
+		job.returncode = -1
+		job.output = str(error)
+	job.duration = time.perf_counter() - start
+	return job
+
+# Run jobs on a pool of background Blender processes, results keep the order of the jobs
+def runJobs(jobs, workers=None, timeout=None):
+	workers = workers or os.cpu_count() or 1
+
+	# Threads only wait on their Blender process, the actual work happens in separate processes
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(lambda job: runJob(job, timeout), jobs))
+
+def report(jobs, out=sys.stdout):
+	for job in jobs:
+		status = "OK" if job.succeeded() else "FAILED (%d)" % (job.returncode)
+		print("%s: %s in %.1fs" % (job.blendFile, status, job.duration), file=out)
+	failed = len([job for job in jobs if not job.succeeded()])
+	print("%d of %d files exported, %d failed" % (len(jobs) - failed, len(jobs), failed), file=out)
+
+def main(argv=None):
+	argv = sys.argv[1:] if argv is None else argv
+
+	# Split own arguments from the ones passed on to the batch script
+	batchArguments = []
+	if "--" in argv:
+		index = argv.index("--")
+		argv, batchArguments = argv[:index], argv[index + 1:]
+
+	parser = argparse.ArgumentParser(description="Export many .blend files using background Blender instances")
+	parser.add_argument("files", nargs='+', help=".blend files to export")
+	parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"), help="Blender executable (default: $BLENDER or blender)")
+	parser.add_argument("--jobs", type=int, default=None, help="Number of concurrent Blender instances (default: cpu count)")
+	parser.add_argument("--script", default=batchScript, help="Script to run in each instance (default: tgor_batch.py)")
+	parser.add_argument("--timeout", type=float, default=None, help="Seconds after which a single file is aborted")
+	parser.add_argument("--logs", default=None, help="Folder to write the Blender output of each file to")
+	args = parser.parse_args(argv)
+
+	jobs = [Job(blendFile, blenderCommand(args.blender, blendFile, args.script, batchArguments)) for blendFile in args.files]
+	jobs = runJobs(jobs, args.jobs, args.timeout)
+
+	for job in jobs:
+		if args.logs:
+			os.makedirs(args.logs, exist_ok=True)
+			with open(os.path.join(args.logs, os.path.splitext(os.path.basename(job.blendFile))[0] + ".log"), "w") as f:
+				f.write(job.output)
+		elif not job.succeeded():
+			print(job.output)
+
+	report(jobs)
+	return 0 if all(job.succeeded() for job in jobs) else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,5 +1,12 @@
 import bpy
 
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from contextlib import contextmanager
+
 #-----------------------------------
 # Exits the pose mode and puts blender in the object mode, contexts with the scripts are made to work with
 def exitPoseMode(context):	
@@ -31,3 +38,341 @@ def exportableMesh(deformRig, ob):
 	# Check the object name if it doesn't have _LOD# or _LO# as suffix (for potential LOD export in the future)
 	# if not ob.name.endswith(("_LOD", "_LO"), 0 , len(ob.name)-1):
 	
+
+
+#-----------------------------------
+# Accumulates wall time and call counts of named phases, e.g. to profile exports
+class PhaseTimer():
+
+	def __init__(self):
+		self.phases = {}
+	
+	# Time the enclosed block as one call of a phase
+	@contextmanager
+	def phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - start)
+
+	def add(self, name, seconds, calls=1):
+		total, count = self.phases.get(name, (0.0, 0))
+		self.phases[name] = (total + seconds, count + calls)
+
+	def total(self):
+		return sum(total for total, count in self.phases.values())
+
+	def summary(self):
+		return ", ".join("%s %.3fs (%dx)" % (name, total, count) for name, (total, count) in self.phases.items())
+
+	# Append phases as one json line so traces of many runs can be aggregated
+	def write(self, filename, **info):
+		record = dict(info)
+		record['total'] = self.total()
+		record['phases'] = {name: {'seconds': total, 'calls': count} for name, (total, count) in self.phases.items()}
+		with open(filename, "a") as f:
+			f.write(json.dumps(record) + "\n")
+
+#-----------------------------------
+# Keeps track of which frame each scene was last evaluated at while exporting, so consecutive exports
+# (e.g. of a batch) skip frame_set calls that wouldn't change anything, and the frame of the user is
+# restored once when the outermost session ends instead of after every single export
+class ExportSession():
+
+	def __init__(self):
+		self.depth = 0
+		self.userFrames = {}
+		self.evaluated = {}
+
+	def begin(self, scene):
+		self.depth += 1
+		self.remember(scene)
+
+	# Restores frames of the user if this ends the outermost session
+	def end(self):
+		if self.depth == 0:
+			return
+		self.depth -= 1
+		if self.depth == 0:
+			for scene, frame in self.userFrames.values():
+				self.frameSet(scene, frame)
+			self.userFrames.clear()
+
+			# Outside of exports the user may change anything
+			self.evaluated.clear()
+
+	def remember(self, scene):
+		if self.depth > 0:
+			self.userFrames.setdefault(scene.as_pointer(), (scene, scene.frame_current))
+
+	# Evaluate scene at a frame unless it already is, returns whether it had to be evaluated
+	def frameSet(self, scene, frame):
+		self.remember(scene)
+		key = scene.as_pointer()
+		if self.evaluated.get(key) == frame and scene.frame_current == frame:
+			return False
+
+		scene.frame_set(frame)
+		if self.depth > 0:
+			self.evaluated[key] = frame
+		return True
+
+	# Call after changing anything that affects evaluation, e.g. assigning an action
+	def invalidate(self):
+		self.evaluated.clear()
+
+	@contextmanager
+	def scope(self, scene):
+		self.begin(scene)
+		try:
+			yield self
+		finally:
+			self.end()
+
+exportSession = ExportSession()
+
+#-----------------------------------
+# Temporary copies of meshes and armatures to export from, so the user's objects are neither duplicated
+# with bpy.ops nor get their modifiers applied. Meshes are built from the objects evaluated once with all
+# visible modifiers but armatures, the copies are deformed by copies of their armatures instead.
+# Copies are linked to the scene and selected, cleanup removes them along with their data. With decimate
+# below 1 meshes are collapsed to that share of their faces, vertex group weights are interpolated along.
+# The user's objects are left untouched, modifier stacks are changed on temporary copies only.
+class ExportCopies():
+
+	def __init__(self, context, meshes, armatures, decimate=1.0):
+		self.copies = {}
+		collection = context.scene.collection
+
+		# Don't leave any copies behind if one can't be made
+		try:
+			self.copyArmatures(collection, armatures)
+			self.copyMeshes(context, collection, meshes, decimate)
+
+			# New objects only get their world matrices once the view layer is evaluated
+			context.view_layer.update()
+		except:
+			self.cleanup()
+			raise
+
+	# Armature copies have their own data so bones can be renamed and posed freely
+	def copyArmatures(self, collection, armatures):
+		for armature in armatures:
+			copy = armature.copy()
+			copy.data = armature.data.copy()
+			self.link(collection, armature, copy)
+		copies = dict(self.copies)
+
+		# Constraints between copied armatures follow the copies
+		for copy in copies.values():
+			for poseBone in copy.pose.bones:
+				for constraint in poseBone.constraints:
+					if getattr(constraint, 'target', None) in copies:
+						constraint.target = copies[constraint.target]
+
+	def copyMeshes(self, context, collection, meshes, decimate):
+		copies = dict(self.copies)
+
+		# Stand-ins share the mesh data of the originals but have their own modifier stacks, without
+		# armature modifiers and with a decimate modifier at the end, e.g. for lower levels of detail
+		standIns = []
+		try:
+			for obj in meshes:
+				standIn = obj.copy()
+				collection.objects.link(standIn)
+				standIns.append(standIn)
+				for mod in [mod for mod in standIn.modifiers if mod.type == 'ARMATURE']:
+					standIn.modifiers.remove(mod)
+				if decimate < 1.0:
+					mod = standIn.modifiers.new("ExportDecimate", 'DECIMATE')
+					mod.decimate_type = 'COLLAPSE'
+					mod.ratio = decimate
+
+			# Evaluate all meshes at once, the copies are deformed by the armature copies
+			depsgraph = context.evaluated_depsgraph_get()
+			for obj, standIn in zip(meshes, standIns):
+				mesh = bpy.data.meshes.new_from_object(standIn.evaluated_get(depsgraph), preserve_all_data_layers=True, depsgraph=depsgraph)
+				self.link(collection, obj, self.copyMesh(obj, mesh, copies))
+		finally:
+			for standIn in standIns:
+				bpy.data.objects.remove(standIn, do_unlink=True)
+
+	def link(self, collection, original, copy):
+		collection.objects.link(copy)
+		copy.select_set(True)
+		self.copies[original] = copy
+
+	# Object for an evaluated mesh with the parenting, vertex groups and armature modifiers of the original
+	def copyMesh(self, obj, mesh, copies):
+		copy = bpy.data.objects.new(obj.name, mesh)
+		copy.parent = copies.get(obj.parent, obj.parent)
+		copy.parent_type = obj.parent_type
+		copy.parent_bone = obj.parent_bone
+		copy.matrix_parent_inverse = obj.matrix_parent_inverse.copy()
+		copy.matrix_basis = obj.matrix_basis.copy()
+
+		# Older versions store vertex group names on the object instead of the mesh
+		if not copy.vertex_groups:
+			for group in obj.vertex_groups:
+				copy.vertex_groups.new(name=group.name)
+
+		for index, slot in enumerate(obj.material_slots):
+			if slot.link == 'OBJECT':
+				copy.material_slots[index].link = 'OBJECT'
+				copy.material_slots[index].material = slot.material
+
+		for mod in obj.modifiers:
+			if mod.type == 'ARMATURE':
+				armature = copy.modifiers.new(mod.name, 'ARMATURE')
+				armature.object = copies.get(mod.object, mod.object)
+				armature.use_vertex_groups = mod.use_vertex_groups
+				armature.use_bone_envelopes = mod.use_bone_envelopes
+				armature.use_deform_preserve_volume = mod.use_deform_preserve_volume
+		return copy
+
+	# Copy of an object, e.g. of the deform rig
+	def get(self, obj):
+		return self.copies.get(obj)
+
+	def cleanup(self):
+		for obj in reversed(list(self.copies.values())):
+			data = obj.data
+			bpy.data.objects.remove(obj, do_unlink=True)
+			if data.users == 0:
+				if isinstance(data, bpy.types.Mesh):
+					bpy.data.meshes.remove(data)
+				else:
+					bpy.data.armatures.remove(data)
+		self.copies = {}
+
+#-----------------------------------
+# All vertex group assignments of a mesh object as flat (vertex, group, weight) arrays
+def readWeights(obj):
+	vertices = obj.data.vertices
+
+	# Vertex groups can't be read with foreach_get, this is the only loop over vertices
+	counts = np.fromiter((len(vertex.groups) for vertex in vertices), dtype=np.int32, count=len(vertices))
+	total = int(counts.sum())
+	indices = np.repeat(np.arange(len(vertices), dtype=np.int32), counts)
+	groups = np.fromiter((group.group for vertex in vertices for group in vertex.groups), dtype=np.int32, count=total)
+	weights = np.fromiter((group.weight for vertex in vertices for group in vertex.groups), dtype=np.float32, count=total)
+
+	# Ignore assignments to groups that don't exist anymore
+	valid = groups < len(obj.vertex_groups)
+	return indices[valid], groups[valid], weights[valid]
+
+#-----------------------------------
+# Settings of a modifier (or any other struct) as plain values, pointers by name
+def rnaSettings(struct):
+	settings = []
+	for prop in struct.bl_rna.properties:
+		if prop.identifier == 'rna_type' or prop.type == 'COLLECTION':
+			continue
+		value = getattr(struct, prop.identifier)
+		if prop.type == 'POINTER':
+			value = getattr(value, "name", None)
+		elif isinstance(value, set):
+			value = sorted(value)
+		elif getattr(prop, "is_array", False):
+			value = list(value)
+		settings.append((prop.identifier, value))
+	return settings
+
+# Content hash of what an export of a mesh is made of: vertex positions, topology, UVs, vertex group
+# weights, shape keys, materials, placement, modifier settings and the rest pose of its deform rig.
+# Objects referenced by modifiers are only hashed by name, editing them doesn't change the hash.
+def meshHash(obj, armature=None):
+	digest = hashlib.sha1()
+	mesh = obj.data
+
+	def update(*values):
+		digest.update(repr(values).encode())
+
+	def array(collection, attribute, count, dtype=np.float32):
+		values = np.empty(len(collection) * count, dtype=dtype)
+		collection.foreach_get(attribute, values)
+		digest.update(values.tobytes())
+
+	array(mesh.vertices, "co", 3)
+	array(mesh.edges, "vertices", 2, np.int32)
+	array(mesh.edges, "use_edge_sharp", 1, bool)
+	array(mesh.polygons, "loop_start", 1, np.int32)
+	array(mesh.polygons, "material_index", 1, np.int32)
+	array(mesh.polygons, "use_smooth", 1, bool)
+	array(mesh.loops, "vertex_index", 1, np.int32)
+	for layer in mesh.uv_layers:
+		update(layer.name, layer.active_render)
+		array(layer.data, "uv", 2)
+
+	update([group.name for group in obj.vertex_groups])
+	for values in readWeights(obj):
+		digest.update(values.tobytes())
+
+	if mesh.shape_keys:
+		for key in mesh.shape_keys.key_blocks:
+			update(key.name, key.value, key.mute, key.relative_key.name)
+			array(key.data, "co", 3)
+
+	update([slot.material.name if slot.material else None for slot in obj.material_slots])
+	update([list(row) for row in obj.matrix_world])
+	for mod in obj.modifiers:
+		update(mod.type, rnaSettings(mod))
+
+	if armature:
+		bones = armature.data.bones
+		update([(bone.name, bone.parent.name if bone.parent else None, bone.use_deform) for bone in bones])
+		update([list(row) for row in armature.matrix_world])
+		array(bones, "head_local", 3)
+		array(bones, "tail_local", 3)
+		array(bones, "matrix_local", 16)
+
+	return digest.hexdigest()
+
+#-----------------------------------
+# Hashes of the meshes and the settings each file of an export folder was last written with, so exports
+# can skip files that would come out the same. Kept as json next to the exported files.
+class ExportManifest():
+
+	fileName = "tgor_export_manifest.json"
+
+	# Workers of a parallel export leave the manifest to the instance that started them
+	enabled = True
+
+	# Only used if enabled, e.g. by Skip Unchanged, otherwise nothing is hashed, read or written
+	def __init__(self, folder, enabled=True):
+		self.path = os.path.join(folder, self.fileName)
+		self.enabled = enabled and ExportManifest.enabled
+		self.entries = {}
+		if not self.enabled:
+			return
+		try:
+			with open(self.path) as f:
+				self.entries = json.load(f)
+		except (OSError, ValueError):
+			pass
+
+	# Hashes of meshes to compare and record, hashing reads every vertex so it's skipped if not enabled
+	def hashes(self, meshes, armature=None):
+		if not self.enabled:
+			return {}
+		return {mesh.name: meshHash(mesh, armature) for mesh in meshes}
+
+	# Whether the file exists and was written from the same meshes with the same settings
+	def unchanged(self, filePath, settings, hashes):
+		if not self.enabled or not os.path.isfile(filePath):
+			return False
+		return self.entries.get(os.path.basename(filePath)) == {'settings': settings, 'meshes': hashes}
+
+	def record(self, filePath, settings, hashes):
+		if self.enabled:
+			self.entries[os.path.basename(filePath)] = {'settings': settings, 'meshes': hashes}
+
+	# Written to a temporary file first so an interrupted export doesn't leave a broken manifest
+	def save(self):
+		if not self.enabled:
+			return
+		temporary = self.path + ".tmp"
+		with open(temporary, "w") as f:
+			json.dump(self.entries, f, indent=1, sort_keys=True)
+		os.replace(temporary, self.path)